@@ -2,16 +2,31 @@ import os
 
 from flask import Flask, flash, redirect, render_template, request, session, url_for, abort
 from flask_session import Session
-from helpers import apology, login_required, blogger_required, moderator_required
+from helpers import apology, login_required, blogger_required, moderator_required, wants_json, get_current_user
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 import requests
-from sqlalchemy import func, or_
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import joinedload, selectinload, contains_eager
 import shutil
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from llm_guard import guard_text, guard_image
-import tempfile
+from llm_guard import guard_image, metrics_snapshot
+import guard_metrics
+from moderation import TextCheck, ImageCheck, moderate, upload_block_message, IMAGE_NOT_APPROVED_MESSAGE
+import moderation_queue
+import moderation_diff
+import search_index
+import index_check
+import comment_tree
+import thread_purge
+import hot_rank
+import voting
+import vote_buffer
+import query_guard
+from pagination import paginate
+import migrations
+import click
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -24,6 +39,31 @@ app = Flask(__name__)
 # 5 MB upload limit
 app.config["MAX_CONTENT_LENGTH"] = 5 * 1024 * 1024 
 
+# Items per page on the listing pages
+app.config["PAGE_SIZE"] = int(os.getenv("PAGE_SIZE", "20"))
+
+# Dialogue threads load progressively: top-level comments per page, and per comment
+# the best COMMENT_REPLIES_SHOWN replies for COMMENT_REPLY_DEPTH levels
+app.config["COMMENT_PAGE_SIZE"] = int(os.getenv("COMMENT_PAGE_SIZE", "20"))
+app.config["COMMENT_REPLY_DEPTH"] = int(os.getenv("COMMENT_REPLY_DEPTH", "2"))
+app.config["COMMENT_REPLIES_SHOWN"] = int(os.getenv("COMMENT_REPLIES_SHOWN", "3"))
+
+# Moderate new posts/comments in the background instead of during the request
+app.config["ASYNC_MODERATION"] = os.getenv("ASYNC_MODERATION", "0") == "1"
+app.config["MODERATION_WORKERS"] = int(os.getenv("MODERATION_WORKERS", "2"))
+
+# Uploads of pending content wait here, outside the static folder, until they are approved
+app.config["MODERATION_QUARANTINE_FOLDER"] = os.getenv(
+    "MODERATION_QUARANTINE_FOLDER", os.path.join(app.instance_path, "quarantine")
+)
+
+# Buffer vote counter updates in memory and write them every VOTE_FLUSH_MS
+app.config["VOTE_BUFFER"] = os.getenv("VOTE_BUFFER", "0") == "1"
+
+# Recompute the "hot" rank of the dialogues every HOT_REFRESH_SECONDS in this process
+# (0 = off, e.g. when `flask refresh-hot-ranks` runs from cron)
+app.config["HOT_RANK_REFRESH"] = os.getenv("HOT_RANK_REFRESH", "1") == "1"
+
 
 # Check for environment variable
 if not os.getenv("DATABASE_URL"):
@@ -33,6 +73,10 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False 
 db.init_app(app)
 
+# Count queries per request; above QUERY_LIMIT a request fails in tests and is logged otherwise
+app.config["QUERY_LIMIT"] = int(os.getenv("QUERY_LIMIT", "0"))
+query_guard.init_app(app)
+
 # Configure session to use filesystem
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_TYPE"] = "filesystem"
@@ -74,9 +118,7 @@ def nl_datetime(value, fmt="%d-%m-%Y %H:%M"):
 def inject_user():
     """Make user available in all templates"""
 
-    user_id = session.get("user_id")
-    user = User.query.get(user_id) if user_id else None
-    return {"user": user}
+    return {"user": get_current_user()}
 
 
 # ROOT ROUTE
@@ -226,7 +268,7 @@ def index():
     """User profile page and update profile (incl. optional password change)"""
 
     # Get current user
-    user = User.query.get(session["user_id"])
+    user = get_current_user()
 
 
     # Handle profile update via POST
@@ -291,7 +333,7 @@ def index():
                     os.remove(path)
                 except Exception:
                     pass
-                flash("Upload tegengehouden: ongewenste afbeelding gedetecteerd.", "danger")
+                flash(upload_block_message(decision_img), "danger")
                 return redirect(url_for("index"))
             user.profile_image = filename
 
@@ -320,8 +362,7 @@ def home():
     """Home page"""
 
     # Get current user if logged in
-    user_id = session.get("user_id")
-    user = User.query.get(user_id) if user_id else None
+    user = get_current_user()
     username = user.username if user else None
 
     return render_template("home.html", username=username)
@@ -335,14 +376,19 @@ def admin():
     """Admin overview page of all users"""
 
     # Check if current user is admin/superadmin
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
     if not current or (not current.has_role("admin") and not current.has_role("superadmin")):
         abort(403)
 
     # Search term from query string ?q=
     q = request.args.get("q", "").strip()
-    query = User.query
-    if q:
+    query = User.query.options(selectinload(User.roles))
+    hits = search_index.matches("user", q) if q else None
+    if hits is not None:
+        # Full-text search on username and name; a number also finds that user ID
+        found = User.id.in_(select(hits.c.ref_id))
+        query = query.filter(or_(found, User.id == int(q)) if q.isdigit() else found)
+    elif q:
         if q.isdigit():
             # Search by username or ID
             query = query.filter(
@@ -355,9 +401,17 @@ def admin():
             query = query.filter(User.username.ilike(f"%{q}%"))
 
     # Execute query and get all users
-    users = query.order_by(User.created_at.desc()).all()
+    # Newest users first, one page at a time
+    page = paginate(
+        query,
+        order=[(User.created_at, True), (User.id, True)],
+        key=lambda u: (u.created_at, u.id),
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        per_page=app.config["PAGE_SIZE"],
+    )
 
-    return render_template("admin.html", users=users, search=q)
+    return render_template("admin.html", users=page.items, page=page, search=q)
 
 
 # ADMIN DETAIL PAGE
@@ -368,7 +422,7 @@ def admin_detail(user_id):
     """Admin overview detail page per user and ability to change roles"""
 
     # Check if current user is admin/superadmin only admins and superadmins can access the page
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
     if not current or (not current.has_role("admin") and not current.has_role("superadmin")):
         return render_template("apology.html", top=403, bottom="Toegang geweigerd"), 403        
 
@@ -409,36 +463,81 @@ def admin_detail(user_id):
     return render_template("admin_detail.html", viewed_user=user, roles=roles)
 
 
+# ADMIN MODERATION METRICS
+#--------------------------------------------------------------------------------------------------------------
+@app.route("/admin/metrics")
+@login_required
+def admin_metrics():
+    """Moderation telemetry per context as JSON: latency, tokens, verdicts, cache and pre-filter ratios"""
+
+    # Check if current user is admin/superadmin
+    current = get_current_user()
+    if not current or (not current.has_role("admin") and not current.has_role("superadmin")):
+        abort(403)
+
+    return metrics_snapshot()
+
+
 # BLOG PAGE
 #--------------------------------------------------------------------------------------------------------------
 @app.route("/blog")
 def blog():
     """Overview of blog posts and search area"""
 
+    # Get current user
+    current_user = get_current_user()
+
     # Searchterm from query string
     q = request.args.get("q", "").strip()
 
-    # Base query
-    query = BlogPost.query
+    # Base query, pending posts are only shown to their author
+    query = (
+        BlogPost.query
+        .options(joinedload(BlogPost.author))
+        .filter(visible_to(BlogPost, current_user))
+    )
 
-    if q:
-        # Add search filters
-        query = (
-            BlogPost.query
-            .join(User)
-            .filter(
-                or_(
-                    BlogPost.title.ilike(f"%{q}%"),
-                    BlogPost.content.ilike(f"%{q}%"),
-                    User.username.ilike(f"%{q}%"),
-                    User.first_name.ilike(f"%{q}%"),
-                    User.last_name.ilike(f"%{q}%"),
+    hits = search_index.matches("blog_post", q) if q else None
+    if hits is not None:
+        # Full-text search, best matches first
+        query = query.join(hits, hits.c.ref_id == BlogPost.id).add_columns(hits.c.rank)
+        page = paginate(
+            query,
+            order=[(hits.c.rank, False), (BlogPost.id, True)],
+            key=lambda row: (row.rank, row[0].id),
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+            per_page=app.config["PAGE_SIZE"],
+        )
+        page.items = [row[0] for row in page.items]
+    else:
+        if q:
+            # No search index (database without full-text support)
+            query = (
+                query
+                .join(User)
+                .filter(
+                    or_(
+                        BlogPost.title.ilike(f"%{q}%"),
+                        BlogPost.content.ilike(f"%{q}%"),
+                        User.username.ilike(f"%{q}%"),
+                        User.first_name.ilike(f"%{q}%"),
+                        User.last_name.ilike(f"%{q}%"),
+                    )
                 )
             )
-        )
 
-    # Get all posts ordered by creation date descending
-    posts = query.order_by(BlogPost.created_at.desc()).all()
+        # Get all posts ordered by creation date descending
+        # Newest posts first, one page at a time
+        page = paginate(
+            query,
+            order=[(BlogPost.created_at, True), (BlogPost.id, True)],
+            key=lambda p: (p.created_at, p.id),
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+            per_page=app.config["PAGE_SIZE"],
+        )
+    posts = page.items
 
     # Collect thread stats for each post
     thread_stats = {}
@@ -459,23 +558,19 @@ def blog():
                 # Get thread score (default to 0 if None)
                 score = t.score or 0
 
-                # Number of comments in the dialogue
-                try:
-                    comment_count = t.comments.count()
-                except TypeError:
-                    comment_count = len(t.comments)
-
                 # Store stats
                 thread_stats[p.id] = {
                     "thread_id": t.id,
-                    "comment_count": comment_count,
+                    "comment_count": t.comment_count,
                     "score": score,
                 }
 
     return render_template(
         "blog.html",
         posts=posts,
+        page=page,
         search_query=q,
+        snippets=search_index.snippets("blog_post", q, [p.id for p in posts]) if q else {},
         thread_stats=thread_stats,
     )
 
@@ -488,8 +583,7 @@ def new_blog():
     """Create a new blog post"""
 
     # Check if current user is author
-    user_id = session.get("user_id")
-    current_user = User.query.get(user_id) if user_id else None
+    current_user = get_current_user()
 
     # Only authors can create blog posts
     if current_user is None or not current_user.has_role("author"):
@@ -506,98 +600,67 @@ def new_blog():
         if not content:
             errors.append("Inhoud is verplicht.")
 
-        pending_blocks = []
-        should_block = False
-
-        # Process thumbnail
-        thumb_file = request.files.get("thumbnail_image")
-        thumb_filename = None
-        if thumb_file and thumb_file.filename:
-            import tempfile
-
-            with tempfile.NamedTemporaryFile(
-                delete=False,
-                suffix=os.path.splitext(thumb_file.filename)[1] or ".jpg"
-            ) as tmp:
-                tmp_path = tmp.name
-                thumb_file.save(tmp_path)
+        # Asynchronous moderation: store as pending and check in the background
+        if app.config["ASYNC_MODERATION"]:
+            if errors:
+                for e in errors:
+                    flash(e, "danger")
+                return render_template("new_blog.html", title=title, content=content)
 
-            # Image content moderation via LLM guard
-            decision_img = guard_image(tmp_path, context="blog_thumbnail")
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+            # The thumbnail is set by the worker once it is approved
+            thumb_file = request.files.get("thumbnail_image")
+            thumb_path = None
+            if thumb_file and thumb_file.filename:
+                thumb_path = moderation_queue.quarantine(thumb_file)
 
-            if decision_img.get("action") == "block":
-                cats = decision_img.get("categories", {}) or {}
-
-                if cats.get("nsfw"):
-                    pending_blocks.append(
-                        "Post tegengehouden: Mogelijk seksueel expliciete afbeelding gedetecteerd"
-                    )
-                    should_block = True
-
-                if cats.get("gore"):
-                    pending_blocks.append(
-                        "Post tegengehouden: Mogelijk gewelddadige/bloederige afbeelding gedetecteerd"
-                    )
-                    should_block = True
-
-                if cats.get("offensive_symbols"):
-                    pending_blocks.append(
-                        "Post tegengehouden: Mogelijk aanstootgevende symbolen gedetecteerd"
-                    )
-                    should_block = True
+            post = BlogPost(
+                title=title,
+                content=content,
+                author_id=current_user.id,
+                moderation_status="pending",
+            )
+            db.session.add(post)
+            db.session.flush()
+            moderation_queue.enqueue("blog_post", post.id, "blog_post", image_path=thumb_path)
+            db.session.commit()
+            moderation_queue.notify()
 
-                if not pending_blocks:
-                    pending_blocks.append(
-                        "Post tegengehouden: Ongewenste afbeelding gedetecteerd."
-                    )
-                    should_block = True
+            flash("Blogpost ontvangen, deze wordt zo snel mogelijk gecontroleerd.", "info")
+            return redirect(url_for("blog"))
 
         if errors:
             for e in errors:
                 flash(e, "danger")
             return render_template("new_blog.html", title=title, content=content)
-        
-        # Text Content moderation via LLM guard
-        decision = guard_text(title=title, body=content, context="blog_post")
-        if decision.get("action") == "block":
-            found = decision.get("found", {})
-            prof = found.get("profanity_terms", []) or []
-            sus_urls = found.get("suspicious_urls", []) or []
-
-            if prof:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                    + ", ".join(prof[:10])
-                )
-                should_block = True
 
-            if sus_urls:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                    + ", ".join(sus_urls[:5])
-                )
-                should_block = True
+        # Text content moderation via LLM guard
+        text_check = TextCheck(title=title, body=content, context="blog_post")
+        checks = [text_check]
 
-            if not prof and not sus_urls:
-                pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-                should_block = True
+        # Process thumbnail, checked from a temporary file and only moved into static when approved
+        thumb_file = request.files.get("thumbnail_image")
+        image_check = None
+        if thumb_file and thumb_file.filename:
+            # Image content moderation via LLM guard
+            image_check = ImageCheck.from_upload(thumb_file, context="blog_thumbnail")
+            checks.append(image_check)
 
-        if should_block:
-            for msg in pending_blocks:
+        # Run text and image moderation at the same time
+        outcome = moderate(checks)
+
+        if outcome.blocked:
+            if image_check is not None:
+                image_check.discard()
+            for msg in outcome.messages:
                 flash(msg, "danger")
             return render_template("new_blog.html", title=title, content=content)
 
-        if thumb_file and thumb_file.filename:
-            thumb_file.stream.seek(0)
-            filename = secure_filename(thumb_file.filename)
-            path = os.path.join(BLOG_THUMB_UPLOAD_FOLDER, filename)
-            thumb_file.save(path)
-            thumb_filename = filename
-        
+        thumb_filename = None
+        if image_check is not None:
+            thumb_filename = image_check.publish(BLOG_THUMB_UPLOAD_FOLDER)
+            if thumb_filename is None:
+                flash(IMAGE_NOT_APPROVED_MESSAGE, "warning")
+
         # Create and save new blog post
         post = BlogPost(
             title=title,
@@ -606,6 +669,11 @@ def new_blog():
             thumbnail_image=thumb_filename
         )
         db.session.add(post)
+        db.session.flush()
+
+        # Later edits only re-check what changed
+        if moderation_diff.approved(text_check):
+            moderation_diff.remember("blog_post", post.id, title, content)
         db.session.commit()
 
         flash("Blogpost succesvol aangemaakt.", "success")
@@ -642,7 +710,7 @@ def upload_image():
             os.remove(path)
         except Exception:
             pass
-        return {"error": "Upload tegengehouden: ongewenste afbeelding gedetecteerd."}, 400
+        return {"error": upload_block_message(decision_img)}, 400
 
     # Return the file URL for TinyMCE
     file_url = url_for("static", filename=f"uploads/{filename}", _external=False)
@@ -658,6 +726,13 @@ def view_blog(post_id):
     # Get the blog post
     post = BlogPost.query.get_or_404(post_id)
 
+    # Get current user
+    current_user = get_current_user()
+
+    # Pending or blocked posts are only visible to their author
+    if not is_visible_to(post, current_user):
+        abort(404)
+
     # Get dialogue thread info if the blog has been converted to a dialogue
     thread = None
     comment_count = 0
@@ -665,13 +740,15 @@ def view_blog(post_id):
     if post.dialogue_thread_id:
         thread = DialogueThread.query.get(post.dialogue_thread_id)
         if thread:
-            comment_count = thread.comments.count()
+            comment_count = thread.comment_count
             thread_score = thread.score or 0
 
     # Sidebar: recent blog posts
     sidebar_posts = (
         BlogPost.query
+        .options(joinedload(BlogPost.author))
         .filter(BlogPost.id != post.id)
+        .filter(visible_to(BlogPost, current_user))
         .order_by(BlogPost.created_at.desc())
         .limit(10)
         .all()
@@ -698,8 +775,7 @@ def edit_blog(post_id):
     post = BlogPost.query.get_or_404(post_id)
 
     # Get the current user from the session
-    user_id = session.get("user_id")
-    current_user = User.query.get(user_id) if user_id else None
+    current_user = get_current_user()
 
     # Check if user is logged in
     if current_user is None:
@@ -721,72 +797,40 @@ def edit_blog(post_id):
             flash("Titel en inhoud zijn verplicht.", "danger")
             return render_template("edit_blog.html", post=post)
 
-        pending_blocks = []
-        should_block = False
-
-        #  Text Content moderation via LLM guard
-        decision = guard_text(title=title, body=content, context="blog_post_edit")
-        if decision.get("action") == "block":
-            found = decision.get("found", {})
-            prof = found.get("profanity_terms", []) or []
-            sus_urls = found.get("suspicious_urls", []) or []
-
-            if prof:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                    + ", ".join(prof[:10])
-                )
-                should_block = True
-
-            if sus_urls:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                    + ", ".join(sus_urls[:5])
-                )
-                should_block = True
-
-            if not prof and not sus_urls:
-                pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-                should_block = True
+        # Text content moderation via LLM guard, only of what changed since the last approved version
+        text_check = moderation_diff.edit_check("blog_post", post.id, title, content, "blog_post_edit")
+        checks = [text_check]
 
         post.title = title
         post.content = content
 
         # Optionally upload a new thumbnail
         file = request.files.get("thumbnail_image")
+        image_check = None
         if file and file.filename:
-            filename = secure_filename(file.filename)
-            path = os.path.join(BLOG_THUMB_UPLOAD_FOLDER, filename)
-            file.save(path)
+            # Image content moderation via LLM guard, from a temporary file
+            image_check = ImageCheck.from_upload(file, context="blog_thumbnail_edit")
+            checks.append(image_check)
 
-            # Image content moderation via LLM guard
-            decision_img = guard_image(path, context="blog_thumbnail_edit")
-            if decision_img.get("action") == "block":
-                try:
-                    os.remove(path)
-                except Exception:
-                    pass
-                cats = decision_img.get("categories", {}) or {}
-                if cats.get("nsfw"):
-                    pending_blocks.append("Post tegengehouden: Mogelijk seksueel expliciete afbeelding gedetecteerd")
-                    should_block = True
-                if cats.get("gore"):
-                    pending_blocks.append("Post tegengehouden: Mogelijk gewelddadige/bloederige afbeelding gedetecteerd")
-                    should_block = True
-                if cats.get("offensive_symbols"):
-                    pending_blocks.append("Post tegengehouden: Mogelijk aanstootgevende symbolen gedetecteerd")
-                    should_block = True
-                if not cats.get("nsfw") and not cats.get("gore") and not cats.get("offensive_symbols"):
-                    pending_blocks.append("Post tegengehouden: Ongewenste afbeelding gedetecteerd.")
-                    should_block = True
-            else:
-                post.thumbnail_image = filename
+        # Run text and image moderation at the same time
+        outcome = moderate(checks)
 
-        if should_block:
-            for msg in pending_blocks:
+        if outcome.blocked:
+            if image_check is not None:
+                image_check.discard()
+            for msg in outcome.messages:
                 flash(msg, "danger")
             return render_template("edit_blog.html", post=post)
 
+        if image_check is not None:
+            filename = image_check.publish(BLOG_THUMB_UPLOAD_FOLDER)
+            if filename is None:
+                flash(IMAGE_NOT_APPROVED_MESSAGE, "warning")
+            else:
+                post.thumbnail_image = filename
+
+        if moderation_diff.approved(text_check):
+            moderation_diff.remember("blog_post", post.id, title, content)
         db.session.commit()
 
         flash("Blogpost bijgewerkt.", "success")
@@ -806,6 +850,7 @@ def delete_blog(post_id):
     post = BlogPost.query.get_or_404(post_id)
 
     # Delete the blog post
+    moderation_diff.forget("blog_post", [post.id])
     db.session.delete(post)
     db.session.commit()
     flash("Blogpost verwijderd.")
@@ -823,7 +868,7 @@ def make_dialogue_from_blog(post_id):
     post = BlogPost.query.get_or_404(post_id)
 
     # Get current user
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
 
     # Only the author of the post or an admin/superadmin can convert
     if post.dialogue_thread_id:
@@ -864,6 +909,13 @@ def make_dialogue_from_blog(post_id):
 # Dialogue constant
 MAX_TITLE_LENGTH = 255
 
+# Orders of the /dialoog listing, (column, descending) ending in the id for the cursors
+DIALOOG_SORTS = {
+    "hot": [(DialogueThread.hot_rank, True), (DialogueThread.created_at, True), (DialogueThread.id, True)],
+    "top": [(DialogueThread.score, True), (DialogueThread.created_at, True), (DialogueThread.id, True)],
+    "new": [(DialogueThread.created_at, True), (DialogueThread.id, True)],
+}
+
 # DIALOOG PAGE
 #--------------------------------------------------------------------------------------------------------------
 @app.route("/dialoog", methods=["GET"])
@@ -871,32 +923,64 @@ def dialoog():
     """overview of dialogue threads and search area"""
 
     # Get current user
-    user_id = session.get("user_id")
-    current_user = User.query.get(user_id) if user_id else None
+    current_user = get_current_user()
 
     # search term from query string
     q = request.args.get("q", "").strip()
 
-    # base query
-    query = DialogueThread.query.join(User)
-    if q:
-        query = query.filter(
-            or_(
-                DialogueThread.title.ilike(f"%{q}%"),
-                DialogueThread.body.ilike(f"%{q}%"),
-                User.username.ilike(f"%{q}%"),
-                User.first_name.ilike(f"%{q}%"),
-                User.last_name.ilike(f"%{q}%"),
-            )
+    # hot (recent activity), top (highest score) or new; search results are ordered by relevance
+    sort = request.args.get("sort", "hot")
+    if sort not in DIALOOG_SORTS:
+        sort = "hot"
+
+    # base query, pending threads are only shown to their author
+    query = (
+        DialogueThread.query
+        .join(User)
+        .options(contains_eager(DialogueThread.author))
+        .filter(visible_to(DialogueThread, current_user))
+    )
+    hits = search_index.matches("dialogue_thread", q) if q else None
+    if hits is not None:
+        # Full-text search, best matches first
+        query = query.join(hits, hits.c.ref_id == DialogueThread.id).add_columns(hits.c.rank)
+        page = paginate(
+            query,
+            order=[(hits.c.rank, False), (DialogueThread.id, True)],
+            key=lambda row: (row.rank, row[0].id),
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+            per_page=app.config["PAGE_SIZE"],
         )
+        page.items = [row[0] for row in page.items]
+    else:
+        if q:
+            # No search index (database without full-text support)
+            query = query.filter(
+                or_(
+                    DialogueThread.title.ilike(f"%{q}%"),
+                    DialogueThread.body.ilike(f"%{q}%"),
+                    User.username.ilike(f"%{q}%"),
+                    User.first_name.ilike(f"%{q}%"),
+                    User.last_name.ilike(f"%{q}%"),
+                )
+            )
 
-    # get all threads ordered by score desc, then creation date desc
-    threads = query.order_by(
-        DialogueThread.score.desc(),
-        DialogueThread.created_at.desc()
-    ).all()
+        # One page at a time in the chosen order, each served by its own index
+        order = DIALOOG_SORTS[sort]
+        page = paginate(
+            query,
+            order=order,
+            key=lambda t: tuple(getattr(t, expr.key) for expr, _ in order),
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+            per_page=app.config["PAGE_SIZE"],
+        )
 
-    return render_template("dialoog.html", threads=threads, search_query=q)
+    snippets = search_index.snippets("dialogue_thread", q, [t.id for t in page.items]) if q else {}
+    return render_template(
+        "dialoog.html", threads=page.items, page=page, search_query=q, snippets=snippets, sort=sort,
+    )
 
 
 # NEW DIALOOG THREAD
@@ -907,8 +991,7 @@ def new_dialoog():
     """Create a new dialogue thread"""
 
     # Get current user
-    user_id = session.get("user_id")
-    current_user = User.query.get(user_id) if user_id else None
+    current_user = get_current_user()
 
     # Check if user is logged in
     if current_user is None:
@@ -924,64 +1007,33 @@ def new_dialoog():
         if not title:
             errors.append("Titel is verplicht.")
 
-        pending_blocks = []
-        should_block = False
+        # Asynchronous moderation: store as pending and check in the background
+        if app.config["ASYNC_MODERATION"]:
+            if errors:
+                for e in errors:
+                    flash(e, "danger")
+                return render_template("new_dialoog.html", title=title, body=body)
 
-        #  Text Content moderation via LLM guard
-        decision = guard_text(title=title, body=body, context="dialogue_thread")
-        if decision.get("action") == "block":
-            found = decision.get("found", {})
-            prof = found.get("profanity_terms", []) or []
-            sus_urls = found.get("suspicious_urls", []) or []
-
-            if prof:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                    + ", ".join(prof[:10])
-                )
-                should_block = True
+            # The thumbnail is set by the worker once it is approved
+            thumb_file = request.files.get("thumbnail")
+            thumb_path = None
+            if thumb_file and thumb_file.filename:
+                thumb_path = moderation_queue.quarantine(thumb_file)
 
-            if sus_urls:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                    + ", ".join(sus_urls[:5])
-                )
-                should_block = True
+            thread = DialogueThread(
+                title=title,
+                body=body or None,
+                author_id=current_user.id,
+                moderation_status="pending",
+            )
+            db.session.add(thread)
+            db.session.flush()
+            moderation_queue.enqueue("dialogue_thread", thread.id, "dialogue_thread", image_path=thumb_path)
+            db.session.commit()
+            moderation_queue.notify()
 
-            if not prof and not sus_urls:
-                pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-                should_block = True
-
-        # Process thumbnail (image or video)
-        thumb_file = request.files.get("thumbnail")
-        thumb_filename = None
-        if thumb_file and thumb_file.filename:
-            filename = secure_filename(thumb_file.filename)
-            path = os.path.join(DIALOGUE_THUMB_UPLOAD_FOLDER, filename)
-            thumb_file.save(path)
-
-            # Image content moderation via LLM guard
-            decision_img = guard_image(path, context="dialogue_thumbnail")
-            if decision_img.get("action") == "block":
-                try:
-                    os.remove(path)
-                except Exception:
-                    pass
-                cats = decision_img.get("categories", {}) or {}
-                if cats.get("nsfw"):
-                    pending_blocks.append("Post tegengehouden: Mogelijk seksueel expliciete afbeelding gedetecteerd")
-                    should_block = True
-                if cats.get("gore"):
-                    pending_blocks.append("Post tegengehouden: Mogelijk gewelddadige/bloederige afbeelding gedetecteerd")
-                    should_block = True
-                if cats.get("offensive_symbols"):
-                    pending_blocks.append("Post tegengehouden: Mogelijk aanstootgevende symbolen gedetecteerd")
-                    should_block = True
-                if not cats.get("nsfw") and not cats.get("gore") and not cats.get("offensive_symbols"):
-                    pending_blocks.append("Post tegengehouden: Ongewenste afbeelding gedetecteerd.")
-                    should_block = True
-            else:
-                thumb_filename = filename
+            flash("Dialoog ontvangen, deze wordt zo snel mogelijk gecontroleerd.", "info")
+            return redirect(url_for("view_thread", thread_id=thread.id))
 
         # Show errors if any
         if errors:
@@ -993,8 +1045,25 @@ def new_dialoog():
                 body=body,
             )
 
-        if should_block:
-            for msg in pending_blocks:
+        # Text content moderation via LLM guard
+        text_check = TextCheck(title=title, body=body, context="dialogue_thread")
+        checks = [text_check]
+
+        # Process thumbnail (image or video)
+        thumb_file = request.files.get("thumbnail")
+        image_check = None
+        if thumb_file and thumb_file.filename:
+            # Image content moderation via LLM guard, from a temporary file
+            image_check = ImageCheck.from_upload(thumb_file, context="dialogue_thumbnail")
+            checks.append(image_check)
+
+        # Run text and image moderation at the same time
+        outcome = moderate(checks)
+
+        if outcome.blocked:
+            if image_check is not None:
+                image_check.discard()
+            for msg in outcome.messages:
                 flash(msg, "danger")
             return render_template(
                 "new_dialoog.html",
@@ -1002,6 +1071,12 @@ def new_dialoog():
                 body=body,
             )
 
+        thumb_filename = None
+        if image_check is not None:
+            thumb_filename = image_check.publish(DIALOGUE_THUMB_UPLOAD_FOLDER)
+            if thumb_filename is None:
+                flash(IMAGE_NOT_APPROVED_MESSAGE, "warning")
+
         # Create and save new dialogue thread
         thread = DialogueThread(
             title=title,
@@ -1010,6 +1085,11 @@ def new_dialoog():
             thumbnail_image=thumb_filename,
         )
         db.session.add(thread)
+        db.session.flush()
+
+        # Later edits only re-check what changed
+        if moderation_diff.approved(text_check):
+            moderation_diff.remember("dialogue_thread", thread.id, title, body)
         db.session.commit()
 
         flash("Nieuwe dialoog gestart.", "success")
@@ -1029,8 +1109,11 @@ def view_thread(thread_id):
     thread = DialogueThread.query.get_or_404(thread_id)
 
     # Get current user
-    user_id = session.get("user_id")
-    current_user = User.query.get(user_id) if user_id else None
+    current_user = get_current_user()
+
+    # Pending or blocked threads are only visible to their author
+    if not is_visible_to(thread, current_user):
+        abort(404)
 
     # Handle new comment submission
     if request.method == "POST":
@@ -1042,39 +1125,35 @@ def view_thread(thread_id):
         parent_id_raw = request.form.get("parent_id", "").strip()
         parent_id = int(parent_id_raw) if parent_id_raw.isdigit() else None
 
+        # Replies only to comments of this thread
+        if parent_id is not None and not DialogueComment.query.filter_by(id=parent_id, thread_id=thread.id).first():
+            parent_id = None
+
         if not body:
             flash("Reactie mag niet leeg zijn.", "danger")
-        else:
-            pending_blocks = []
-            should_block = False
-
-            #  Text Content moderation via LLM guard
-            decision = guard_text(title="", body=body, context="dialogue_comment")
-            if decision.get("action") == "block":
-                found = decision.get("found", {})
-                prof = found.get("profanity_terms", []) or []
-                sus_urls = found.get("suspicious_urls", []) or []
-
-                if prof:
-                    pending_blocks.append(
-                        "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                        + ", ".join(prof[:10])
-                    )
-                    should_block = True
-
-                if sus_urls:
-                    pending_blocks.append(
-                        "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                        + ", ".join(sus_urls[:5])
-                    )
-                    should_block = True
-
-                if not prof and not sus_urls:
-                    pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-                    should_block = True
+        elif app.config["ASYNC_MODERATION"]:
+            # Store as pending and check in the background
+            comment = DialogueComment(
+                body=body,
+                author_id=current_user.id,
+                thread_id=thread.id,
+                parent_id=parent_id,
+                moderation_status="pending",
+            )
+            db.session.add(comment)
+            db.session.flush()
+            moderation_queue.enqueue("dialogue_comment", comment.id, "dialogue_comment")
+            db.session.commit()
+            moderation_queue.notify()
 
-            if should_block:
-                for msg in pending_blocks:
+            flash("Reactie ontvangen, deze wordt zo snel mogelijk gecontroleerd.", "info")
+            return redirect(url_for("view_thread", thread_id=thread.id, _anchor="comments"))
+        else:
+            # Text content moderation via LLM guard
+            text_check = TextCheck(title="", body=body, context="dialogue_comment")
+            outcome = moderate([text_check])
+            if outcome.blocked:
+                for msg in outcome.messages:
                     flash(msg, "danger")
                 return redirect(url_for("view_thread", thread_id=thread.id, _anchor="comments"))
 
@@ -1085,6 +1164,11 @@ def view_thread(thread_id):
                 parent_id=parent_id,
             )
             db.session.add(comment)
+            db.session.flush()
+
+            # Later edits only re-check what changed
+            if moderation_diff.approved(text_check):
+                moderation_diff.remember("dialogue_comment", comment.id, "", body)
             db.session.commit()
             flash("Reactie geplaatst.", "success")
             return redirect(
@@ -1096,26 +1180,52 @@ def view_thread(thread_id):
                 )
             )
 
-    # Retrieve comments
-    comments = (
-        DialogueComment.query
-        .filter_by(thread_id=thread.id)
-        .order_by(DialogueComment.score.desc(), DialogueComment.created_at.asc())
-        .all()
+    # First page of top-level comments with their best replies
+    return comment_page(thread, current_user)
+
+
+def comment_page(thread, current_user, parent=None):
+    """One page of comments below ``parent`` (None: top level) and their best replies.
+
+    The whole thread page, or only the comments for the "more" links (JSON).
+    """
+
+    comments, more, page = comment_tree.load_page(
+        thread.id,
+        visible_to(DialogueComment, current_user),
+        parent_id=parent.id if parent else None,
+        after=request.args.get("after"),
+        per_page=app.config["COMMENT_PAGE_SIZE"],
+        depth=app.config["COMMENT_REPLY_DEPTH"],
+        replies_shown=app.config["COMMENT_REPLIES_SHOWN"],
     )
 
-    # Build the top-level comment tree 
-    tree = []
-    by_id = {c.id: c for c in comments}
-    for c in comments:
-        if c.parent_id and c.parent_id in by_id:
-            continue
-        tree.append(c)
+    # Next page of this level
+    next_url = None
+    if page.has_next:
+        if parent is None:
+            next_url = url_for("thread_comments", thread_id=thread.id, after=page.next_cursor)
+        else:
+            next_url = url_for("comment_replies", comment_id=parent.id, after=page.next_cursor)
+
+    if wants_json():
+        rows = comment_tree.render_list(comments, more)
+        html = render_template("_comment_rows.html", comment_rows=rows, next_url=next_url, user=current_user)
+        return {"html": html, "next": next_url}
+
+    # Without JavaScript the "more" links open the page with only that part of the thread
+    if parent is not None:
+        if next_url:
+            more[parent.id] = (None, page.next_cursor)
+        comments.insert(0, parent)
+        next_url = None
 
     # Get sidebar threads
     sidebar_threads = (
         DialogueThread.query
+        .options(joinedload(DialogueThread.author))
         .filter(DialogueThread.id != thread.id)
+        .filter(visible_to(DialogueThread, current_user))
         .order_by(DialogueThread.created_at.desc())
         .limit(10)
         .all()
@@ -1124,13 +1234,51 @@ def view_thread(thread_id):
     return render_template(
         "dialoog_thread.html",
         thread=thread,
-        root_comments=tree,
-        all_comments=comments,
+        comment_rows=comment_tree.render_list(comments, more),
+        next_url=next_url,
+        comment_focus=parent is not None or page.has_prev,
         user=current_user,
         sidebar_threads=sidebar_threads,
     )
 
 
+# MORE COMMENTS
+#--------------------------------------------------------------------------------------------------------------
+@app.route("/dialoog/<int:thread_id>/comments")
+def thread_comments(thread_id):
+    """Next page of top-level comments of a thread"""
+
+    # Get the dialogue thread
+    thread = DialogueThread.query.get_or_404(thread_id)
+
+    # Get current user
+    current_user = get_current_user()
+
+    if not is_visible_to(thread, current_user):
+        abort(404)
+
+    return comment_page(thread, current_user)
+
+
+# MORE REPLIES
+#--------------------------------------------------------------------------------------------------------------
+@app.route("/dialoog/comment/<int:comment_id>/replies")
+def comment_replies(comment_id):
+    """(Next page of) the replies to a comment"""
+
+    # Get the comment and its thread
+    comment = DialogueComment.query.get_or_404(comment_id)
+    thread = comment.thread
+
+    # Get current user
+    current_user = get_current_user()
+
+    if not is_visible_to(thread, current_user) or not is_visible_to(comment, current_user):
+        abort(404)
+
+    return comment_page(thread, current_user, parent=comment)
+
+
 # EDIT THREAD
 #--------------------------------------------------------------------------------------------------------------
 @app.route("/dialoog/thread/<int:thread_id>/edit", methods=["POST"])
@@ -1140,7 +1288,7 @@ def edit_thread(thread_id):
 
     # Get the dialogue thread
     thread = DialogueThread.query.get_or_404(thread_id)
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
 
     # Only starter, admin or superadmin
     if not (
@@ -1159,33 +1307,9 @@ def edit_thread(thread_id):
         flash("Titel mag niet leeg zijn.", "danger")
         return redirect(url_for("view_thread", thread_id=thread.id))
 
-    pending_blocks = []
-    should_block = False
-
-    #  Text Content moderation via LLM guard
-    decision = guard_text(title=title, body=body, context="dialogue_thread_edit")
-    if decision.get("action") == "block":
-        found = decision.get("found", {})
-        prof = found.get("profanity_terms", []) or []
-        sus_urls = found.get("suspicious_urls", []) or []
-
-        if prof:
-            pending_blocks.append(
-                "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                + ", ".join(prof[:10])
-            )
-            should_block = True
-
-        if sus_urls:
-            pending_blocks.append(
-                "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                + ", ".join(sus_urls[:5])
-            )
-            should_block = True
-
-        if not prof and not sus_urls:
-            pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-            should_block = True
+    # Text content moderation via LLM guard, only of what changed since the last approved version
+    text_check = moderation_diff.edit_check("dialogue_thread", thread.id, title, body, "dialogue_thread_edit")
+    checks = [text_check]
 
     # Update thread
     thread.title = title
@@ -1193,39 +1317,31 @@ def edit_thread(thread_id):
 
     # Optionally upload a new thumbnail
     file = request.files.get("thumbnail")
+    image_check = None
     if file and file.filename:
-        filename = secure_filename(file.filename)
-        path = os.path.join(DIALOGUE_THUMB_UPLOAD_FOLDER, filename)
-        file.save(path)
-
-        # Image content moderation via LLM guard
-        decision_img = guard_image(path, context="dialogue_thumbnail_edit")
-        if decision_img.get("action") == "block":
-            try:
-                os.remove(path)
-            except Exception:
-                pass
-            cats = decision_img.get("categories", {}) or {}
-            if cats.get("nsfw"):
-                pending_blocks.append("Post tegengehouden: Mogelijk seksueel expliciete afbeelding gedetecteerd")
-                should_block = True
-            if cats.get("gore"):
-                pending_blocks.append("Post tegengehouden: Mogelijk gewelddadige/bloederige afbeelding gedetecteerd")
-                should_block = True
-            if cats.get("offensive_symbols"):
-                pending_blocks.append("Post tegengehouden: Mogelijk aanstootgevende symbolen gedetecteerd")
-                should_block = True
-            if not cats.get("nsfw") and not cats.get("gore") and not cats.get("offensive_symbols"):
-                pending_blocks.append("Post tegengehouden: Ongewenste afbeelding gedetecteerd.")
-                should_block = True
-        else:
-            thread.thumbnail_image = filename
+        # Image content moderation via LLM guard, from a temporary file
+        image_check = ImageCheck.from_upload(file, context="dialogue_thumbnail_edit")
+        checks.append(image_check)
+
+    # Run text and image moderation at the same time
+    outcome = moderate(checks)
 
-    if should_block:
-        for msg in pending_blocks:
+    if outcome.blocked:
+        if image_check is not None:
+            image_check.discard()
+        for msg in outcome.messages:
             flash(msg, "danger")
         return redirect(url_for("view_thread", thread_id=thread.id))
 
+    if image_check is not None:
+        filename = image_check.publish(DIALOGUE_THUMB_UPLOAD_FOLDER)
+        if filename is None:
+            flash(IMAGE_NOT_APPROVED_MESSAGE, "warning")
+        else:
+            thread.thumbnail_image = filename
+
+    if moderation_diff.approved(text_check):
+        moderation_diff.remember("dialogue_thread", thread.id, title, body)
     db.session.commit()
     flash("Dialoog bijgewerkt.", "success")
     return redirect(url_for("view_thread", thread_id=thread.id))
@@ -1239,30 +1355,13 @@ def delete_thread(thread_id):
     """Delete a dialogue thread (only admin / superadmin)"""
 
     thread = DialogueThread.query.get_or_404(thread_id)
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
 
     if not (current.has_role("admin") or current.has_role("superadmin")):
         abort(403)
 
-    # 0) delete all thread votes (to avoid FK error)
-    DialogueThreadVote.query.filter_by(thread_id=thread.id).delete(
-        synchronize_session=False
-    )
-
-    # 1) delete all votes on comments of this thread
-    for comment in thread.comments:
-        DialogueCommentVote.query.filter_by(comment_id=comment.id).delete(
-            synchronize_session=False
-        )
-
-    # 2) remove any linkage from BlogPost
-    BlogPost.query.filter_by(dialogue_thread_id=thread.id).update(
-        {BlogPost.dialogue_thread_id: None},
-        synchronize_session=False,
-    )
-
-    # 3) then delete the thread itself (and via cascade the comments)
-    db.session.delete(thread)
+    # Votes, comments, links, fingerprints and the thread itself in a few bulk statements
+    thread_purge.purge_thread(thread.id)
     db.session.commit()
 
     flash("Dialoog verwijderd.", "success")
@@ -1278,7 +1377,6 @@ def vote_thread(thread_id):
 
     # Get the dialogue thread
     thread = DialogueThread.query.get_or_404(thread_id)
-    current_user = User.query.get(session["user_id"])
 
     # Get vote direction from form
     direction = request.form.get("direction")
@@ -1288,36 +1386,13 @@ def vote_thread(thread_id):
     # Determine vote value
     value = 1 if direction == "up" else -1
 
-    # Check if user has already voted
-    existing = DialogueThreadVote.query.filter_by(
-        user_id=current_user.id,
-        thread_id=thread.id
-    ).first()
-
-    # Update vote if exists
-    if existing:
-        if existing.value == value:
-            # same vote again will remove vote
-            thread.score -= existing.value
-            db.session.delete(existing)
-        else:
-            # reverse vote
-            thread.score -= existing.value
-            existing.value = value
-            thread.score += value
-    
-    # New vote
-    else:
-        vote = DialogueThreadVote(
-            user_id=current_user.id,
-            thread_id=thread.id,
-            value=value
-        )
-        db.session.add(vote)
-        thread.score += value
-
+    # Add, reverse or (same vote again) remove the vote in SQL
+    totals = voting.vote_thread(session["user_id"], thread.id, value)
     db.session.commit()
 
+    if wants_json():
+        return totals
+
     return redirect(request.referrer or url_for("dialoog"))
 
 
@@ -1331,10 +1406,6 @@ def vote_comment(comment_id):
     # Get the comment
     comment = DialogueComment.query.get_or_404(comment_id)
 
-    # Get current user
-    user_id = session.get("user_id")
-    current_user = User.query.get(user_id)
-
     # get vote direction
     direction = request.form.get("direction")
     if direction not in ("up", "down"):
@@ -1343,34 +1414,13 @@ def vote_comment(comment_id):
     # Determine vote value
     value = 1 if direction == "up" else -1
 
-    # Check if user has already voted
-    existing = DialogueCommentVote.query.filter_by(
-        user_id=current_user.id,
-        comment_id=comment.id
-    ).first()
-
-    if existing:
-        if existing.value == value:
-            # Same vote again will remove vote
-            comment.score -= existing.value
-            db.session.delete(existing)
-        else:
-            # Reverse vote
-            comment.score -= existing.value
-            existing.value = value
-            comment.score += value
-    else:
-        # New vote
-        vote = DialogueCommentVote(
-            user_id=current_user.id,
-            comment_id=comment.id,
-            value=value,
-        )
-        db.session.add(vote)
-        comment.score += value
-
+    # Add, reverse or (same vote again) remove the vote in SQL
+    totals = voting.vote_comment(session["user_id"], comment.id, value)
     db.session.commit()
 
+    if wants_json():
+        return totals
+
     return redirect(
         url_for(
             "view_thread",
@@ -1389,7 +1439,7 @@ def delete_comment(comment_id):
     
     # Get the comment
     comment = DialogueComment.query.get_or_404(comment_id)
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
 
     # only owner or admin/superadmin
     if not (
@@ -1401,6 +1451,10 @@ def delete_comment(comment_id):
 
     # Get the thread ID before deleting the comment
     thread_id = comment.thread_id
+    moderation_diff.forget("dialogue_comment", [comment.id])
+
+    # Replies become top-level comments
+    comment_tree.detach_replies(comment)
     db.session.delete(comment)
     db.session.commit()
     flash("Reactie verwijderd.", "success")
@@ -1416,7 +1470,7 @@ def edit_comment(comment_id):
 
     # Get the comment
     comment = DialogueComment.query.get_or_404(comment_id)
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
 
     # only owner or admin/superadmin
     if not (
@@ -1430,37 +1484,20 @@ def edit_comment(comment_id):
     body = request.form.get("body", "").strip()
     if not body:
         flash("Reactie mag niet leeg zijn.", "danger")
+    elif app.config["ASYNC_MODERATION"]:
+        # Store as pending and check in the background
+        comment.body = body
+        comment.moderation_status = "pending"
+        moderation_queue.enqueue("dialogue_comment", comment.id, "dialogue_comment_edit")
+        db.session.commit()
+        moderation_queue.notify()
+        flash("Reactie bijgewerkt, deze wordt zo snel mogelijk gecontroleerd.", "info")
     else:
-        pending_blocks = []
-        should_block = False
-
-        #  Text Content moderation via LLM guard
-        decision = guard_text(title="", body=body, context="dialogue_comment_edit")
-        if decision.get("action") == "block":
-            found = decision.get("found", {})
-            prof = found.get("profanity_terms", []) or []
-            sus_urls = found.get("suspicious_urls", []) or []
-
-            if prof:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                    + ", ".join(prof[:10])
-                )
-                should_block = True
-
-            if sus_urls:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                    + ", ".join(sus_urls[:5])
-                )
-                should_block = True
-
-            if not prof and not sus_urls:
-                pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-                should_block = True
-
-        if should_block:
-            for msg in pending_blocks:
+        # Text content moderation via LLM guard, only of what changed since the last approved version
+        text_check = moderation_diff.edit_check("dialogue_comment", comment.id, "", body, "dialogue_comment_edit")
+        outcome = moderate([text_check])
+        if outcome.blocked:
+            for msg in outcome.messages:
                 flash(msg, "danger")
             return redirect(
                 url_for(
@@ -1471,6 +1508,8 @@ def edit_comment(comment_id):
             )
 
         comment.body = body
+        if moderation_diff.approved(text_check):
+            moderation_diff.remember("dialogue_comment", comment.id, "", body)
         db.session.commit()
         flash("Reactie bijgewerkt.", "success")
 
@@ -1489,22 +1528,39 @@ def edit_comment(comment_id):
 def opinie():
     """Show all opinion polls, ordered by popularity, plus user vote info."""
 
+    # Current user (may be None)
+    current_user = get_current_user()
+
     # Get all polls ordered by total votes desc, then creation date desc
-    polls = (
+    # Most votes first, then newest, one page at a time
+    query = (
         OpinionPoll.query
-        .order_by((OpinionPoll.yes_count + OpinionPoll.no_count).desc(),
-                  OpinionPoll.created_at.desc())
-        .all()
+        .options(joinedload(OpinionPoll.author))
+        .filter(visible_to(OpinionPoll, current_user))
     )
+    page = paginate(
+        query,
+        order=[
+            (OpinionPoll.yes_count + OpinionPoll.no_count, True),
+            (OpinionPoll.created_at, True),
+            (OpinionPoll.id, True),
+        ],
+        key=lambda p: (p.yes_count + p.no_count, p.created_at, p.id),
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        per_page=app.config["PAGE_SIZE"],
+    )
+    polls = page.items
 
-    # Current user (may be None)
-    user_id = session.get("user_id")
-    current_user = User.query.get(user_id) if user_id else None
-
-    # Get user's votes
+    # Get user's votes on the polls of this page
     user_votes = {}
-    if current_user:
-        votes = OpinionVote.query.filter_by(user_id=current_user.id).all()
+    if current_user and polls:
+        votes = (
+            OpinionVote.query
+            .filter(OpinionVote.user_id == current_user.id)
+            .filter(OpinionVote.poll_id.in_([p.id for p in polls]))
+            .all()
+        )
         for v in votes:
             user_votes[v.poll_id] = "yes" if v.value == 1 else "no"
 
@@ -1512,6 +1568,7 @@ def opinie():
     return render_template(
         "opinie.html",
         polls=polls,
+        page=page,
         user=current_user,
         user_votes=user_votes,
         now_utc=datetime.utcnow(),
@@ -1526,7 +1583,7 @@ def new_opinie():
     """Create a new opinion poll with default duration of 3 days."""
 
     # Get current user
-    current_user = User.query.get(session["user_id"])
+    current_user = get_current_user()
 
     # Get and validate form data
     question = (request.form.get("question") or "").strip()
@@ -1549,36 +1606,40 @@ def new_opinie():
         flash(f"Toelichting mag maximaal {max_description_len} tekens bevatten.", "danger")
         return redirect(url_for("opinie"))
 
-    pending_blocks = []
-    should_block = False
-
-    #  Text Content moderation via LLM guard
-    decision = guard_text(title=question, body=description, context="opinion_poll")
-    if decision.get("action") == "block":
-        found = decision.get("found", {})
-        prof = found.get("profanity_terms", []) or []
-        sus_urls = found.get("suspicious_urls", []) or []
+    # Asynchronous moderation: store as pending and check in the background
+    if app.config["ASYNC_MODERATION"]:
+        thumb_file = request.files.get("thumbnail")
+        if not thumb_file or not thumb_file.filename:
+            flash("Thumbnail is verplicht.", "danger")
+            return redirect(url_for("opinie"))
 
-        if prof:
-            pending_blocks.append(
-                "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                + ", ".join(prof[:10])
-            )
-            should_block = True
+        # The thumbnail is set by the worker once it is approved
+        thumb_path = moderation_queue.quarantine(thumb_file)
 
-        if sus_urls:
-            pending_blocks.append(
-                "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                + ", ".join(sus_urls[:5])
-            )
-            should_block = True
+        poll = OpinionPoll(
+            question=question,
+            description=description,
+            author_id=current_user.id,
+            created_at=datetime.utcnow(),
+            expires_at=datetime.utcnow() + timedelta(days=3),
+            yes_count=0,
+            no_count=0,
+            score=0,
+            moderation_status="pending",
+        )
+        db.session.add(poll)
+        db.session.flush()
+        moderation_queue.enqueue("opinion_poll", poll.id, "opinion_poll", image_path=thumb_path)
+        db.session.commit()
+        moderation_queue.notify()
 
-        if not prof and not sus_urls:
-            pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-            should_block = True
+        flash("Peiling ontvangen, deze wordt zo snel mogelijk gecontroleerd.", "info")
+        return redirect(url_for("opinie"))
 
-    if should_block:
-        for msg in pending_blocks:
+    # Text content moderation via LLM guard
+    outcome = moderate([TextCheck(title=question, body=description, context="opinion_poll")])
+    if outcome.blocked:
+        for msg in outcome.messages:
             flash(msg, "danger")
         return redirect(url_for("opinie"))
 
@@ -1599,7 +1660,7 @@ def new_opinie():
             os.remove(path)
         except Exception:
             pass
-        flash("Upload tegengehouden: ongewenste afbeelding gedetecteerd.", "danger")
+        flash(upload_block_message(decision_img), "danger")
         return redirect(url_for("opinie"))
     thumb_filename = filename
 
@@ -1631,12 +1692,13 @@ def new_opinie():
 def vote_opinie(poll_id):
     """Vote yes/no on an opinion poll."""
 
-    # Get the poll and current user
+    # Get the poll
     poll = OpinionPoll.query.get_or_404(poll_id)
-    current_user = User.query.get(session["user_id"])
 
     # Use model property or datetime comparison for expiry
     if poll.is_expired:
+        if wants_json():
+            return {"error": "Deze peiling is gesloten; stemmen is niet meer mogelijk."}, 409
         flash("Deze peiling is gesloten; stemmen is niet meer mogelijk.", "warning")
         return redirect(url_for("opinie"))
 
@@ -1647,43 +1709,18 @@ def vote_opinie(poll_id):
     # Map to +1 / -1
     value = 1 if choice == "yes" else -1
 
-    # Check for existing vote
-    existing = OpinionVote.query.filter_by(
-        user_id=current_user.id,
-        poll_id=poll.id,
-    ).first()
-
-    if existing:
-        # Same vote again doesn't lead to change
-        if existing.value == value:
-            flash("Je hebt al zo gestemd op deze peiling.", "info")
-            return redirect(url_for("opinie"))
-
-        # Remove previous counts
-        if existing.value == 1:
-            poll.yes_count = max(0, (poll.yes_count or 0) - 1)
-        else:
-            poll.no_count = max(0, (poll.no_count or 0) - 1)
+    # Insert or change the vote and move the counters in SQL
+    totals = voting.vote_poll(session["user_id"], poll.id, value)
+    db.session.commit()
 
-        existing.value = value
-    else:
-        # New vote record
-        existing = OpinionVote(
-            user_id=current_user.id,
-            poll_id=poll.id,
-            value=value,
-        )
-        db.session.add(existing)
+    if wants_json():
+        return totals
 
-    # Update counters and score
-    if value == 1:
-        poll.yes_count = (poll.yes_count or 0) + 1
-    else:
-        poll.no_count = (poll.no_count or 0) + 1
-
-    poll.score = (poll.yes_count or 0) - (poll.no_count or 0)
+    # Same vote again doesn't lead to change
+    if not totals["changed"]:
+        flash("Je hebt al zo gestemd op deze peiling.", "info")
+        return redirect(url_for("opinie"))
 
-    db.session.commit()
     flash("Stem geregistreerd.", "success")
     return redirect(url_for("opinie"))
 
@@ -1696,7 +1733,7 @@ def update_poll_time(poll_id):
     """Update the remaining time of a poll (admin/superadmin only)."""
 
     poll = OpinionPoll.query.get_or_404(poll_id)
-    current_user = User.query.get(session["user_id"])
+    current_user = get_current_user()
 
     # Only admins and superadmins may change timing for any poll
     if not current_user or not (
@@ -1752,7 +1789,7 @@ def delete_opinie(poll_id):
 
     # Get the poll and current user
     poll = OpinionPoll.query.get_or_404(poll_id)
-    current_user = User.query.get(session["user_id"])
+    current_user = get_current_user()
 
     # Check permissions
     allowed = (
@@ -1779,7 +1816,7 @@ def poll_make_dialogue(poll_id):
 
     # Get the poll and current user
     poll = OpinionPoll.query.get_or_404(poll_id)
-    current = User.query.get(session["user_id"])
+    current = get_current_user()
 
     # Only the poll creator, admin or superadmin can convert
     if poll.dialogue_thread_id:
@@ -1853,36 +1890,10 @@ def contact():
                 message=message,
             )
 
-        pending_blocks = []
-        should_block = False
-
-        #  Text Content moderation via LLM guard
-        decision = guard_text(title=subject, body=message, context="contact_form")
-        if decision.get("action") == "block":
-            found = decision.get("found", {})
-            prof = found.get("profanity_terms", []) or []
-            sus_urls = found.get("suspicious_urls", []) or []
-
-            if prof:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
-                    + ", ".join(prof[:10])
-                )
-                should_block = True
-
-            if sus_urls:
-                pending_blocks.append(
-                    "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
-                    + ", ".join(sus_urls[:5])
-                )
-                should_block = True
-
-            if not prof and not sus_urls:
-                pending_blocks.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
-                should_block = True
-
-        if should_block:
-            for msg in pending_blocks:
+        # Text content moderation via LLM guard
+        outcome = moderate([TextCheck(title=subject, body=message, context="contact_form")])
+        if outcome.blocked:
+            for msg in outcome.messages:
                 flash(msg, "danger")
             return render_template(
                 "contact.html",
@@ -1898,10 +1909,69 @@ def contact():
     return render_template("contact.html")
 
 
+# MAINTENANCE COMMANDS
+#--------------------------------------------------------------------------------------------------------------
+@app.cli.command("reconcile-counts")
+def reconcile_counts_command():
+    """Recompute the comment counters of all dialogue threads (flask reconcile-counts)"""
+
+    fixed = reconcile_comment_counts()
+    click.echo(f"{fixed} dialoog-tellers gecorrigeerd.")
+
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    """EXPLAIN the hot queries and fail when one of them can't use an index (flask check-indexes)"""
+
+    failed = 0
+    for name, problems, plan in index_check.check():
+        if problems:
+            failed += 1
+            click.echo(f"FOUT {name}: {', '.join(problems)}")
+            for line in plan:
+                click.echo(f"     {line}")
+        else:
+            click.echo(f"ok   {name}")
+
+    if failed:
+        raise SystemExit(1)
+
+
+@app.cli.command("rebuild-vote-counters")
+def rebuild_vote_counters_command():
+    """Recompute thread, comment and poll vote counters from the vote tables (flask rebuild-vote-counters)"""
+
+    fixed = vote_buffer.rebuild_counters()
+    click.echo(f"{fixed} stemtellers gecorrigeerd.")
+
+
+@app.cli.command("rebuild-search")
+def rebuild_search_command():
+    """Rebuild the full-text search index from the content tables (flask rebuild-search)"""
+
+    if not search_index.enabled():
+        click.echo("Deze database ondersteunt geen full-text zoeken; er wordt met ILIKE gezocht.")
+        return
+    with db.engine.begin() as conn:
+        count = search_index.rebuild(conn)
+    click.echo(f"Zoekindex opnieuw opgebouwd: {count} documenten.")
+
+
+@app.cli.command("refresh-hot-ranks")
+def refresh_hot_ranks_command():
+    """Recompute the hot rank of the recent dialogues (flask refresh-hot-ranks)"""
+
+    with db.engine.begin() as conn:
+        count = hot_rank.refresh(conn)
+    click.echo(f"Hot-score bijgewerkt voor {count} dialogen.")
+
+
 # Create database tables and default roles if they don't exist
 # ----------------------------------------------------------
 with app.app_context():
     db.create_all()
+    migrations.upgrade(db)
+    search_index.init(db.engine)
 
     # Roles that can be assigned
     default_roles = ["user", "author", "admin", "superadmin"]
@@ -1910,3 +1980,19 @@ with app.app_context():
         if not Role.query.filter_by(name=r).first():
             db.session.add(Role(name=r))
     db.session.commit()
+
+
+# Start background moderation workers
+if app.config["ASYNC_MODERATION"]:
+    moderation_queue.start_workers(app, app.config["MODERATION_WORKERS"])
+
+# Start the vote counter write-behind
+if app.config["VOTE_BUFFER"]:
+    vote_buffer.start(app)
+
+# Start the decay of the dialogue hot ranks
+if app.config["HOT_RANK_REFRESH"]:
+    hot_rank.start(app)
+
+# Periodic moderation summary in the log (GUARD_METRICS_LOG_INTERVAL seconds, 0 = off)
+guard_metrics.start_log_summary()
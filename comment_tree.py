@@ -0,0 +1,499 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import bindparam, event, func, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, DialogueComment
+from pagination import encode_cursor, paginate
+
+
+# Materialized path: the ids of all ancestors and of the comment itself, each
+# as PATH_WIDTH base-36 characters. Sorting on path gives the thread in
+# reply order (depth first, siblings oldest first) and a subtree is one range
+# scan on (thread_id, path). 6 characters cover ids up to 2.1 billion; on
+# PostgreSQL the btree limit keeps paths indexable up to ~400 levels deep.
+#
+# Paths are compared byte-wise: SQLite's default BINARY collation, and the
+# column is declared COLLATE "C" on PostgreSQL (models.DialogueComment.path),
+# where locale collations would sort PATH_END and the digits differently.
+PATH_WIDTH = 6
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# Sorts after every path character (byte-wise), so [path, path + PATH_END) is the subtree
+PATH_END = "~"
+
+# Sibling order on the page: best first, then oldest first (unique thanks to the id)
+RANKED = [(DialogueComment.score, True), (DialogueComment.created_at, False), (DialogueComment.id, False)]
+
+
+def segment(comment_id: int) -> str:
+    """Fixed-width base-36 id, e.g. 1234 -> '0000ya'."""
+    chars = []
+    while comment_id:
+        comment_id, rest = divmod(comment_id, 36)
+        chars.append(DIGITS[rest])
+    return "".join(reversed(chars)).rjust(PATH_WIDTH, "0")
+
+
+def _in_subtree(path, include_root=True):
+    # A range instead of LIKE 'path%': SQLite only uses an index for LIKE with case_sensitive_like
+    column = DialogueComment.path
+    lower = column >= path if include_root else column > path
+    return lower & (column < path + PATH_END)
+
+
+def thread_comments(thread_id, max_depth=None, ranked=False):
+    """All comments of a thread, optionally only the first levels (depth 0 = top level).
+
+    In path order, or with ``ranked`` by score (desc) and then oldest first,
+    which is the sibling order render_list() expects.
+    """
+
+    query = DialogueComment.query.filter(DialogueComment.thread_id == thread_id)
+    if max_depth is not None:
+        query = query.filter(DialogueComment.depth <= max_depth)
+    if ranked:
+        return query.order_by(DialogueComment.score.desc(), DialogueComment.created_at.asc())
+    return query.order_by(DialogueComment.path)
+
+
+def rank_key(comment):
+    return (comment.score, comment.created_at, comment.id)
+
+
+def _ranked_order():
+    return [expr.desc() if desc else expr.asc() for expr, desc in RANKED]
+
+
+def _best_replies(thread_id, visible, parent_ids, limit):
+    # The best ``limit`` replies per parent, with the number of visible replies of that parent
+    ranked = (
+        select(
+            DialogueComment.id,
+            func.row_number().over(partition_by=DialogueComment.parent_id, order_by=_ranked_order()).label("position"),
+            func.count().over(partition_by=DialogueComment.parent_id).label("total"),
+        )
+        .where(DialogueComment.thread_id == thread_id, DialogueComment.parent_id.in_(parent_ids), visible)
+        .subquery()
+    )
+    return (
+        DialogueComment.query
+        .options(joinedload(DialogueComment.author))
+        .join(ranked, ranked.c.id == DialogueComment.id)
+        .filter(ranked.c.position <= limit)
+        .add_columns(ranked.c.total)
+        .order_by(*_ranked_order())
+        .all()
+    )
+
+
+def _reply_counts(thread_id, visible, parent_ids):
+    return (
+        db.session.query(DialogueComment.parent_id, func.count(DialogueComment.id))
+        .filter(DialogueComment.thread_id == thread_id, DialogueComment.parent_id.in_(parent_ids), visible)
+        .group_by(DialogueComment.parent_id)
+        .all()
+    )
+
+
+def load_page(thread_id, visible, parent_id=None, after=None, per_page=20, depth=2, replies_shown=3):
+    """Progressive loading: one page of the comments right below ``parent_id`` (None: top level),
+    plus the best ``replies_shown`` replies of each comment for ``depth`` levels below them.
+
+    ``visible`` is the visible_to() filter. At most per_page * (1 + r + ... + r^depth) comments
+    are loaded in depth + 2 queries, whatever the size of the thread.
+    Returns (comments, more, page): the comments for render_list(), per comment id the
+    (count, cursor) of its replies that were left out, and the KeysetPage of the level itself.
+    """
+
+    level = (
+        DialogueComment.query
+        .options(joinedload(DialogueComment.author))
+        .filter(DialogueComment.thread_id == thread_id, DialogueComment.parent_id == parent_id, visible)
+    )
+    page = paginate(level, order=RANKED, key=rank_key, after=after, per_page=per_page)
+
+    comments, more = list(page.items), {}
+    parents = [c.id for c in page.items]
+    for _ in range(depth):
+        if not parents:
+            break
+        shown, totals = {}, {}
+        for reply, total in _best_replies(thread_id, visible, parents, replies_shown):
+            shown.setdefault(reply.parent_id, []).append(reply)
+            totals[reply.parent_id] = total
+            comments.append(reply)
+        for parent, replies in shown.items():
+            if totals[parent] > len(replies):
+                more[parent] = (totals[parent] - len(replies), encode_cursor(rank_key(replies[-1])))
+        parents = [reply.id for replies in shown.values() for reply in replies]
+
+    # Below the last level only count, for the "show replies" links
+    if parents:
+        for parent, count in _reply_counts(thread_id, visible, parents):
+            more[parent] = (count, None)
+    return comments, more, page
+
+
+@dataclass
+class CommentRow:
+    depth: int
+    comment: Optional[DialogueComment]  # None for a "more replies" row
+    author: object
+    has_replies: bool = False
+    closes: int = 0  # reply levels that end right after this row
+    more_of: Optional[int] = None  # "more replies" row: the comment whose replies were left out
+    more_count: Optional[int] = None
+    more_cursor: Optional[str] = None
+
+
+def render_list(comments, more=None):
+    """Flatten ranked comments into CommentRows in reading order, in one pass.
+
+    Siblings keep the order of ``comments``. Replies to a comment that is not
+    in the list (hidden for this user) are shown at the top level. ``more``
+    (from load_page) adds a "more replies" row after the replies of a comment.
+    """
+
+    more = more or {}
+
+    ids = {c.id for c in comments}
+    roots, replies = [], {}
+    for c in comments:
+        if c.parent_id in ids:
+            replies.setdefault(c.parent_id, []).append(c)
+        else:
+            roots.append(c)
+
+    # Depth first without recursion, reply chains can be thousands deep
+    rows = []
+    stack = [(c, 0) for c in reversed(roots)]
+    while stack:
+        c, depth = stack.pop()
+        if rows and depth <= rows[-1].depth:
+            rows[-1].closes = rows[-1].depth - depth
+        if isinstance(c, CommentRow):
+            rows.append(c)
+            continue
+
+        below = replies.get(c.id, ())
+        rows.append(CommentRow(depth, c, c.author, bool(below) or c.id in more))
+        if c.id in more:
+            count, cursor = more[c.id]
+            stack.append((CommentRow(depth + 1, None, None, more_of=c.id, more_count=count, more_cursor=cursor), depth + 1))
+        stack.extend((r, depth + 1) for r in reversed(below))
+    if rows:
+        rows[-1].closes = rows[-1].depth
+    return rows
+
+
+def detach_replies(comment):
+    """Before deleting ``comment``: its replies become top-level (parent_id is set to NULL
+    by the ORM), so strip its path from theirs. Call before the delete is flushed."""
+
+    cut = len(comment.path)
+    db.session.execute(
+        update(DialogueComment)
+        .where(DialogueComment.thread_id == comment.thread_id, _in_subtree(comment.path, include_root=False))
+        .values(
+            path=func.substr(DialogueComment.path, cut + 1),
+            depth=DialogueComment.depth - (comment.depth + 1),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+# New comments get their path right after the INSERT (the id is needed for it)
+@event.listens_for(DialogueComment, "after_insert")
+def _comment_path(mapper, connection, comment):
+    table = DialogueComment.__table__
+    parent_path, depth = "", 0
+
+    if comment.parent_id is not None:
+        parent = connection.execute(
+            select(table.c.path, table.c.depth).where(table.c.id == comment.parent_id)
+        ).first()
+        if parent is not None and parent.path:
+            parent_path, depth = parent.path, parent.depth + 1
+
+    path = parent_path + segment(comment.id)
+    connection.execute(update(table).where(table.c.id == comment.id).values(path=path, depth=depth))
+    set_committed_value(comment, "path", path)
+    set_committed_value(comment, "depth", depth)
+
+
+def rebuild_paths(conn):
+    """(Re)compute path and depth of every comment from parent_id. Returns the number of comments."""
+
+    table = DialogueComment.__table__
+    rows = conn.execute(select(table.c.id, table.c.parent_id)).all()
+    parents = {r.id: r.parent_id for r in rows}
+    paths, depths = {}, {}
+
+    def resolve(comment_id):
+        # Walk up iteratively, deep reply chains would overflow recursion
+        chain = []
+        while comment_id is not None and comment_id not in paths:
+            chain.append(comment_id)
+            comment_id = parents.get(comment_id)
+            if comment_id in chain:
+                comment_id = None  # broken data: a loop, treat as top level
+        prefix = paths.get(comment_id, "") if comment_id is not None else ""
+        depth = depths.get(comment_id, -1) if comment_id is not None else -1
+        for cid in reversed(chain):
+            prefix, depth = prefix + segment(cid), depth + 1
+            paths[cid], depths[cid] = prefix, depth
+
+    for r in rows:
+        resolve(r.id)
+
+    if rows:
+        conn.execute(
+            update(table).where(table.c.id == bindparam("cid")).values(path=bindparam("p"), depth=bindparam("d")),
+            [{"cid": cid, "p": paths[cid], "d": depths[cid]} for cid in paths],
+        )
+    return len(rows)
+
+
+def _benchmark(comments=10_000, chain=2_000, repeat=5):
+    """Loading a 10k comment thread and a deep reply chain: lazy children against path queries."""
+    import sys
+    import random
+    import tempfile
+    import time
+    from flask import Flask
+    from models import User, DialogueThread
+
+    random.seed(1)
+    workdir = tempfile.mkdtemp(prefix="treebench")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{workdir}/bench.db"
+    db.init_app(app)
+
+    queries = [0]
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _count(*args):
+        queries[0] += 1
+
+    def timed(label, fn):
+        best = None
+        for _ in range(repeat):
+            db.session.expunge_all()
+            queries[0] = 0
+            started = time.perf_counter()
+            rows = fn()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"  {label:<36} {best * 1000:>9.1f} ms {queries[0]:>7} queries {rows:>7} rows")
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, username="bench", hash="x"))
+        wide = DialogueThread(title="Breed", author_id=1)
+        deep = DialogueThread(title="Diep", author_id=1)
+        db.session.add_all([wide, deep])
+        db.session.commit()
+
+        started = time.perf_counter()
+        ids = []
+        for i in range(comments):
+            # A third top level, the rest replies to a random earlier comment
+            parent = random.choice(ids) if ids and random.random() > 0.33 else None
+            c = DialogueComment(body=f"Reactie {i}", thread_id=wide.id, author_id=1, parent_id=parent)
+            db.session.add(c)
+            db.session.flush()
+            ids.append(c.id)
+        parent = None
+        for i in range(chain):
+            c = DialogueComment(body=f"Antwoord {i}", thread_id=deep.id, author_id=1, parent_id=parent)
+            db.session.add(c)
+            db.session.flush()
+            parent = c.id
+        db.session.commit()
+        print(f"inserted {comments + chain} comments in {time.perf_counter() - started:.1f}s (path kept on insert)")
+
+        def lazy_tree(thread_id):
+            # The old way: every comment, then c.children per comment
+            def visit(c):
+                return 1 + sum(visit(child) for child in c.children)
+            roots = DialogueComment.query.filter_by(thread_id=thread_id, parent_id=None).all()
+            return sum(visit(c) for c in roots)
+
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), chain * 4))
+
+        for label, thread_id in ((f"{comments} comments", wide.id), (f"reply chain of {chain}", deep.id)):
+            print(label)
+            timed("lazy c.children", lambda: lazy_tree(thread_id))
+            timed("whole thread, one query", lambda: len(thread_comments(thread_id).all()))
+            timed("first 3 levels", lambda: len(thread_comments(thread_id, max_depth=2).all()))
+
+
+def _bulk_comments(thread_id, size, next_id):
+    """Benchmark data: ``size`` comments, a third top level, the rest replies to a random earlier one."""
+    import random
+    from datetime import datetime, timedelta
+
+    rows, ids, start = [], [], datetime(2024, 1, 1)
+    for i in range(size):
+        parent = random.choice(ids) if ids and random.random() > 0.33 else None
+        rows.append({
+            "id": next_id, "thread_id": thread_id, "author_id": 1, "parent_id": parent,
+            "body": f"<p>Reactie {i}</p>", "score": random.randint(-3, 20),
+            "created_at": start + timedelta(seconds=i),
+        })
+        ids.append(next_id)
+        next_id += 1
+    db.session.execute(DialogueComment.__table__.insert(), rows)
+    rebuild_paths(db.session.connection())
+    db.session.commit()
+    return next_id
+
+
+def _benchmark_render(sizes=(1_000, 10_000, 50_000), repeat=3):
+    """Rendering a thread: recursive macro with lazy, sorted children against render_list()."""
+    import re
+    import random
+    import tempfile
+    import time
+    from flask import Flask, render_template_string
+    from models import User, DialogueThread
+
+    # The comment markup of dialoog_thread.html, without the forms
+    box = """<div class="comment-box" id="comment-{{ c.id }}"><div class="comment-score">{{ c.score }}</div>
+<div class="comment-body-card"><div class="comment-meta">{{ a.full_name or a.username }} · {{ c.created_at }}</div>
+<div>{{ c.body | safe }}</div>"""
+    recursive = """{% macro render_comment(c) %}{% set a = c.author %}""" + box + """
+{% if c.children %}<div class="comment-children">
+{% for child in c.children|sort(attribute='created_at')|sort(attribute='score', reverse=True) %}
+{% if child.id in visible_comment_ids %}{{ render_comment(child) }}{% endif %}{% endfor %}</div>{% endif %}
+</div></div>{% endmacro %}{% for c in root_comments %}{{ render_comment(c) }}{% endfor %}"""
+    flat = """{% for row in comment_rows %}{% set c = row.comment %}{% set a = row.author %}""" + box + """
+{% if row.has_replies %}<div class="comment-children">{% else %}</div></div>{% endif %}
+{% for _ in range(row.closes) %}</div></div></div>{% endfor %}{% endfor %}"""
+
+    random.seed(1)
+    workdir = tempfile.mkdtemp(prefix="renderbench")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{workdir}/bench.db"
+    db.init_app(app)
+
+    queries = [0]
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _count(*args):
+        queries[0] += 1
+
+    with app.app_context(), app.test_request_context():
+        db.create_all()
+        db.session.add(User(id=1, username="bench", hash="x"))
+        db.session.commit()
+
+        next_id = 1
+        for size in sizes:
+            thread = DialogueThread(title=f"{size} reacties", author_id=1)
+            db.session.add(thread)
+            db.session.commit()
+            thread_id = thread.id
+
+            next_id = _bulk_comments(thread_id, size, next_id)
+
+            def old():
+                comments = (
+                    DialogueComment.query.options(joinedload(DialogueComment.author))
+                    .filter_by(thread_id=thread_id)
+                    .order_by(DialogueComment.score.desc(), DialogueComment.created_at.asc()).all()
+                )
+                ids = {c.id for c in comments}
+                roots = [c for c in comments if c.parent_id not in ids]
+                return render_template_string(recursive, root_comments=roots, visible_comment_ids=ids)
+
+            def new():
+                comments = thread_comments(thread_id, ranked=True).options(joinedload(DialogueComment.author)).all()
+                return render_template_string(flat, comment_rows=render_list(comments))
+
+            print(f"{size} comments")
+            html = {}
+            for label, fn in (("recursive macro, lazy children", old), ("render_list + loop", new)):
+                best = None
+                for _ in range(repeat):
+                    db.session.expunge_all()
+                    queries[0] = 0
+                    started = time.perf_counter()
+                    html[label] = re.sub(r"\s+", "", fn())
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                print(f"  {label:<32} {best * 1000:>9.1f} ms {queries[0]:>7} queries")
+            assert len(set(html.values())) == 1, "the renderings differ"
+
+
+def _benchmark_first_paint(size=20_000, per_page=20, depth=2, replies_shown=3, budget_ms=100, repeat=5):
+    """First paint of a big thread: every comment against load_page() (progressive loading)."""
+    import random
+    import tempfile
+    import time
+    from flask import Flask, render_template_string
+    from models import User, DialogueThread
+
+    template = """{% for row in comment_rows %}{% if row.comment is none %}
+<div class="comment-more"><a href="/dialoog/comment/{{ row.more_of }}/replies">{{ row.more_count }}</a></div>
+{% else %}{% set c = row.comment %}<div class="comment-box" id="comment-{{ c.id }}">
+<div class="comment-score">{{ c.score }}</div><div class="comment-body-card">
+<div class="comment-meta">{{ row.author.full_name or row.author.username }} · {{ c.created_at }}</div>
+<div>{{ c.body | safe }}</div>{% if row.has_replies %}<div class="comment-children">{% else %}</div></div>{% endif %}
+{% endif %}{% for _ in range(row.closes) %}</div></div></div>{% endfor %}{% endfor %}"""
+
+    random.seed(1)
+    workdir = tempfile.mkdtemp(prefix="paintbench")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{workdir}/bench.db"
+    db.init_app(app)
+
+    queries = [0]
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _count(*args):
+        queries[0] += 1
+
+    with app.app_context(), app.test_request_context():
+        db.create_all()
+        db.session.add(User(id=1, username="bench", hash="x"))
+        thread = DialogueThread(title=f"{size} reacties", author_id=1)
+        db.session.add(thread)
+        db.session.commit()
+        thread_id = thread.id
+        _bulk_comments(thread_id, size, 1)
+        visible = DialogueComment.moderation_status == "approved"
+
+        def everything():
+            comments = thread_comments(thread_id, ranked=True).options(joinedload(DialogueComment.author)).all()
+            return render_template_string(template, comment_rows=render_list(comments)), len(comments)
+
+        def first_page():
+            comments, more, page = load_page(thread_id, visible, per_page=per_page, depth=depth, replies_shown=replies_shown)
+            return render_template_string(template, comment_rows=render_list(comments, more)), len(comments)
+
+        bound = per_page * sum(replies_shown ** level for level in range(depth + 1))
+        print(f"{size} comments, first page: {per_page} top level, {replies_shown} replies for {depth} levels (<= {bound})")
+        for label, fn in (("whole thread", everything), ("first page (load_page)", first_page)):
+            best = None
+            for _ in range(repeat):
+                db.session.expunge_all()
+                queries[0] = 0
+                started = time.perf_counter()
+                html, rows = fn()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"  {label:<24} {best * 1000:>8.1f} ms {queries[0]:>3} queries {rows:>6} comments {len(html) // 1024:>6} KB")
+
+        assert rows <= bound
+        print(f"  first page {'within' if best * 1000 <= budget_ms else 'OVER'} the {budget_ms} ms budget")
+
+
+if __name__ == "__main__":
+    _benchmark()
+    _benchmark_render()
+    _benchmark_first_paint()
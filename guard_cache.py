@@ -0,0 +1,439 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it only exact image matches are cached
+    Image = None
+
+
+# Default location of the persistent verdict cache (next to this module)
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "guard_cache.sqlite3")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def make_key(*parts) -> str:
+    """Build a stable sha256 cache key from json-serializable parts."""
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """sha256 of a file's bytes, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def perceptual_hashes(path: str):
+    """Return (aHash, dHash) as 64-bit ints, or None if the file can't be decoded.
+
+    Both hashes survive resizing and re-encoding, so near-identical copies of an
+    image end up within a small Hamming distance of each other.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as img:
+            gray = img.convert("L")
+            small = list(gray.resize((8, 8), Image.LANCZOS).getdata())
+            wide = list(gray.resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+
+    # aHash: pixel brighter than the mean
+    mean = sum(small) / len(small)
+    ahash = 0
+    for px in small:
+        ahash = (ahash << 1) | (px > mean)
+
+    # dHash: pixel brighter than its right neighbour
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            left = wide[row * 9 + col]
+            right = wide[row * 9 + col + 1]
+            dhash = (dhash << 1) | (left > right)
+
+    return ahash, dhash
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class LRUCache:
+    """Small thread-safe in-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStore:
+    """Persistent key/value table in a local SQLite file with TTL and size-bounded eviction.
+
+    Entries older than ``ttl`` seconds are ignored on read and removed during eviction.
+    When the table grows past ``max_entries`` the least recently used rows are deleted.
+    Reads don't write: the last_used times of hits are collected and written in one
+    statement every TOUCH_EVERY hits and before eviction.
+    """
+
+    # Run eviction once every this many writes
+    EVICT_EVERY = 100
+
+    # Write the collected last_used times once every this many hits
+    TOUCH_EVERY = 100
+
+    def __init__(self, path: str, table: str, ttl: int, max_entries: int, extra_columns: str = ""):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._hits = 0
+        self._touched = {}
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL"
+            f"{extra_columns})"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_last_used ON {table} (last_used)")
+        self._conn.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._touched[key] = now
+            self._hits += 1
+            if self._hits % self.TOUCH_EVERY == 0:
+                self._flush_touched_locked()
+        return json.loads(row[0])
+
+    def _flush_touched_locked(self):
+        if self._touched:
+            self._conn.executemany(
+                f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._conn.commit()
+            self._touched.clear()
+
+    def set(self, key: str, value, **extra):
+        now = time.time()
+        columns = ["key", "value", "created_at", "last_used"] + list(extra)
+        params = [key, json.dumps(value, ensure_ascii=False), now, now] + list(extra.values())
+        placeholders = ", ".join("?" for _ in columns)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} ({', '.join(columns)}) VALUES ({placeholders})",
+                params,
+            )
+            self._conn.commit()
+            self._touched.pop(key, None)
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict_locked()
+
+    def add_column(self, name: str, decl: str):
+        """Add a column that cache files from an older version don't have yet."""
+        with self._lock:
+            columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({self.table})")]
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE {self.table} ADD COLUMN {name} {decl}")
+                self._conn.commit()
+
+    def execute(self, sql: str, params=()):
+        """Run a read query against the store (used for secondary lookups)."""
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def evict(self):
+        with self._lock:
+            self._evict_locked()
+
+    def _evict_locked(self):
+        self._flush_touched_locked()
+        if self.ttl:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl,)
+            )
+        if self.max_entries:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f" SELECT key FROM {self.table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+            self._touched.clear()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class VerdictCache:
+    """Two-tier verdict cache: in-process LRU in front of a persistent SQLite table."""
+
+    def __init__(self, table: str, memory_size: int, ttl: int, max_entries: int, path: str = None,
+                 extra_columns: str = ""):
+        self.memory = LRUCache(maxsize=memory_size, ttl=ttl)
+        self.store = None
+        if path:
+            try:
+                self.store = SQLiteStore(
+                    path, table, ttl=ttl, max_entries=max_entries, extra_columns=extra_columns
+                )
+            except sqlite3.Error:
+                # Fall back to memory only if the cache file can't be opened
+                self.store = None
+
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return json.loads(value)
+
+        if self.store is not None:
+            try:
+                stored = self.store.get(key)
+            except sqlite3.Error:
+                stored = None
+            if stored is not None:
+                self.memory.set(key, json.dumps(stored))
+                self._count("disk_hits")
+                return stored
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value: dict, **extra):
+        # Values are kept as json so callers always receive a fresh copy
+        self.memory.set(key, json.dumps(value))
+        if self.store is not None:
+            try:
+                self.store.set(key, value, **extra)
+            except sqlite3.Error:
+                pass
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (hits / lookups) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+    def clear(self):
+        self.memory.clear()
+        if self.store is not None:
+            self.store.clear()
+
+
+# Set GUARD_CACHE_ENABLED=0 to bypass all verdict caching
+CACHE_ENABLED = os.getenv("GUARD_CACHE_ENABLED", "1") != "0"
+
+
+class ImageVerdictCache(VerdictCache):
+    """Image verdicts keyed on the sha256 of the bytes, plus a perceptual-hash
+    index of blocked images so resized or re-encoded copies are caught too.
+
+    The sha256 key already contains the prompt version; the hash index stores
+    it with each entry, so verdicts of an older prompt are never matched.
+    """
+
+    def __init__(self, table: str, memory_size: int, ttl: int, max_entries: int, path: str = None,
+                 max_distance: int = 6):
+        super().__init__(
+            table, memory_size, ttl, max_entries, path,
+            extra_columns=", ahash TEXT, dhash TEXT, blocked INTEGER NOT NULL DEFAULT 0, prompt_version TEXT",
+        )
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.similar_hits = 0
+
+        # Cache files from before the prompt_version column: their rows have no
+        # version and are left out of the index
+        if self.store is not None:
+            try:
+                self.store.add_column("prompt_version", "TEXT")
+            except sqlite3.Error:
+                self.store = None
+
+        # key -> (stored_at, ahash, dhash, verdict json), newest last, for _blocked_version only
+        self._blocked = OrderedDict()
+        self._blocked_version = None
+        self._index_lock = threading.Lock()
+
+    def _load_blocked(self, prompt_version: str):
+        if self._blocked_version == prompt_version:
+            return
+        # The prompt changed (or first use): start over with that version's blocks
+        self._blocked.clear()
+        self._blocked_version = prompt_version
+        if self.store is None:
+            return
+        try:
+            rows = self.store.execute(
+                f"SELECT key, created_at, ahash, dhash, value FROM {self.store.table}"
+                " WHERE blocked = 1 AND ahash IS NOT NULL AND prompt_version = ?"
+                " ORDER BY created_at DESC LIMIT ?",
+                (prompt_version, self.max_entries),
+            )
+        except sqlite3.Error:
+            return
+        for key, created_at, ahash, dhash, value in reversed(rows):
+            self._blocked[key] = (created_at, int(ahash, 16), int(dhash, 16), value)
+
+    def find_similar(self, hashes, prompt_version: str):
+        """Return the verdict of an image blocked under ``prompt_version`` within
+        ``max_distance`` bits, if any."""
+        if not hashes:
+            return None
+        ahash, dhash = hashes
+        now = time.time()
+        with self._index_lock:
+            self._load_blocked(prompt_version)
+            for stored_at, a, d, value in reversed(self._blocked.values()):
+                if self.ttl and now - stored_at > self.ttl:
+                    continue
+                if hamming(a, ahash) <= self.max_distance and hamming(d, dhash) <= self.max_distance:
+                    self._count("similar_hits")
+                    return json.loads(value)
+        return None
+
+    def set(self, key: str, value: dict, hashes=None, prompt_version: str = None):
+        blocked = value.get("action") == "block"
+        extra = {"blocked": int(blocked), "prompt_version": prompt_version}
+        if hashes:
+            extra["ahash"] = format(hashes[0], "016x")
+            extra["dhash"] = format(hashes[1], "016x")
+        super().set(key, value, **extra)
+
+        if blocked and hashes and prompt_version is not None:
+            with self._index_lock:
+                self._load_blocked(prompt_version)
+                self._blocked[key] = (time.time(), hashes[0], hashes[1], json.dumps(value))
+                self._blocked.move_to_end(key)
+                while len(self._blocked) > self.max_entries:
+                    self._blocked.popitem(last=False)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits + self.similar_hits
+        stats["similar_hits"] = self.similar_hits
+        stats["hit_rate"] = (hits / lookups) if lookups else 0.0
+        stats["blocked_index_entries"] = len(self._blocked)
+        return stats
+
+    def clear(self):
+        super().clear()
+        with self._index_lock:
+            self._blocked.clear()
+            self._blocked_version = None
+
+
+def cache_path() -> str:
+    """Return the configured cache file, or None when the persistent tier is disabled."""
+    if not CACHE_ENABLED:
+        return None
+    return os.getenv("GUARD_CACHE_PATH", DEFAULT_CACHE_PATH) or None
+
+
+# Text verdicts, keyed on prompt version + context + normalized title/body
+text_cache = VerdictCache(
+    table="text_verdicts",
+    memory_size=_env_int("GUARD_CACHE_MEMORY_SIZE", 1024),
+    ttl=_env_int("GUARD_CACHE_TTL", 7 * 24 * 3600),
+    max_entries=_env_int("GUARD_CACHE_MAX_ENTRIES", 50000),
+    path=cache_path(),
+)
+
+# Image verdicts, keyed on prompt version + sha256 of the file
+image_cache = ImageVerdictCache(
+    table="image_verdicts",
+    memory_size=_env_int("GUARD_CACHE_MEMORY_SIZE", 1024),
+    ttl=_env_int("GUARD_CACHE_TTL", 7 * 24 * 3600),
+    max_entries=_env_int("GUARD_IMAGE_CACHE_MAX_ENTRIES", 20000),
+    path=cache_path(),
+    max_distance=_env_int("GUARD_IMAGE_HASH_DISTANCE", 6),
+)
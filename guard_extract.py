@@ -0,0 +1,244 @@
+import os
+import re
+from html.parser import HTMLParser
+
+try:
+    import tiktoken
+except ImportError:  # only used by the benchmark; falls back to a chars/4 estimate
+    tiktoken = None
+
+
+# Longest piece of body text sent to the LLM in one call
+CHUNK_CHARS = int(os.getenv("GUARD_CHUNK_CHARS", "6000"))
+
+# Characters repeated at the start of the next chunk, so nothing is lost at a cut
+CHUNK_OVERLAP = int(os.getenv("GUARD_CHUNK_OVERLAP", "200"))
+
+# Upper bound on chunks per text; anything longer is sent to review
+MAX_CHUNKS = int(os.getenv("GUARD_MAX_CHUNKS", "16"))
+
+# Tags whose text is never shown to readers
+SKIP_TAGS = {"script", "style", "noscript", "template"}
+
+# Content that runs in the reader's browser instead of being read: script and
+# style bodies and event handler attributes. The stored HTML is rendered as is,
+# so it is kept in the text (with ACTIVE_MARK) for the URL rules and the LLM,
+# and guard_text sends anything that contains it to review at least.
+ACTIVE_TAGS = {"script", "style"}
+ACTIVE_ATTRS = {"srcdoc"}
+ACTIVE_MARK = "[actief "
+# Style attributes with functions (url(), expression()) or escapes; plain
+# TinyMCE layout ("text-align: center") stays out of the text
+ACTIVE_STYLE_RE = re.compile(r"[(\\]|//|javascript:|@import", re.IGNORECASE)
+
+# Tags that start a new line of text
+BLOCK_TAGS = {
+    "p", "div", "br", "li", "ul", "ol", "tr", "td", "th", "table", "blockquote",
+    "pre", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "section", "article", "figure",
+    "figcaption",
+}
+
+# Attributes that hold a link we want the moderator to see
+URL_ATTRS = {"href", "src", "action", "formaction", "data", "poster", "cite"}
+
+BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+SPACES_RE = re.compile("[ \t\r\f\v\u00a0]+")
+
+# Good places to cut, best first
+BREAK_RES = [
+    re.compile(r"\n"),
+    re.compile(r"(?<=[.!?])\s"),
+    re.compile(r"\s"),
+]
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self, active=True):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.active = active
+        self.active_parts = []
+        self._skip = 0
+        self._active_tag = None
+        self._link = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in SKIP_TAGS:
+            self._skip += 1
+            if tag in ACTIVE_TAGS:
+                self._active_tag = tag
+        if tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+        if self.active:
+            for k, v in attrs.items():
+                v = (v or "").strip()
+                if not v:
+                    continue
+                if k.startswith("on") or k in ACTIVE_ATTRS or (k == "style" and ACTIVE_STYLE_RE.search(v)):
+                    self._add_active(k, v)
+
+        urls = [
+            v.strip() for k, v in attrs.items()
+            if k in URL_ATTRS and v and not v.strip().lower().startswith("data:")
+        ]
+
+        if tag == "a" and urls:
+            # Shown after the link text, unless the text is the URL itself
+            self._link = (urls[0], len(self.parts))
+            return
+        if tag == "img":
+            alt = (attrs.get("alt") or "").strip()
+            label = " ".join(p for p in [alt] + urls if p)
+            self.parts.append(f" [afbeelding: {label}] " if label else " [afbeelding] ")
+            return
+        if urls:
+            self.parts.append(f" [{tag}: {' '.join(urls)}] ")
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in SKIP_TAGS:
+            self._skip -= 1
+            self._active_tag = None
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self._skip:
+            self._skip -= 1
+            self._active_tag = None
+        if tag == "a" and self._link is not None:
+            url, start = self._link
+            self._link = None
+            text = "".join(self.parts[start:]).strip()
+            if url != text:
+                self.parts.append(f" ({url})")
+        if tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+        elif self.active and self._active_tag and data.strip():
+            self._add_active(self._active_tag, data.strip())
+
+    def _add_active(self, name, value):
+        self.active_parts.append(f"{name}: {value}")
+        self.parts.append(f" {ACTIVE_MARK}{name}: {value}] ")
+
+
+def extract(html: str, active: bool = True):
+    """(text, active parts) of TinyMCE HTML; see html_to_text. The active parts are
+    the script/style bodies and handler attributes as "<name>: <value>", in order."""
+    if not html:
+        return "", []
+    if "<" not in html and "&" not in html:
+        return html, []
+
+    parser = _TextExtractor(active=active)
+    parser.feed(html)
+    parser.close()
+
+    text = "".join(parser.parts)
+    text = SPACES_RE.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    text = BLANK_LINES_RE.sub("\n\n", text)
+    return text.strip(), parser.active_parts
+
+
+def html_to_text(html: str, active: bool = True) -> str:
+    """Readable text of TinyMCE HTML, with link and image URLs kept inline.
+
+    Script/style bodies and event handler attributes are kept as
+    "[actief <name>: ...]" unless ``active`` is False (e.g. for the search index).
+    """
+    return extract(html, active)[0]
+
+
+def chunk_text(text: str, max_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """Split text into pieces of at most max_chars, cut at line/sentence/word breaks."""
+    if len(text) <= max_chars:
+        return [text]
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + max_chars
+        if end >= len(text):
+            chunks.append(text[start:])
+            break
+
+        # Cut at the last good break in the second half of the window
+        window = text[start:end]
+        cut = len(window)
+        for pattern in BREAK_RES:
+            matches = [m.end() for m in pattern.finditer(window, len(window) // 2)]
+            if matches:
+                cut = matches[-1]
+                break
+
+        chunks.append(text[start:start + cut].strip())
+        start = max(start + cut - overlap, start + 1)
+
+    return [c for c in chunks if c]
+
+
+def count_tokens(text: str) -> int:
+    """Tokens for gpt-4o-mini when tiktoken is installed, otherwise an estimate."""
+    if tiktoken is not None:
+        return len(tiktoken.get_encoding("o200k_base").encode(text))
+    return (len(text) + 3) // 4
+
+
+def _sample_posts():
+    """Blog posts and threads from DATABASE_URL, or a generated TinyMCE-like post."""
+    url = os.getenv("DATABASE_URL")
+    if url:
+        from sqlalchemy import create_engine, text
+        engine = create_engine(url)
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT content FROM blog_posts")).fetchall()
+            rows += conn.execute(text("SELECT body FROM dialogue_threads")).fetchall()
+        posts = [r[0] for r in rows if r[0]]
+        if posts:
+            return posts
+
+    paragraph = (
+        '<p style="text-align: justify;"><span style="font-family: Arial, sans-serif; '
+        'font-size: 12pt;">De nieuwe <strong>controleverklaring</strong> vraagt meer '
+        'toelichting op <em>kernpunten</em> van de controle. Zie ook '
+        '<a href="https://www.nba.nl/" target="_blank" rel="noopener">de NBA</a>.</span></p>\n'
+    )
+    image = '<p><img src="/static/uploads/grafiek.png" alt="grafiek" width="600" height="400"></p>\n'
+    table = (
+        '<table style="border-collapse: collapse; width: 100%;" border="1"><tbody>'
+        + '<tr><td style="width: 50%;">Omzet</td><td style="width: 50%;">1.200</td></tr>' * 10
+        + "</tbody></table>\n"
+    )
+    return [
+        paragraph * 3,
+        paragraph * 10 + image + table,
+        (paragraph * 40 + image) * 3,
+    ]
+
+
+def _benchmark():
+    """Tokens per post before (raw HTML cut at 20,000 chars) and after (text, chunked)."""
+    total_before = total_after = 0
+    print(f"{'post':>4} {'html chars':>10} {'before':>8} {'after':>8} {'chunks':>6} {'unchecked':>10}")
+    for i, html in enumerate(_sample_posts()):
+        before = count_tokens(html[:20000])
+        text = html_to_text(html)
+        chunks = chunk_text(text)
+        after = sum(count_tokens(c) for c in chunks)
+        unchecked = max(0, len(html) - 20000)
+        total_before += before
+        total_after += after
+        print(f"{i:>4} {len(html):>10} {before:>8} {after:>8} {len(chunks):>6} {unchecked:>10}")
+
+    print(f"total tokens: {total_before} -> {total_after} "
+          f"({total_after / max(total_before, 1):.0%})"
+          + ("" if tiktoken else " (estimated as chars/4, install tiktoken for exact counts)"))
+
+
+if __name__ == "__main__":
+    _benchmark()
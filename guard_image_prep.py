@@ -0,0 +1,148 @@
+import io
+import os
+import base64
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are sent as-is
+    Image = None
+    ImageOps = None
+
+
+# Longest side of the image the LLM gets to see. 512 matches what the model
+# looks at in "low" detail mode anyway
+MAX_SIDE = int(os.getenv("GUARD_IMAGE_MAX_SIDE", "512"))
+
+# "low" costs a small fixed number of tokens per image, "auto"/"high" tile the image
+DETAIL = os.getenv("GUARD_IMAGE_DETAIL", "low")
+
+# "jpeg" or "webp"
+OUTPUT_FORMAT = os.getenv("GUARD_IMAGE_FORMAT", "jpeg").lower()
+QUALITY = int(os.getenv("GUARD_IMAGE_QUALITY", "75"))
+
+# Read/encode in multiples of 3 bytes so base64 chunks can be concatenated
+CHUNK_SIZE = 3 * 64 * 1024
+
+# Magic bytes -> mime type, used when the file can't be re-encoded
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def sniff_mime(head: bytes, path: str = "") -> str:
+    """Detect the image type from the first bytes, falling back to the extension."""
+    for magic, mime in SIGNATURES:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    if ext in ("jpg", "jpeg"):
+        return "image/jpeg"
+    if ext == "png":
+        return "image/png"
+    if ext == "webp":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def b64_stream(f) -> str:
+    """Base64-encode a file object chunk by chunk."""
+    parts = []
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+        parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+def shrink_image(path: str):
+    """Decode, downscale to MAX_SIDE, drop metadata and re-encode compactly.
+
+    Returns (mime, BytesIO) or None when Pillow is missing or the file isn't a
+    decodable image.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as img:
+            # Let the JPEG decoder downscale while decoding (much faster)
+            img.draft("RGB", (MAX_SIDE, MAX_SIDE))
+
+            # First frame of animations, rotated according to EXIF
+            img.seek(0)
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS, reducing_gap=2.0)
+
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1])
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+
+            out = io.BytesIO()
+            # No exif/icc is passed on, so all metadata is stripped
+            if OUTPUT_FORMAT == "webp":
+                img.save(out, format="WEBP", quality=QUALITY, method=4)
+                mime = "image/webp"
+            else:
+                img.save(out, format="JPEG", quality=QUALITY, optimize=True)
+                mime = "image/jpeg"
+    except Exception:
+        return None
+
+    out.seek(0)
+    return mime, out
+
+
+def file_to_data_url(path: str) -> str:
+    """Data URL of a (shrunk) image for the moderation request."""
+    shrunk = shrink_image(path)
+    if shrunk is not None:
+        mime, buf = shrunk
+        return f"data:{mime};base64,{b64_stream(buf)}"
+
+    with open(path, "rb") as f:
+        mime = sniff_mime(f.read(16), path)
+        f.seek(0)
+        return f"data:{mime};base64,{b64_stream(f)}"
+
+
+def _benchmark():
+    """Payload size and preparation time before/after on the bundled thumbnails."""
+    import timeit
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    folders = ["blog_thumbs", "opinion_thumbs"]
+
+    def original(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        return f"data:{sniff_mime(data[:16], path)};base64," + base64.b64encode(data).decode()
+
+    total_before = total_after = 0
+    print(f"{'file':<70} {'before':>10} {'after':>10} {'t before':>9} {'t after':>9}")
+    for folder in folders:
+        for name in sorted(os.listdir(os.path.join(root, folder))):
+            path = os.path.join(root, folder, name)
+            before = len(original(path))
+            after = len(file_to_data_url(path))
+            t_before = timeit.timeit(lambda: original(path), number=5) / 5
+            t_after = timeit.timeit(lambda: file_to_data_url(path), number=5) / 5
+            total_before += before
+            total_after += after
+            print(f"{folder + '/' + name:<70} {before:>10} {after:>10} "
+                  f"{t_before * 1000:>7.1f}ms {t_after * 1000:>7.1f}ms")
+
+    print(f"total payload: {total_before} -> {total_after} bytes "
+          f"({total_after / total_before:.0%})")
+    if Image is None:
+        print("Pillow is not installed: images are sent unchanged")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,201 @@
+import os
+import time
+import logging
+import threading
+from bisect import bisect_left
+
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets in milliseconds (the last bucket is open-ended)
+LATENCY_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+# Seconds between log summaries, 0 disables them
+LOG_INTERVAL = int(os.getenv("GUARD_METRICS_LOG_INTERVAL", "300"))
+
+# Where a verdict came from
+SOURCES = ("prefilter", "cache", "similar", "llm", "fallback")
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; percentiles are bucket upper bounds."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return float(self.bounds[i]) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 1) if self.count else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max, 1),
+            # [upper bound in ms, count] pairs, None = no upper bound
+            "buckets": [[b, n] for b, n in zip(self.bounds + [None], self.counts)],
+        }
+
+
+class ContextStats:
+    """Counters for one (kind, context) pair, e.g. ("text", "dialogue_comment")."""
+
+    def __init__(self):
+        self.calls = 0
+        self.sources = {s: 0 for s in SOURCES}
+        self.verdicts = {}
+        self.categories = {}
+        self.latency = Histogram()
+        self.llm_latency = Histogram()
+        self.llm_calls = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "calls": self.calls,
+            "sources": dict(self.sources),
+            "llm_fraction": round(self.sources["llm"] / self.calls, 3) if self.calls else 0.0,
+            "verdicts": dict(self.verdicts),
+            "categories": dict(self.categories),
+            "latency": self.latency.snapshot(),
+            "llm_latency": self.llm_latency.snapshot(),
+            "llm_calls": round(self.llm_calls, 2),
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+        }
+
+
+class GuardMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contexts = {}
+        self.started_at = time.time()
+
+    def _get(self, kind: str, context: str) -> ContextStats:
+        key = (kind, context)
+        stats = self._contexts.get(key)
+        if stats is None:
+            stats = self._contexts[key] = ContextStats()
+        return stats
+
+    def record(self, kind: str, context: str, source: str, decision: dict, elapsed: float):
+        """One guard_text/guard_image call: where the verdict came from, the verdict, the latency."""
+        ms = elapsed * 1000
+        with self._lock:
+            stats = self._get(kind, context)
+            stats.calls += 1
+            stats.sources[source] = stats.sources.get(source, 0) + 1
+            stats.latency.observe(ms)
+            if source == "llm":
+                stats.llm_latency.observe(ms)
+
+            action = decision.get("action", "unknown")
+            stats.verdicts[action] = stats.verdicts.get(action, 0) + 1
+            for name, flagged in (decision.get("categories") or {}).items():
+                if flagged:
+                    stats.categories[name] = stats.categories.get(name, 0) + 1
+
+    def record_usage(self, kind: str, context: str, usage, share: float = 1.0):
+        """Token usage of an LLM response. ``share`` splits a batched call over its items."""
+        if usage is None:
+            return
+        with self._lock:
+            stats = self._get(kind, context)
+            stats.llm_calls += share
+            stats.input_tokens += round((getattr(usage, "input_tokens", 0) or 0) * share)
+            stats.output_tokens += round((getattr(usage, "output_tokens", 0) or 0) * share)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            contexts = {
+                f"{kind}:{context}": stats.snapshot()
+                for (kind, context), stats in sorted(self._contexts.items())
+            }
+
+        totals = {"calls": 0, "input_tokens": 0, "output_tokens": 0}
+        for stats in contexts.values():
+            for key in totals:
+                totals[key] += stats[key]
+
+        return {
+            "since": self.started_at,
+            "uptime_s": round(time.time() - self.started_at),
+            "totals": totals,
+            "contexts": contexts,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._contexts.clear()
+            self.started_at = time.time()
+
+    def summary_lines(self):
+        """One log line per context, most expensive (in tokens) first."""
+        contexts = self.snapshot()["contexts"]
+        ranked = sorted(
+            contexts.items(),
+            key=lambda kv: kv[1]["input_tokens"] + kv[1]["output_tokens"],
+            reverse=True,
+        )
+        for name, s in ranked:
+            yield (
+                f"{name}: {s['calls']} calls, llm {s['sources']['llm']}, "
+                f"prefilter {s['sources']['prefilter']}, cache {s['sources']['cache'] + s['sources']['similar']}, "
+                f"fallback {s['sources']['fallback']}, tokens {s['input_tokens']}/{s['output_tokens']}, "
+                f"p50 {s['latency']['p50_ms']:.0f}ms p95 {s['latency']['p95_ms']:.0f}ms, "
+                f"verdicts {s['verdicts']}"
+            )
+
+
+metrics = GuardMetrics()
+
+_logger_thread = None
+
+
+def _log_loop(interval: int):
+    while True:
+        time.sleep(interval)
+        try:
+            lines = list(metrics.summary_lines())
+            if lines:
+                log.info("Moderation summary:\n  %s", "\n  ".join(lines))
+        except Exception:
+            log.exception("Moderation summary failed")
+
+
+def start_log_summary(interval: int = LOG_INTERVAL):
+    """Log a per-context summary every ``interval`` seconds (once per process)."""
+    global _logger_thread
+    if interval <= 0 or _logger_thread is not None:
+        return
+
+    # The app doesn't configure logging; make sure the summary isn't dropped
+    if not log.hasHandlers():
+        log.addHandler(logging.StreamHandler())
+    log.setLevel(logging.INFO)
+
+    _logger_thread = threading.Thread(
+        target=_log_loop, args=(interval,), name="guard-metrics-log", daemon=True
+    )
+    _logger_thread.start()
@@ -0,0 +1,334 @@
+"""Local stand-in for the part of the OpenAI Responses API that llm_guard uses.
+
+Run it on its own:
+
+    python guard_stub.py --port 8765
+    LLM_GUARD_BASE_URL=http://127.0.0.1:8765/v1 flask run
+
+or let llm_guard start it in-process with LLM_GUARD_MODE=stub.
+
+Settings (environment or command line):
+    GUARD_STUB_LATENCY      "const:MS", "uniform:MIN:MAX", "normal:MEAN:SD" or
+                            "lognormal:MEDIAN:SIGMA" (milliseconds), default "const:0"
+    GUARD_STUB_ERROR_RATE   fraction of requests that fail, default 0
+    GUARD_STUB_ERROR_CODES  status codes to fail with, default "500,503,429"
+    GUARD_STUB_BLOCK_WORDS  comma separated marker words that get "block", default "STUBBLOCK"
+    GUARD_STUB_REVIEW_WORDS marker words that get "review", default "STUBREVIEW"
+    GUARD_STUB_SCRIPT       JSON file with extra rules, checked in order:
+                            [{"contains": "casino", "action": "block",
+                              "categories": ["spam"], "reasons": ["..."]}]
+    GUARD_STUB_SEED         seed for latency and errors, for repeatable runs
+"""
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+CATEGORY_NAMES = [
+    "nsfw", "weapons", "alcohol", "drugs", "gore", "offensive_symbols",
+    "profanity", "spam", "spam_email", "malicious_url",
+]
+
+SEVERITY = {"allow": "low", "warn": "low", "review": "medium", "block": "high"}
+
+ITEM_RE = re.compile(r"^=== ITEM (\d+) ===$", re.MULTILINE)
+
+
+def parse_latency(spec: str):
+    """Latency spec -> function returning a delay in seconds."""
+    kind, _, args = (spec or "const:0").partition(":")
+    values = [float(v) for v in args.split(":") if v] or [0.0]
+
+    if kind == "uniform":
+        low, high = values[0], values[1] if len(values) > 1 else values[0]
+        return lambda rng: rng.uniform(low, high) / 1000
+    if kind == "normal":
+        mean, sd = values[0], values[1] if len(values) > 1 else 0.0
+        return lambda rng: max(0.0, rng.gauss(mean, sd)) / 1000
+    if kind == "lognormal":
+        median, sigma = values[0], values[1] if len(values) > 1 else 0.5
+        return lambda rng: median * rng.lognormvariate(0, sigma) / 1000
+    return lambda rng: values[0] / 1000
+
+
+class StubConfig:
+    def __init__(self, latency="const:0", error_rate=0.0, error_codes=(500, 503, 429),
+                 block_words=("STUBBLOCK",), review_words=("STUBREVIEW",), rules=None, seed=None):
+        self.latency_spec = latency
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.rules = list(rules or [])
+        self.rules += [{"contains": w, "action": "block", "categories": ["profanity"]} for w in block_words]
+        self.rules += [{"contains": w, "action": "review", "categories": ["spam"]} for w in review_words]
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "errors": 0, "items": 0, "allow": 0, "review": 0, "block": 0}
+
+    @classmethod
+    def from_env(cls):
+        def words(name, default):
+            return [w.strip() for w in os.getenv(name, default).split(",") if w.strip()]
+
+        rules = None
+        script = os.getenv("GUARD_STUB_SCRIPT")
+        if script:
+            with open(script, encoding="utf-8") as f:
+                rules = json.load(f)
+
+        seed = os.getenv("GUARD_STUB_SEED")
+        return cls(
+            latency=os.getenv("GUARD_STUB_LATENCY", "const:0"),
+            error_rate=float(os.getenv("GUARD_STUB_ERROR_RATE", "0")),
+            error_codes=[int(c) for c in words("GUARD_STUB_ERROR_CODES", "500,503,429")],
+            block_words=words("GUARD_STUB_BLOCK_WORDS", "STUBBLOCK"),
+            review_words=words("GUARD_STUB_REVIEW_WORDS", "STUBREVIEW"),
+            rules=rules,
+            seed=int(seed) if seed else None,
+        )
+
+    def draw(self):
+        """(delay in seconds, error status or None) for the next request."""
+        with self.lock:
+            delay = self.latency(self.rng)
+            error = None
+            if self.error_rate and self.rng.random() < self.error_rate:
+                error = self.rng.choice(self.error_codes)
+            return delay, error
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def verdict(self, text: str) -> dict:
+        """GuardResult payload for one piece of text; first matching rule wins."""
+        lowered = text.lower()
+        for rule in self.rules:
+            if rule["contains"].lower() in lowered:
+                return make_verdict(rule["action"], rule.get("categories", []),
+                                    rule.get("reasons"), rule["contains"])
+        return make_verdict("allow")
+
+
+def make_verdict(action: str, categories=(), reasons=None, term=None) -> dict:
+    found_terms = [term] if term and "profanity" in categories else []
+    return {
+        "action": action,
+        "severity": SEVERITY.get(action, "medium"),
+        "categories": {name: name in categories for name in CATEGORY_NAMES},
+        "found": {
+            "profanity_terms": found_terms,
+            "suspicious_phrases": [],
+            "urls": [],
+            "suspicious_urls": [],
+            "notes": ["stub"],
+        },
+        "reasons": list(reasons) if reasons else ([f"Stub rule: {term}"] if term else []),
+    }
+
+
+def _user_text(payload: dict) -> str:
+    """All user text of a Responses API request (input_text parts included)."""
+    parts = []
+    for message in payload.get("input") or []:
+        if not isinstance(message, dict) or message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(p.get("text", "") for p in content if p.get("type") == "input_text")
+    return "\n".join(parts)
+
+
+def _is_batch(payload: dict) -> bool:
+    fmt = (payload.get("text") or {}).get("format") or {}
+    properties = (fmt.get("schema") or {}).get("properties") or {}
+    return "results" in properties
+
+
+def build_output(payload: dict, config: StubConfig) -> dict:
+    """Structured output for a GuardResult or GuardBatchResult request."""
+    text = _user_text(payload)
+
+    if not _is_batch(payload):
+        verdict = config.verdict(text)
+        config.count("items")
+        config.count(verdict["action"])
+        return verdict
+
+    # "=== ITEM i ===" headers split the batch; each item is judged on its own
+    marks = list(ITEM_RE.finditer(text))
+    results = []
+    for n, mark in enumerate(marks):
+        end = marks[n + 1].start() if n + 1 < len(marks) else len(text)
+        verdict = config.verdict(text[mark.end():end])
+        config.count("items")
+        config.count(verdict["action"])
+        results.append({"index": int(mark.group(1)), "result": verdict})
+    return {"results": results}
+
+
+def _tokens(s: str) -> int:
+    return max(1, len(s) // 4)
+
+
+def build_response(payload: dict, output: dict) -> dict:
+    """Responses API response object with the output as JSON text."""
+    text = json.dumps(output, ensure_ascii=False)
+    input_tokens = _tokens(json.dumps(payload.get("input"), ensure_ascii=False))
+    output_tokens = _tokens(text)
+    return {
+        "id": f"resp_stub_{random.getrandbits(48):012x}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": "completed",
+        "model": payload.get("model", "stub"),
+        "output": [
+            {
+                "type": "message",
+                "id": f"msg_stub_{random.getrandbits(48):012x}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }
+        ],
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        },
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    config = None  # set by make_server
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            with self.config.lock:
+                self._send(200, dict(self.config.counts, latency=self.config.latency_spec))
+        else:
+            self._send(200, {"status": "ok"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+
+        if not self.path.rstrip("/").endswith("/responses"):
+            self._send(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        try:
+            payload = json.loads(raw or b"{}")
+        except ValueError:
+            self._send(400, {"error": {"message": "Invalid JSON", "type": "invalid_request_error"}})
+            return
+
+        self.config.count("requests")
+        delay, error = self.config.draw()
+        if delay:
+            time.sleep(delay)
+
+        if error is not None:
+            self.config.count("errors")
+            self._send(error, {"error": {"message": f"Injected error {error}", "type": "stub_error"}})
+            return
+
+        self._send(200, build_response(payload, build_output(payload, self.config)))
+
+
+def make_server(host="127.0.0.1", port=0, config=None) -> ThreadingHTTPServer:
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"config": config or StubConfig.from_env()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+_background = None
+
+
+def start_in_background(config=None) -> str:
+    """Start the stub in a daemon thread (once per process) and return its base URL."""
+    global _background
+    if _background is None:
+        _background = make_server(config=config)
+        threading.Thread(target=_background.serve_forever, name="guard-stub", daemon=True).start()
+    host, port = _background.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+
+def _benchmark(calls: int = 200, concurrency: int = 16):
+    """guard_text latency through the whole client stack against the in-process stub."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.environ.setdefault("LLM_GUARD_MODE", "stub")
+    os.environ.setdefault("GUARD_CACHE_ENABLED", "0")
+    import llm_guard
+
+    body = "Wat vinden jullie van de nieuwe regels voor de controle van kleine stichtingen? " * 6
+
+    def one(i):
+        start = time.perf_counter()
+        marker = " STUBBLOCK" if i % 10 == 0 else ""
+        decision = llm_guard.guard_text(title=f"Vraag {i}", body=body + str(i) + marker, context="bench")
+        return time.perf_counter() - start, decision["action"]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(calls)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(r[0] for r in results)
+    actions = {}
+    for _, action in results:
+        actions[action] = actions.get(action, 0) + 1
+    print(f"{calls} calls, {concurrency} concurrent, stub latency {os.getenv('GUARD_STUB_LATENCY', 'const:0')}")
+    print(f"wall {wall:.2f}s, {calls / wall:.0f} calls/s, "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f}ms, verdicts {actions}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", help="overrides GUARD_STUB_LATENCY")
+    parser.add_argument("--error-rate", type=float, help="overrides GUARD_STUB_ERROR_RATE")
+    parser.add_argument("--bench", action="store_true", help="run the guard_text benchmark instead")
+    args = parser.parse_args()
+
+    if args.latency:
+        os.environ["GUARD_STUB_LATENCY"] = args.latency
+    if args.error_rate is not None:
+        os.environ["GUARD_STUB_ERROR_RATE"] = str(args.error_rate)
+
+    if args.bench:
+        _benchmark()
+    else:
+        server = make_server(args.host, args.port)
+        print(f"Moderation stub on http://{args.host}:{args.port}/v1")
+        server.serve_forever()
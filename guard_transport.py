@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+import openai
+from openai import OpenAI, Timeout
+
+
+log = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+CONNECT_TIMEOUT = _env_float("GUARD_CONNECT_TIMEOUT", 5)
+READ_TIMEOUT = _env_float("GUARD_READ_TIMEOUT", 30)
+
+# Retries after the first attempt, with full-jitter exponential backoff
+MAX_RETRIES = int(os.getenv("GUARD_MAX_RETRIES", "2"))
+BACKOFF_BASE = _env_float("GUARD_BACKOFF_BASE", 0.5)
+BACKOFF_MAX = _env_float("GUARD_BACKOFF_MAX", 4)
+
+# Process-wide cap on LLM calls in flight, and how long a caller may wait for a slot
+MAX_IN_FLIGHT = int(os.getenv("GUARD_MAX_IN_FLIGHT", "8"))
+QUEUE_TIMEOUT = _env_float("GUARD_QUEUE_TIMEOUT", 10)
+
+# Circuit breaker: open when the failure rate over the last WINDOW calls
+# reaches THRESHOLD (with at least MIN_CALLS calls), stay open COOLDOWN seconds
+BREAKER_WINDOW = int(os.getenv("GUARD_BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("GUARD_BREAKER_MIN_CALLS", "5"))
+BREAKER_THRESHOLD = _env_float("GUARD_BREAKER_THRESHOLD", 0.5)
+BREAKER_COOLDOWN = _env_float("GUARD_BREAKER_COOLDOWN", 30)
+
+# Errors that say nothing about the request itself and are worth retrying
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class GuardUnavailable(Exception):
+    """The moderation LLM can't be reached right now (timeouts, errors, open circuit)."""
+
+
+class CircuitBreaker:
+    """Fail fast while the moderation API is failing.
+
+    closed -> open when the failure rate gets too high, open -> half-open after
+    the cooldown (one trial call), half-open -> closed on success or back to
+    open on failure.
+    """
+
+    def __init__(self, window: int, min_calls: int, threshold: float, cooldown: float):
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._results = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.times_opened = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._trial_running = False
+            if self.state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record(self, ok: bool):
+        with self._lock:
+            if self.state == "half_open":
+                self._trial_running = False
+                if ok:
+                    self.state = "closed"
+                    self._results.clear()
+                else:
+                    self._open()
+                return
+
+            self._results.append(ok)
+            failures = self._results.count(False)
+            if (
+                self.state == "closed"
+                and len(self._results) >= self.min_calls
+                and failures / len(self._results) >= self.threshold
+            ):
+                self._open()
+
+    def cancel(self):
+        """Give back a half-open trial that never reached the API."""
+        with self._lock:
+            if self.state == "half_open":
+                self._trial_running = False
+
+    def _open(self):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.times_opened += 1
+        log.warning("Moderation circuit breaker opened for %.0fs", self.cooldown)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "recent_calls": len(self._results),
+                "recent_failures": self._results.count(False),
+                "times_opened": self.times_opened,
+            }
+
+
+breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+_slots = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
+# "openai" (default) or "stub": talk to the local stand-in server from guard_stub,
+# started in-process unless LLM_GUARD_BASE_URL points at a running one
+MODE = os.getenv("LLM_GUARD_MODE", "openai").lower()
+
+
+def make_client() -> OpenAI:
+    """OpenAI client with explicit timeouts; retries are done by call()."""
+    base_url = os.getenv("LLM_GUARD_BASE_URL") or None
+    api_key = os.getenv("OPENAI_API_KEY")
+
+    if MODE == "stub":
+        if base_url is None:
+            import guard_stub
+            base_url = guard_stub.start_in_background()
+        api_key = api_key or "stub"
+
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        max_retries=0,
+    )
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def call(fn, *args, **kwargs):
+    """Call the LLM through the semaphore, the retry loop and the circuit breaker.
+
+    Raises GuardUnavailable when the circuit is open, no slot is free within
+    QUEUE_TIMEOUT, or all retries failed. Other API errors (e.g. a bad request)
+    count as a failure for the breaker and are raised unchanged.
+    """
+
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise GuardUnavailable("circuit open")
+
+        if not _slots.acquire(timeout=QUEUE_TIMEOUT):
+            breaker.cancel()
+            raise GuardUnavailable("too many moderation calls in flight")
+
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+        except RETRYABLE_ERRORS as e:
+            error = e
+        finally:
+            # Every call that reached the API is recorded, whatever it raised,
+            # so a half-open trial is always settled
+            _slots.release()
+            breaker.record(ok)
+
+        if ok:
+            return result
+        if attempt >= MAX_RETRIES or breaker.state == "open":
+            raise GuardUnavailable(repr(error)) from error
+
+        # The slot is free during the backoff, other callers can use it
+        time.sleep(_backoff(attempt))
+        attempt += 1
@@ -1,11 +1,12 @@
 import os
 import requests
 import urllib.parse
-from models import User
+from models import db, User
 
 
-from flask import redirect, render_template, request, session
+from flask import g, redirect, render_template, request, session
 from functools import wraps
+from sqlalchemy.orm import joinedload
 
 
 def apology(message, code=400):
@@ -23,6 +24,14 @@ def apology(message, code=400):
     return render_template("apology.html", top=code, bottom=escape(message)), code
 
 
+def get_current_user():
+    """The logged in user (roles loaded) or None, loaded once per request and kept on flask.g."""
+    if "current_user" not in g:
+        user_id = session.get("user_id")
+        g.current_user = db.session.get(User, user_id, options=[joinedload(User.roles)]) if user_id else None
+    return g.current_user
+
+
 def login_required(f):
     """
     Decorate routes to require login.
@@ -41,8 +50,7 @@ def blogger_required(f):
     """Only allow users with authors to blog"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user_id = session.get("user_id")
-        user = User.query.get(user_id) if user_id else None
+        user = get_current_user()
 
         if user is None:
             return redirect("/login")
@@ -58,13 +66,12 @@ def moderator_required(f):
     """Only allow admins and superadmins to moderate"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user_id = session.get("user_id")
-        user = User.query.get(user_id) if user_id else None
+        user = get_current_user()
 
         if user is None:
             return redirect("/home")   
 
-        if not (user.has_role("admin") or user.has_role("superadmin") or user.has_role("author")):
+        if not user.role_names & {"admin", "superadmin", "author"}:
             return redirect("/home") 
 
         return f(*args, **kwargs)
@@ -75,3 +82,9 @@ def moderator_required(f):
 
 
 
+
+
+def wants_json():
+    """True when the client asked for JSON (fetch with Accept: application/json) instead of a page."""
+    best = request.accept_mimetypes.best_match(["application/json", "text/html"])
+    return best == "application/json" and request.accept_mimetypes[best] > request.accept_mimetypes["text/html"]
@@ -0,0 +1,141 @@
+import json
+
+from sqlalchemy import select, text
+
+from models import (
+    db, BlogPost, DialogueThread, DialogueComment, DialogueCommentVote,
+    DialogueThreadVote, OpinionPoll, OpinionVote, visible_to,
+)
+
+
+def hot_queries():
+    """(name, table, statement) for the queries that have to be served by an index.
+
+    The statements mirror the ones in app.py; ids are placeholders.
+    """
+    queries = [
+        ("blog listing", BlogPost.__table__, select(BlogPost)
+            .where(visible_to(BlogPost, None))
+            .order_by(BlogPost.created_at.desc(), BlogPost.id.desc()).limit(20)),
+        ("blog post of thread", BlogPost.__table__, select(BlogPost)
+            .where(BlogPost.dialogue_thread_id == 1)),
+        ("dialoog listing (hot)", DialogueThread.__table__, select(DialogueThread)
+            .where(visible_to(DialogueThread, None))
+            .order_by(DialogueThread.hot_rank.desc(), DialogueThread.created_at.desc(), DialogueThread.id.desc())
+            .limit(20)),
+        ("dialoog listing (top)", DialogueThread.__table__, select(DialogueThread)
+            .where(visible_to(DialogueThread, None))
+            .order_by(DialogueThread.score.desc(), DialogueThread.created_at.desc(), DialogueThread.id.desc())
+            .limit(20)),
+        ("dialoog listing (new)", DialogueThread.__table__, select(DialogueThread)
+            .where(visible_to(DialogueThread, None))
+            .order_by(DialogueThread.created_at.desc(), DialogueThread.id.desc())
+            .limit(20)),
+        ("dialoog sidebar", DialogueThread.__table__, select(DialogueThread)
+            .where(visible_to(DialogueThread, None))
+            .order_by(DialogueThread.created_at.desc()).limit(10)),
+        ("thread comments", DialogueComment.__table__, select(DialogueComment)
+            .where(DialogueComment.thread_id == 1, visible_to(DialogueComment, None))
+            .order_by(DialogueComment.score.desc(), DialogueComment.created_at.asc())),
+        ("comment replies", DialogueComment.__table__, select(DialogueComment)
+            .where(DialogueComment.parent_id == 1)),
+        ("top-level comments page", DialogueComment.__table__, select(DialogueComment)
+            .where(DialogueComment.thread_id == 1, DialogueComment.parent_id.is_(None),
+                   visible_to(DialogueComment, None))
+            .order_by(DialogueComment.score.desc(), DialogueComment.created_at.asc(), DialogueComment.id.asc())
+            .limit(21)),
+        ("replies page", DialogueComment.__table__, select(DialogueComment)
+            .where(DialogueComment.thread_id == 1, DialogueComment.parent_id == 1,
+                   visible_to(DialogueComment, None))
+            .order_by(DialogueComment.score.desc(), DialogueComment.created_at.asc(), DialogueComment.id.asc())
+            .limit(21)),
+        ("thread in tree order", DialogueComment.__table__, select(DialogueComment)
+            .where(DialogueComment.thread_id == 1).order_by(DialogueComment.path)),
+        ("replies of a deleted comment", DialogueComment.__table__, select(DialogueComment.id)
+            .where(DialogueComment.thread_id == 1, DialogueComment.path > "000001",
+                   DialogueComment.path < "000001~")),
+        ("opinie listing", OpinionPoll.__table__, select(OpinionPoll)
+            .where(visible_to(OpinionPoll, None))
+            .order_by((OpinionPoll.yes_count + OpinionPoll.no_count).desc(),
+                      OpinionPoll.created_at.desc(), OpinionPoll.id.desc())
+            .limit(20)),
+        ("poll of thread", OpinionPoll.__table__, select(OpinionPoll)
+            .where(OpinionPoll.dialogue_thread_id == 1)),
+        ("own poll vote", OpinionVote.__table__, select(OpinionVote)
+            .where(OpinionVote.user_id == 1, OpinionVote.poll_id == 1)),
+        ("poll votes", OpinionVote.__table__, select(OpinionVote)
+            .where(OpinionVote.poll_id == 1)),
+        ("own thread vote", DialogueThreadVote.__table__, select(DialogueThreadVote)
+            .where(DialogueThreadVote.user_id == 1, DialogueThreadVote.thread_id == 1)),
+        ("thread votes", DialogueThreadVote.__table__, select(DialogueThreadVote)
+            .where(DialogueThreadVote.thread_id == 1)),
+        ("own comment vote", DialogueCommentVote.__table__, select(DialogueCommentVote)
+            .where(DialogueCommentVote.user_id == 1, DialogueCommentVote.comment_id == 1)),
+        ("comment votes", DialogueCommentVote.__table__, select(DialogueCommentVote)
+            .where(DialogueCommentVote.comment_id == 1)),
+    ]
+
+    # Everything written by one user (profile pages, account deletion)
+    for model in (BlogPost, DialogueThread, DialogueComment, OpinionPoll):
+        queries.append((
+            f"{model.__tablename__} by author", model.__table__,
+            select(model).where(model.author_id == 1),
+        ))
+    return queries
+
+
+def _sqlite_problems(conn, table, sql):
+    plan = [row[3] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql))]
+    problems = []
+    for detail in plan:
+        if detail == f"SCAN {table.name}":
+            problems.append("full table scan")
+        if "TEMP B-TREE" in detail:
+            problems.append("sorts without an index")
+    return problems, plan
+
+
+def _postgres_problems(conn, table, sql):
+    # Small test tables are cheaper to scan; only fail when no index *can* be used
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    conn.execute(text("SET LOCAL enable_sort = off"))
+    plan = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    problems, nodes = [], [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get("Plans", []))
+        if node["Node Type"] == "Seq Scan" and node.get("Relation Name") == table.name:
+            problems.append("full table scan")
+        if node["Node Type"] in ("Sort", "Incremental Sort"):
+            problems.append("sorts without an index")
+    return problems, [json.dumps(plan)]
+
+
+def check(bind=None):
+    """EXPLAIN every hot query. Returns a list of (name, problems, plan lines)."""
+
+    bind = bind if bind is not None else db.engine
+    explain = _sqlite_problems if bind.dialect.name == "sqlite" else _postgres_problems
+
+    results = []
+    for name, table, stmt in hot_queries():
+        sql = str(stmt.compile(bind, compile_kwargs={"literal_binds": True}))
+        with bind.begin() as conn:
+            problems, plan = explain(conn, table, sql)
+        results.append((name, sorted(set(problems)), plan))
+    return results
+
+
+if __name__ == "__main__":
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        for name, problems, plan in check():
+            print(f"{'FAIL' if problems else 'ok':<5} {name:<28} {'; '.join(problems or plan)}")
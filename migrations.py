@@ -0,0 +1,154 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+import comment_tree
+import hot_rank
+from models import DialogueComment
+
+
+# Columns added to existing tables after the first release.
+# db.create_all() only creates missing tables, so these are added by hand
+# (the DDL, or a function of the dialect that returns it).
+ADDED_COLUMNS = {
+    "blog_posts": [
+        ("moderation_status", "VARCHAR(20) NOT NULL DEFAULT 'approved'"),
+    ],
+    "dialogue_threads": [
+        ("moderation_status", "VARCHAR(20) NOT NULL DEFAULT 'approved'"),
+        ("comment_count", "INTEGER NOT NULL DEFAULT 0"),
+        ("hot_rank", "FLOAT NOT NULL DEFAULT 0"),
+    ],
+    "dialogue_comments": [
+        ("moderation_status", "VARCHAR(20) NOT NULL DEFAULT 'approved'"),
+        ("depth", "INTEGER NOT NULL DEFAULT 0"),
+        # TEXT, COLLATE "C" on PostgreSQL
+        ("path", lambda dialect: DialogueComment.path.type.compile(dialect=dialect)),
+    ],
+    "opinion_polls": [
+        ("moderation_status", "VARCHAR(20) NOT NULL DEFAULT 'approved'"),
+    ],
+    "moderation_jobs": [
+        ("run_after", "DATETIME"),
+    ],
+    "moderation_fingerprints": [
+        ("active_hash", "VARCHAR(64)"),
+    ],
+}
+
+
+# Statements (or functions taking the connection) that fill a column right after it was added
+BACKFILLS = {
+    ("dialogue_comments", "path"): comment_tree.rebuild_paths,
+    ("dialogue_threads", "hot_rank"): hot_rank.refresh,
+    ("dialogue_threads", "comment_count"): """
+        UPDATE dialogue_threads SET comment_count = (
+            SELECT COUNT(*) FROM dialogue_comments
+            WHERE dialogue_comments.thread_id = dialogue_threads.id
+              AND dialogue_comments.moderation_status IN ('approved', 'review')
+        )
+    """,
+}
+
+
+# Columns that became NOT NULL after the first release, with the value for
+# existing NULLs (they sort as the oldest rows; keyset pagination needs a value).
+# SQLite can't change the constraint of an existing column, there only the
+# NULLs are filled and the model default keeps new rows filled.
+NOT_NULL_COLUMNS = {
+    ("blog_posts", "created_at"): "'1970-01-01 00:00:00'",
+    ("dialogue_threads", "created_at"): "'1970-01-01 00:00:00'",
+}
+
+
+# Unique constraints added after the first release, created as unique indexes
+# (SQLite can't add a constraint to an existing table). Duplicate rows are
+# removed first, keeping the newest vote, and the totals are recounted.
+ADDED_UNIQUE = {
+    ("opinion_votes", "uq_user_poll_vote"): (
+        ["user_id", "poll_id"],
+        [
+            """
+            DELETE FROM opinion_votes WHERE id NOT IN (
+                SELECT MAX(id) FROM opinion_votes GROUP BY user_id, poll_id
+            )
+            """,
+            """
+            UPDATE opinion_polls SET
+                yes_count = (SELECT COUNT(*) FROM opinion_votes
+                             WHERE opinion_votes.poll_id = opinion_polls.id AND opinion_votes.value = 1),
+                no_count = (SELECT COUNT(*) FROM opinion_votes
+                            WHERE opinion_votes.poll_id = opinion_polls.id AND opinion_votes.value = -1)
+            """,
+            "UPDATE opinion_polls SET score = yes_count - no_count",
+        ],
+    ),
+    ("dialogue_thread_votes", "uq_user_thread_vote"): (
+        ["user_id", "thread_id"],
+        [
+            """
+            DELETE FROM dialogue_thread_votes WHERE id NOT IN (
+                SELECT MAX(id) FROM dialogue_thread_votes GROUP BY user_id, thread_id
+            )
+            """,
+            """
+            UPDATE dialogue_threads SET score = COALESCE((
+                SELECT SUM(value) FROM dialogue_thread_votes
+                WHERE dialogue_thread_votes.thread_id = dialogue_threads.id
+            ), 0)
+            """,
+        ],
+    ),
+}
+
+
+def upgrade(db):
+    """Bring an existing database up to date with the models."""
+
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+
+    with db.engine.begin() as conn:
+        # Before the backfills below, which may read these columns
+        for (table, name), value in NOT_NULL_COLUMNS.items():
+            if table not in tables:
+                continue
+            column = next(c for c in inspector.get_columns(table) if c["name"] == name)
+            if column["nullable"]:
+                conn.execute(text(f"UPDATE {table} SET {name} = {value} WHERE {name} IS NULL"))
+                if conn.dialect.name != "sqlite":
+                    conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {name} SET NOT NULL"))
+
+        for table, columns in ADDED_COLUMNS.items():
+            if table not in tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            for name, ddl in columns:
+                if name not in existing:
+                    if callable(ddl):
+                        ddl = ddl(conn.dialect)
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+                    fill = BACKFILLS.get((table, name))
+                    if callable(fill):
+                        fill(conn)
+                    elif fill:
+                        conn.execute(text(fill))
+
+        # Unique constraints, after removing the duplicates they would reject
+        for (table, name), (columns, dedupe) in ADDED_UNIQUE.items():
+            if table not in tables:
+                continue
+            existing = {u["name"] for u in inspector.get_unique_constraints(table)}
+            existing |= {i["name"] for i in inspector.get_indexes(table)}
+            if name in existing:
+                continue
+            removed = conn.execute(text(dedupe[0])).rowcount
+            if removed:
+                for statement in dedupe[1:]:
+                    conn.execute(text(statement))
+            conn.execute(text(f"CREATE UNIQUE INDEX {name} ON {table} ({', '.join(columns)})"))
+
+        # Indexes declared on the models (create_all skips existing tables)
+        for table in db.metadata.sorted_tables:
+            if table.name in tables:
+                for index in table.indexes:
+                    conn.execute(CreateIndex(index, if_not_exists=True))
@@ -1,8 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import or_, true, event, func, select, update
+from sqlalchemy.dialects import postgresql
 from datetime import datetime, timedelta
 
 db = SQLAlchemy()
 
+# Moderation states of user content. "review" stays visible, just like a
+# "review" verdict doesn't block a post in synchronous mode
+MODERATION_STATUSES = ("pending", "approved", "blocked", "review")
+VISIBLE_STATUSES = ("approved", "review")
+
 # Connection table for many to many relationships between users and roles
 user_roles = db.Table(
     "user_roles",
@@ -30,7 +37,15 @@ class User(db.Model):
     roles = db.relationship("Role", secondary=user_roles, backref="users") 
 
     def has_role(self, role_name):
-        return any(r.name == role_name for r in self.roles)
+        return role_name in self.role_names
+
+    @property
+    def role_names(self):
+        """Names of the user's roles as a frozenset, built once per loaded user."""
+        names = self.__dict__.get("_role_names")
+        if names is None:
+            names = self._role_names = frozenset(r.name for r in self.roles)
+        return names
 
     # Convenience property for displaying full name
     @property
@@ -47,6 +62,20 @@ class Role(db.Model):
     name = db.Column(db.String(50), unique=True, nullable=False)
 
 
+# Role changes and reloads make User.role_names build the set again
+@event.listens_for(User.roles, "append")
+@event.listens_for(User.roles, "remove")
+@event.listens_for(User.roles, "bulk_replace")
+def _forget_role_names_on_change(user, *args):
+    user.__dict__.pop("_role_names", None)
+
+
+@event.listens_for(User, "expire")
+@event.listens_for(User, "refresh")
+def _forget_role_names(user, *args):
+    user.__dict__.pop("_role_names", None)
+
+
 class BlogPost(db.Model):
     __tablename__ = "blog_posts"
 
@@ -54,16 +83,18 @@ class BlogPost(db.Model):
     title = db.Column(db.String(255), nullable=False)
     content = db.Column(db.Text, nullable=False)
     thumbnail_image = db.Column(db.String(255))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    moderation_status = db.Column(db.String(20), nullable=False, default="approved", server_default="approved")
 
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
     author = db.relationship("User", backref="blog_posts")
 
     # Optional link to a dialogue thread
     dialogue_thread_id = db.Column(
         db.Integer,
         db.ForeignKey("dialogue_threads.id"),
-        nullable=True
+        nullable=True,
+        index=True,
     )
     dialogue_thread = db.relationship(
         "DialogueThread",
@@ -71,6 +102,9 @@ class BlogPost(db.Model):
         uselist=False
     )
 
+    # Newest first listing (/blog and the sidebar)
+    __table_args__ = (db.Index("ix_blog_posts_created", "created_at", "id"),)
+
 
 class DialogueThread(db.Model):
     __tablename__ = "dialogue_threads"
@@ -78,16 +112,30 @@ class DialogueThread(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     body = db.Column(db.Text)
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
     thumbnail_image = db.Column(db.String(255))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    moderation_status = db.Column(db.String(20), nullable=False, default="approved", server_default="approved")
 
     # Total score of up/downvotes on the thread itself
     score = db.Column(db.Integer, default=0, nullable=False)
 
+    # Number of published comments, kept up to date by the DialogueComment events below
+    comment_count = db.Column(db.Integer, default=0, nullable=False, server_default="0")
+
+    # Time-decayed activity for the "hot" order, maintained by hot_rank
+    hot_rank = db.Column(db.Float, default=0, nullable=False, server_default="0")
+
     author = db.relationship("User", backref="dialogue_threads")
     comments = db.relationship("DialogueComment", backref="thread", cascade="all, delete-orphan", lazy="dynamic",)
 
+    # /dialoog listing (hot, top and new order) and the newest-first sidebar
+    __table_args__ = (
+        db.Index("ix_dialogue_threads_hot", "hot_rank", "created_at", "id"),
+        db.Index("ix_dialogue_threads_score", "score", "created_at", "id"),
+        db.Index("ix_dialogue_threads_created", "created_at", "id"),
+    )
+
 
 class DialogueComment(db.Model):
     __tablename__ = "dialogue_comments"
@@ -95,6 +143,7 @@ class DialogueComment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    moderation_status = db.Column(db.String(20), nullable=False, default="approved", server_default="approved")
 
     # Score for sorting / displaying
     score = db.Column(db.Integer, default=0, nullable=False)
@@ -102,13 +151,100 @@ class DialogueComment(db.Model):
     # Links comment to thread
     thread_id = db.Column(db.Integer, db.ForeignKey("dialogue_threads.id"), nullable=False)
 
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
     author = db.relationship("User", backref="dialogue_comments")
 
     # Parent/children for nested structure
-    parent_id = db.Column(db.Integer, db.ForeignKey("dialogue_comments.id"), nullable=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey("dialogue_comments.id"), nullable=True, index=True)
     parent = db.relationship("DialogueComment", remote_side=[id], backref="children")
 
+    # Materialized path of ancestor ids and the nesting level (0 = top level),
+    # maintained by comment_tree. Compared byte-wise, so COLLATE "C" on PostgreSQL
+    path = db.Column(db.Text().with_variant(postgresql.TEXT(collation="C"), "postgresql"), nullable=True)
+    depth = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Comments of a thread in display order (score desc, oldest first), by path (the
+    # subtree range of comment_tree.detach_replies), and one level of it (top level
+    # or the replies of a comment) in display order
+    __table_args__ = (
+        db.Index("ix_dialogue_comments_thread_order", "thread_id", db.text("score DESC"), "created_at"),
+        db.Index("ix_dialogue_comments_thread_path", "thread_id", "path"),
+        db.Index("ix_dialogue_comments_siblings", "thread_id", "parent_id", db.text("score DESC"), "created_at", "id"),
+    )
+
+
+def _bump_comment_count(connection, thread_id, delta):
+    """SQL-side increment, so concurrent requests can't lose an update."""
+    if delta:
+        connection.execute(
+            update(DialogueThread.__table__)
+            .where(DialogueThread.__table__.c.id == thread_id)
+            .values(comment_count=DialogueThread.__table__.c.comment_count + delta)
+        )
+
+
+# Keep DialogueThread.comment_count in step with published comments. These
+# run for every ORM insert/update/delete, including the delete-orphan cascade
+# of a thread; bulk Query.delete()/update() calls have to adjust it themselves
+@event.listens_for(DialogueComment, "after_insert")
+def _comment_inserted(mapper, connection, comment):
+    if comment.moderation_status in VISIBLE_STATUSES:
+        _bump_comment_count(connection, comment.thread_id, 1)
+
+
+@event.listens_for(DialogueComment, "after_delete")
+def _comment_deleted(mapper, connection, comment):
+    if comment.moderation_status in VISIBLE_STATUSES:
+        _bump_comment_count(connection, comment.thread_id, -1)
+
+
+@event.listens_for(DialogueComment, "after_update")
+def _comment_updated(mapper, connection, comment):
+    history = db.inspect(comment).attrs.moderation_status.history
+    if not history.has_changes():
+        return
+
+    # Old value unknown (attribute was expired): recount this one thread
+    if not history.deleted:
+        table = DialogueThread.__table__
+        connection.execute(
+            update(table)
+            .where(table.c.id == comment.thread_id)
+            .values(comment_count=_published_count(table.c.id))
+        )
+        return
+
+    was = history.deleted[0] in VISIBLE_STATUSES
+    now = comment.moderation_status in VISIBLE_STATUSES
+    _bump_comment_count(connection, comment.thread_id, int(now) - int(was))
+
+
+def _published_count(thread_id_column):
+    """Correlated subquery: published comments of the thread in ``thread_id_column``."""
+    comments = DialogueComment.__table__
+    return (
+        select(func.count(comments.c.id))
+        .where(
+            comments.c.thread_id == thread_id_column,
+            comments.c.moderation_status.in_(VISIBLE_STATUSES),
+        )
+        .scalar_subquery()
+    )
+
+
+def reconcile_comment_counts():
+    """Recompute every DialogueThread.comment_count in one UPDATE. Returns the number of fixed threads."""
+
+    counted = _published_count(DialogueThread.id)
+    result = db.session.execute(
+        update(DialogueThread)
+        .where(DialogueThread.comment_count != counted)
+        .values(comment_count=counted)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount
+
 
 class DialogueCommentVote(db.Model):
     __tablename__ = "dialogue_comment_votes"
@@ -120,7 +256,7 @@ class DialogueCommentVote(db.Model):
     user = db.relationship("User", backref="comment_votes")
 
     # Link to user and comment
-    comment_id = db.Column(db.Integer, db.ForeignKey("dialogue_comments.id"), nullable=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey("dialogue_comments.id"), nullable=False, index=True)
     comment = db.relationship("DialogueComment", backref=db.backref("votes", cascade="all, delete-orphan"))
 
     # Ensure a user can only vote once per comment
@@ -132,13 +268,16 @@ class DialogueThreadVote(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    thread_id = db.Column(db.Integer, db.ForeignKey("dialogue_threads.id"), nullable=False)
+    thread_id = db.Column(db.Integer, db.ForeignKey("dialogue_threads.id"), nullable=False, index=True)
     value = db.Column(db.Integer, nullable=False) 
 
     # Link to user and thread
     user = db.relationship("User", backref="thread_votes")
     thread = db.relationship("DialogueThread", backref="votes")
 
+    # Ensure a user can only vote once per thread
+    __table_args__ = (db.UniqueConstraint("user_id", "thread_id", name="uq_user_thread_vote"),)
+
 
 class OpinionPoll(db.Model):
     __tablename__ = "opinion_polls"
@@ -148,14 +287,15 @@ class OpinionPoll(db.Model):
     question = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=True)
 
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
 
     thumbnail_image = db.Column(db.String(255), nullable=True)
 
     # Link to dialogue thread
-    dialogue_thread_id = db.Column(db.Integer, db.ForeignKey("dialogue_threads.id"))
+    dialogue_thread_id = db.Column(db.Integer, db.ForeignKey("dialogue_threads.id"), index=True)
 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    moderation_status = db.Column(db.String(20), nullable=False, default="approved", server_default="approved")
 
     expires_at = db.Column(
         db.DateTime,
@@ -181,6 +321,11 @@ class OpinionPoll(db.Model):
         cascade="all, delete-orphan",
     )
 
+    # /opinie listing: most votes, then newest
+    __table_args__ = (
+        db.Index("ix_opinion_polls_votes", db.text("(yes_count + no_count) DESC"), db.text("created_at DESC"), db.text("id DESC")),
+    )
+
     @property
     def total_votes(self):
         """Return total number of votes."""
@@ -198,10 +343,89 @@ class OpinionVote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    poll_id = db.Column(db.Integer, db.ForeignKey("opinion_polls.id"), nullable=False)
+    poll_id = db.Column(db.Integer, db.ForeignKey("opinion_polls.id"), nullable=False, index=True)
 
     value = db.Column(db.Integer, nullable=False)
 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-    user = db.relationship("User", backref="opinion_votes")
\ No newline at end of file
+    user = db.relationship("User", backref="opinion_votes")
+
+    # Ensure a user can only vote once per poll
+    __table_args__ = (db.UniqueConstraint("user_id", "poll_id", name="uq_user_poll_vote"),)
+
+
+class ModerationJob(db.Model):
+    __tablename__ = "moderation_jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # What to moderate: "blog_post", "dialogue_thread", "dialogue_comment" or "opinion_poll"
+    content_type = db.Column(db.String(50), nullable=False)
+    content_id = db.Column(db.Integer, nullable=False)
+
+    # Guard context, e.g. "blog_post" or "dialogue_comment_edit"
+    context = db.Column(db.String(50), nullable=False)
+
+    # Optional uploaded image that has to be checked as well
+    image_path = db.Column(db.String(500), nullable=True)
+
+    # "queued", "running", "done" or "failed"
+    status = db.Column(db.String(20), nullable=False, default="queued", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+
+    # Retry no earlier than this (set after a failed attempt)
+    run_after = db.Column(db.DateTime, nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ModerationFingerprint(db.Model):
+    """Segment hashes of the last approved text of a content item, to re-check only what changed."""
+    __tablename__ = "moderation_fingerprints"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    content_type = db.Column(db.String(50), nullable=False)
+    content_id = db.Column(db.Integer, nullable=False)
+
+    # Fingerprints from an older prompt/model are not trusted
+    prompt_version = db.Column(db.String(32), nullable=False)
+
+    title_hash = db.Column(db.String(64), nullable=False)
+    # JSON list of segment hashes, in text order
+    segment_hashes = db.Column(db.Text, nullable=False)
+    # Hash of the scripts/event handlers in the markup (guard_extract active parts)
+    active_hash = db.Column(db.String(64), nullable=True)
+
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint("content_type", "content_id", name="uq_fingerprint_content"),)
+
+
+def visible_to(model, user):
+    """Filter for published content, plus the user's own pending/blocked content.
+
+    Admins and superadmins see everything.
+    """
+    published = model.moderation_status.in_(VISIBLE_STATUSES)
+    if user is None:
+        return published
+    if user.has_role("admin") or user.has_role("superadmin"):
+        return true()
+    return or_(published, model.author_id == user.id)
+
+
+def is_visible_to(item, user):
+    """Python counterpart of visible_to() for a single loaded row."""
+    if item.moderation_status in VISIBLE_STATUSES:
+        return True
+    if user is None:
+        return False
+    return (
+        item.author_id == user.id
+        or user.has_role("admin")
+        or user.has_role("superadmin")
+    )
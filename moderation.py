@@ -0,0 +1,211 @@
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import List
+
+from werkzeug.utils import secure_filename
+
+import llm_guard
+
+
+# Shared, bounded pool for all moderation checks of all requests
+_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MODERATION_POOL_SIZE", "8")),
+    thread_name_prefix="moderation",
+)
+
+
+# Shown when content is rejected because the moderation LLM is unavailable
+UNAVAILABLE_MESSAGE = "Post tegengehouden: De controle is tijdelijk niet beschikbaar, probeer het later opnieuw."
+
+# Shown when a single upload (profile picture, editor image) is rejected because
+# the moderation LLM is unavailable
+UPLOAD_UNAVAILABLE_MESSAGE = "Upload tegengehouden: De controle is tijdelijk niet beschikbaar, probeer het later opnieuw."
+
+# Shown when the post goes through but its image wasn't approved (e.g. sent to review)
+IMAGE_NOT_APPROVED_MESSAGE = "Afbeelding niet geplaatst: deze kon niet automatisch worden goedgekeurd."
+
+
+class TextCheck:
+    """Text moderation of a title/body via guard_text."""
+
+    def __init__(self, title: str = "", body: str = "", context: str = "generic"):
+        self.title = title
+        self.body = body
+        self.context = context
+        self.decision = None
+
+    def run(self) -> dict:
+        return llm_guard.guard_text(title=self.title, body=self.body, context=self.context)
+
+    def block_messages(self) -> List[str]:
+        return text_block_messages(self.decision)
+
+    @property
+    def blocked(self) -> bool:
+        return self.decision is not None and self.decision.get("action") == "block"
+
+
+class ImageCheck:
+    """Image moderation of an uploaded file via guard_image."""
+
+    def __init__(self, path: str, context: str = "image_upload", filename: str = None):
+        self.path = path
+        self.context = context
+        self.filename = filename or os.path.basename(path)
+        self.decision = None
+
+    @classmethod
+    def from_upload(cls, file, context: str = "image_upload") -> "ImageCheck":
+        """Check an upload from a private temporary file; nothing is public until publish()."""
+        filename = secure_filename(file.filename or "") or "upload"
+        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1] or ".jpg") as tmp:
+            file.save(tmp)
+        return cls(tmp.name, context=context, filename=filename)
+
+    def run(self) -> dict:
+        return llm_guard.guard_image(self.path, context=self.context)
+
+    def block_messages(self) -> List[str]:
+        return image_block_messages(self.decision)
+
+    @property
+    def blocked(self) -> bool:
+        return self.decision is not None and self.decision.get("action") == "block"
+
+    @property
+    def approved(self) -> bool:
+        # Not checked (another check blocked first) or sent to review is not approved
+        return self.decision is not None and self.decision.get("action") == "allow"
+
+    def publish(self, folder: str):
+        """Move an approved upload into ``folder`` under a unique name and return that name.
+
+        Anything else is deleted and None returned.
+        """
+        if not self.approved:
+            self.discard()
+            return None
+        filename = publish_file(self.path, folder, self.filename)
+        self.path = os.path.join(folder, filename)
+        return filename
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def unique_filename(filename: str) -> str:
+    """<random>_<filename>, so uploads never overwrite each other."""
+    return f"{uuid.uuid4().hex[:12]}_{secure_filename(filename or '') or 'upload'}"
+
+
+def publish_file(path: str, folder: str, filename: str) -> str:
+    """Move ``path`` into ``folder`` under a unique name based on ``filename``."""
+    filename = unique_filename(filename)
+    shutil.move(path, os.path.join(folder, filename))
+    return filename
+
+
+@dataclass
+class ModerationOutcome:
+    blocked: bool
+    messages: List[str] = field(default_factory=list)
+
+
+def text_block_messages(decision: dict) -> List[str]:
+    """Flash messages for a blocked text decision."""
+
+    found = decision.get("found", {}) or {}
+    prof = found.get("profanity_terms", []) or []
+    sus_urls = found.get("suspicious_urls", []) or []
+
+    if decision.get("fallback"):
+        return [UNAVAILABLE_MESSAGE]
+
+    messages = []
+    if prof:
+        messages.append(
+            "Post tegengehouden: Mogelijke scheldwoorden gedetecteerd: "
+            + ", ".join(prof[:10])
+        )
+    if sus_urls:
+        messages.append(
+            "Post tegengehouden: Mogelijk schadelijke link gedetecteerd: "
+            + ", ".join(sus_urls[:5])
+        )
+    if not prof and not sus_urls:
+        messages.append("Post tegengehouden: Ongewenste inhoud gedetecteerd.")
+    return messages
+
+
+def upload_block_message(decision: dict) -> str:
+    """Message for a blocked single upload, checked with guard_image directly."""
+
+    if decision.get("fallback"):
+        return UPLOAD_UNAVAILABLE_MESSAGE
+    return "Upload tegengehouden: ongewenste afbeelding gedetecteerd."
+
+
+def image_block_messages(decision: dict) -> List[str]:
+    """Flash messages for a blocked image decision."""
+
+    if decision.get("fallback"):
+        return [UNAVAILABLE_MESSAGE]
+
+    cats = decision.get("categories", {}) or {}
+
+    messages = []
+    if cats.get("nsfw"):
+        messages.append("Post tegengehouden: Mogelijk seksueel expliciete afbeelding gedetecteerd")
+    if cats.get("gore"):
+        messages.append("Post tegengehouden: Mogelijk gewelddadige/bloederige afbeelding gedetecteerd")
+    if cats.get("offensive_symbols"):
+        messages.append("Post tegengehouden: Mogelijk aanstootgevende symbolen gedetecteerd")
+    if not messages:
+        messages.append("Post tegengehouden: Ongewenste afbeelding gedetecteerd.")
+    return messages
+
+
+def moderate(checks) -> ModerationOutcome:
+    """Run all checks of one submission concurrently and wait for them together.
+
+    Returns as soon as one check blocks; checks that haven't finished by then
+    keep ``decision = None`` (and are cancelled if they haven't started), so
+    callers only use an upload whose ImageCheck is ``approved``. An ImageCheck
+    that is already running is waited for, so the caller can discard its
+    file without deleting it under guard_image. Messages of
+    all finished blocking checks are merged in the order the checks were given.
+    """
+
+    checks = [c for c in checks if c is not None]
+    if not checks:
+        return ModerationOutcome(blocked=False)
+
+    # A single check doesn't need the pool
+    if len(checks) == 1:
+        checks[0].decision = checks[0].run()
+    else:
+        futures = {_pool.submit(c.run): c for c in checks}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures[future].decision = future.result()
+            if any(futures[f].blocked for f in done):
+                for future in pending:
+                    future.cancel()
+                wait([f for f in pending if isinstance(futures[f], ImageCheck)])
+                break
+
+    messages = []
+    for c in checks:
+        if c.blocked:
+            messages.extend(c.block_messages())
+
+    return ModerationOutcome(blocked=bool(messages), messages=messages)
@@ -0,0 +1,164 @@
+import re
+import json
+import bisect
+import hashlib
+from datetime import datetime
+
+import llm_guard
+import guard_extract
+from moderation import TextCheck
+from models import db, ModerationFingerprint
+
+
+# Paragraphs longer than this are split into sentences
+SEGMENT_MAX_CHARS = 600
+
+# Unchanged segments sent along on each side of a changed one
+CONTEXT_SEGMENTS = 1
+
+# Marks skipped text between two changed parts
+GAP = "\n\n[...]\n\n"
+
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def segments(text: str):
+    """Paragraphs of the extracted text; long paragraphs are split into sentences."""
+    text = llm_guard.normalize_text(text)
+    result = []
+    for paragraph in text.split("\n"):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        if len(paragraph) <= SEGMENT_MAX_CHARS:
+            result.append(paragraph)
+        else:
+            result.extend(s for s in SENTENCE_RE.split(paragraph) if s)
+    return result
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(" ".join(text.split()).lower().encode("utf-8")).hexdigest()[:32]
+
+
+def _parse(body: str):
+    """Segments of the body and the hash of its active markup (None when there is none)."""
+    text, active = guard_extract.extract(body or "")
+    # Exact bytes, not _hash: case and whitespace matter in scripts
+    active_hash = hashlib.sha256("\n".join(active).encode("utf-8")).hexdigest()[:32] if active else None
+    return segments(text), active_hash
+
+
+def _load(content_type, content_id):
+    return ModerationFingerprint.query.filter_by(
+        content_type=content_type, content_id=content_id
+    ).first()
+
+
+def remember(content_type, content_id, title, body):
+    """Store the fingerprint of approved text (added to the session, not committed)."""
+
+    fp = _load(content_type, content_id)
+    if fp is None:
+        fp = ModerationFingerprint(content_type=content_type, content_id=content_id)
+        db.session.add(fp)
+
+    fp.prompt_version = llm_guard.PROMPT_VERSION
+    parts, active_hash = _parse(body)
+    fp.title_hash = _hash(llm_guard.normalize_text(title or ""))
+    fp.segment_hashes = json.dumps([_hash(s) for s in parts])
+    fp.active_hash = active_hash
+    fp.updated_at = datetime.utcnow()
+
+
+def forget(content_type, content_ids):
+    """Drop the fingerprints of deleted content (ids can be reused)."""
+
+    if not content_ids:
+        return
+    ModerationFingerprint.query.filter(
+        ModerationFingerprint.content_type == content_type,
+        ModerationFingerprint.content_id.in_(list(content_ids)),
+    ).delete(synchronize_session=False)
+
+
+def _changed_segments(parts, approved_hashes):
+    """Indexes of the segments that weren't approved in this place.
+
+    A segment counts as changed when it is new, or when it is approved text
+    that now comes before something it used to follow (moved or repeated):
+    putting approved sentences in another order can say something new. With
+    the context around it, every new neighbour of a moved segment is checked.
+    """
+
+    positions = {}
+    for pos, h in enumerate(approved_hashes):
+        positions.setdefault(h, []).append(pos)
+
+    changed = []
+    last = -1
+    for i, part in enumerate(parts):
+        seen = positions.get(_hash(part), ())
+        n = bisect.bisect_right(seen, last)
+        if n < len(seen):
+            last = seen[n]
+        else:
+            changed.append(i)
+    return changed
+
+
+def edit_check(content_type, content_id, title, body, context):
+    """TextCheck for an edit that only contains what changed since the last approved version.
+
+    Returns None when nothing new was added (unchanged or only deletions), and a
+    check of the full text when there is no usable fingerprint or when scripts
+    or event handlers in the markup changed. Approved segments in a new order
+    count as changed.
+    """
+
+    fp = _load(content_type, content_id)
+    if fp is None or fp.prompt_version != llm_guard.PROMPT_VERSION:
+        return TextCheck(title=title, body=body, context=context)
+
+    parts, active_hash = _parse(body)
+    if active_hash is not None and active_hash != fp.active_hash:
+        return TextCheck(title=title, body=body, context=context)
+
+    changed = _changed_segments(parts, json.loads(fp.segment_hashes))
+    title_changed = _hash(llm_guard.normalize_text(title or "")) != fp.title_hash
+
+    if not changed and not title_changed:
+        return None
+
+    # Changed segments plus a little unchanged context around them
+    keep = sorted({
+        j
+        for i in changed
+        for j in range(i - CONTEXT_SEGMENTS, i + CONTEXT_SEGMENTS + 1)
+        if 0 <= j < len(parts)
+    })
+    pieces = []
+    for n, j in enumerate(keep):
+        if n and j != keep[n - 1] + 1:
+            pieces.append(GAP)
+        elif n:
+            pieces.append("\n\n")
+        pieces.append(parts[j])
+
+    return TextCheck(
+        title=title if title_changed else "",
+        body="".join(pieces),
+        context=context,
+    )
+
+
+def approved(check) -> bool:
+    """True when a text check passed cleanly (or was skipped), so its text may be fingerprinted."""
+    if check is None:
+        return True
+    decision = check.decision
+    return (
+        decision is not None
+        and decision.get("action") in ("allow", "warn")
+        and not decision.get("fallback")
+    )
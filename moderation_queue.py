@@ -0,0 +1,297 @@
+import os
+import shutil
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import update, or_
+
+from guard_transport import GuardUnavailable
+import moderation_diff
+from moderation import TextCheck, ImageCheck, moderate, unique_filename
+from models import db, BlogPost, DialogueThread, DialogueComment, OpinionPoll, ModerationJob
+
+
+log = logging.getLogger(__name__)
+
+# Give up on a job after this many failed LLM calls
+MAX_ATTEMPTS = 3
+
+# Seconds to wait before retrying a failed job, multiplied by the attempt number
+RETRY_DELAY = 30
+
+# Seconds between polls of the job table when no one wakes the workers
+POLL_INTERVAL = 2.0
+
+# A job still running this many seconds after it was claimed belongs to a
+# worker that died; it is queued again. Well above the longest guard call
+# with all its retries, so a job of a live worker is never taken over.
+JOB_TIMEOUT = int(os.getenv("MODERATION_JOB_TIMEOUT", "600"))
+
+# Content type -> (model, title attribute, body attribute)
+CONTENT_TYPES = {
+    "blog_post": (BlogPost, "title", "content"),
+    "dialogue_thread": (DialogueThread, "title", "body"),
+    "dialogue_comment": (DialogueComment, None, "body"),
+    "opinion_poll": (OpinionPoll, "question", "description"),
+}
+
+# Guard context used for the thumbnail of each content type
+IMAGE_CONTEXTS = {
+    "blog_post": "blog_thumbnail",
+    "dialogue_thread": "dialogue_thumbnail",
+    "opinion_poll": "opinion_thumbnail",
+}
+
+# Static folder of the thumbnails of each content type. Pending thumbnails wait
+# in MODERATION_QUARANTINE_FOLDER (not public) and only move here when approved
+THUMB_FOLDERS = {
+    "blog_post": "blog_thumbs",
+    "dialogue_thread": "dialogue_thumbs",
+    "opinion_poll": "opinion_thumbs",
+}
+
+# Worst verdict wins when text and image are both checked
+_STATUS_ORDER = ["approved", "review", "blocked"]
+
+_wakeup = threading.Event()
+_stop = threading.Event()
+_workers = []
+
+
+def enqueue(content_type, content_id, context, image_path=None):
+    """Add a moderation job to the session, committed together with the content."""
+
+    job = ModerationJob(
+        content_type=content_type,
+        content_id=content_id,
+        context=context,
+        image_path=image_path,
+        status="queued",
+    )
+    db.session.add(job)
+    return job
+
+
+def quarantine(file):
+    """Save an upload of pending content under a unique name in the quarantine folder.
+    Returns the path to pass to enqueue()."""
+
+    folder = current_app.config["MODERATION_QUARANTINE_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, unique_filename(file.filename))
+    file.save(path)
+    return path
+
+
+def _discard_image(job):
+    if job.image_path:
+        try:
+            os.remove(job.image_path)
+        except OSError:
+            pass
+
+
+def _publish_image(job, item):
+    """Move an approved thumbnail from quarantine into its static folder."""
+
+    filename = os.path.basename(job.image_path)
+    folder = os.path.join(current_app.static_folder, THUMB_FOLDERS[job.content_type])
+    shutil.move(job.image_path, os.path.join(folder, filename))
+    item.thumbnail_image = filename
+
+
+def _give_up(job):
+    """Reject the content of a job that keeps failing, so it doesn't stay pending forever.
+    The author sees it as blocked ("Tegengehouden") and can post it again."""
+
+    model = CONTENT_TYPES[job.content_type][0]
+    item = db.session.get(model, job.content_id)
+    if item is not None and item.moderation_status == "pending":
+        item.moderation_status = "blocked"
+    _discard_image(job)
+    job.status = "failed"
+    log.error("Moderation job %s failed %s times, %s %s rejected: %s",
+              job.id, job.attempts, job.content_type, job.content_id, job.last_error)
+
+
+def notify():
+    """Wake up an idle worker after new jobs have been committed."""
+    _wakeup.set()
+
+
+def _status_for(decision):
+    action = decision.get("action")
+    if action == "block":
+        return "blocked"
+    if action == "review":
+        return "review"
+    return "approved"
+
+
+def _claim_next():
+    """Mark the oldest queued job as running. Returns its id, 0 if another worker
+    claimed it first, or None if the queue is empty."""
+
+    job_id = (
+        db.session.query(ModerationJob.id)
+        .filter(
+            ModerationJob.status == "queued",
+            or_(ModerationJob.run_after.is_(None), ModerationJob.run_after <= datetime.utcnow()),
+        )
+        .order_by(ModerationJob.id)
+        .limit(1)
+        .scalar()
+    )
+    if job_id is None:
+        return None
+
+    claimed = db.session.execute(
+        update(ModerationJob)
+        .where(ModerationJob.id == job_id, ModerationJob.status == "queued")
+        .values(status="running", attempts=ModerationJob.attempts + 1, updated_at=datetime.utcnow())
+    )
+    db.session.commit()
+    return job_id if claimed.rowcount == 1 else 0
+
+
+def run_job(job_id):
+    """Moderate the content of one job and update its moderation status."""
+
+    job = db.session.get(ModerationJob, job_id)
+    model, title_attr, body_attr = CONTENT_TYPES[job.content_type]
+    item = db.session.get(model, job.content_id)
+
+    # Content was deleted while it was waiting
+    if item is None:
+        _discard_image(job)
+        job.status = "done"
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        return
+
+    try:
+        checks = []
+
+        # Image content moderation via LLM guard
+        image_check = None
+        if job.image_path and os.path.exists(job.image_path):
+            image_check = ImageCheck(
+                job.image_path, context=IMAGE_CONTEXTS.get(job.content_type, "image_upload")
+            )
+            checks.append(image_check)
+
+        # Text content moderation via LLM guard; edits only check what changed
+        title = (getattr(item, title_attr) if title_attr else "") or ""
+        body = getattr(item, body_attr) or ""
+        if job.context.endswith("_edit"):
+            text_check = moderation_diff.edit_check(job.content_type, item.id, title, body, job.context)
+        else:
+            text_check = TextCheck(title=title, body=body, context=job.context)
+        if text_check is not None:
+            checks.append(text_check)
+
+        moderate(checks)
+
+        # A fallback verdict isn't final: retry the job once the LLM is back
+        if any(c.decision is not None and c.decision.get("fallback") for c in checks):
+            raise GuardUnavailable("moderation LLM unavailable")
+
+        status = max(
+            (_status_for(c.decision) for c in checks if c.decision is not None),
+            key=_STATUS_ORDER.index,
+            default="approved",
+        )
+
+        # The thumbnail goes public only when the image itself was allowed
+        if image_check is not None:
+            if status != "blocked" and image_check.approved:
+                _publish_image(job, item)
+            else:
+                _discard_image(job)
+                item.thumbnail_image = None
+
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(ModerationJob, job_id)
+        job.last_error = repr(e)
+        job.updated_at = datetime.utcnow()
+        if job.attempts >= MAX_ATTEMPTS:
+            _give_up(job)
+        else:
+            job.status = "queued"
+            job.run_after = job.updated_at + timedelta(seconds=RETRY_DELAY * job.attempts)
+        db.session.commit()
+        log.warning("Moderation job %s failed (attempt %s): %r", job_id, job.attempts, e)
+        return
+
+    item.moderation_status = status
+    if status == "approved" and moderation_diff.approved(text_check):
+        moderation_diff.remember(job.content_type, item.id, title, body)
+    job.status = "done"
+    job.last_error = None
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _worker_loop(app):
+    with app.app_context():
+        while not _stop.is_set():
+            try:
+                job_id = _claim_next()
+                if job_id:
+                    run_job(job_id)
+            except Exception:
+                log.exception("Moderation worker error")
+                db.session.rollback()
+                job_id = None
+            finally:
+                db.session.remove()
+
+            # Sleep until new work arrives when the queue is empty
+            if job_id is None:
+                try:
+                    recover_jobs()
+                except Exception:
+                    log.exception("Moderation job recovery failed")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                _wakeup.wait(POLL_INTERVAL)
+                _wakeup.clear()
+
+
+def recover_jobs():
+    """Requeue jobs that were claimed more than JOB_TIMEOUT seconds ago and never
+    finished, because their worker stopped. Returns the number of jobs."""
+
+    stale = db.session.execute(
+        update(ModerationJob)
+        .where(
+            ModerationJob.status == "running",
+            ModerationJob.updated_at < datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT),
+        )
+        .values(status="queued", updated_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    if stale:
+        log.warning("Requeued %d stale moderation job(s)", stale)
+    return stale
+
+
+def start_workers(app, count=2):
+    """Start the background moderation worker threads (once per process)."""
+
+    if _workers:
+        return
+
+    with app.app_context():
+        recover_jobs()
+
+    for i in range(count):
+        t = threading.Thread(
+            target=_worker_loop, args=(app,), name=f"moderation-worker-{i}", daemon=True
+        )
+        t.start()
+        _workers.append(t)
@@ -0,0 +1,131 @@
+import json
+import base64
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from flask import abort
+from sqlalchemy import and_, or_
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values) -> str:
+    """Sort key of a row -> opaque, URL-safe cursor."""
+    data = [["dt", v.isoformat()] if isinstance(v, datetime) else ["v", v] for v in values]
+    raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _matches(value, expected) -> bool:
+    """Does a cursor value fit a column of python type ``expected`` (None: unknown)?"""
+    if isinstance(value, bool):
+        return False
+    if expected is datetime:
+        return isinstance(value, datetime)
+    if expected is float:
+        return isinstance(value, (int, float))
+    if expected in (int, str):
+        return isinstance(value, expected)
+    return isinstance(value, (int, float, str))
+
+
+def _python_type(expr):
+    try:
+        return expr.type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def decode_cursor(cursor: str, order):
+    """Cursor -> list of sort key values for ``order``, or None when it is missing.
+
+    A cursor that doesn't decode, or whose values don't match the length and
+    column types of ``order``, is a bad request (400), not a query error.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        if not isinstance(data, list) or len(data) != len(order):
+            raise ValueError("wrong length")
+        values = []
+        for item in data:
+            if not isinstance(item, list) or len(item) != 2 or item[0] not in ("dt", "v"):
+                raise ValueError("bad value")
+            tag, value = item
+            values.append(datetime.fromisoformat(value) if tag == "dt" else value)
+    except (ValueError, TypeError):
+        abort(400)
+    if not all(_matches(v, _python_type(expr)) for v, (expr, _) in zip(values, order)):
+        abort(400)
+    return values
+
+
+def _after(order, values):
+    """Rows that come after ``values`` in ``order`` (a list of (expression, descending))."""
+    clauses = []
+    for i, (expr, desc) in enumerate(order):
+        equal = [order[j][0] == values[j] for j in range(i)]
+        beyond = expr < values[i] if desc else expr > values[i]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+
+def paginate(query, order, key, after=None, before=None, per_page=20) -> KeysetPage:
+    """Keyset pagination of ``query``.
+
+    ``order`` is a list of (expression, descending) pairs that ends in a unique
+    column; ``key(item)`` returns the same values for a loaded row. ``after``
+    and ``before`` are cursors from an earlier page.
+    """
+
+    after_values = decode_cursor(after, order)
+    before_values = None if after_values else decode_cursor(before, order)
+
+    if before_values is not None:
+        # Walk backwards from the cursor, then flip the rows back
+        reverse = [(expr, not desc) for expr, desc in order]
+        rows = (
+            query.filter(_after(reverse, before_values))
+            .order_by(*[expr.desc() if desc else expr.asc() for expr, desc in reverse])
+            .limit(per_page + 1)
+            .all()
+        )
+        has_more = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        return KeysetPage(
+            items=items,
+            next_cursor=encode_cursor(key(items[-1])) if items else None,
+            prev_cursor=encode_cursor(key(items[0])) if items and has_more else None,
+        )
+
+    if after_values is not None:
+        query = query.filter(_after(order, after_values))
+
+    rows = (
+        query.order_by(*[expr.desc() if desc else expr.asc() for expr, desc in order])
+        .limit(per_page + 1)
+        .all()
+    )
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    return KeysetPage(
+        items=items,
+        next_cursor=encode_cursor(key(items[-1])) if items and has_more else None,
+        prev_cursor=encode_cursor(key(items[0])) if items and after_values is not None else None,
+    )
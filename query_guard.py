@@ -0,0 +1,140 @@
+import os
+import logging
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+log = logging.getLogger(__name__)
+
+
+class QueryLimitExceeded(Exception):
+    """A request ran more SQL statements than QUERY_LIMIT (usually an N+1 in a template)."""
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "query_count" in g:
+        g.query_count += 1
+
+
+def init_app(app):
+    """Count SQL statements per request and complain above app.config["QUERY_LIMIT"].
+
+    QUERY_LIMIT = 0 only counts. In testing (app.testing or QUERY_LIMIT_RAISE=1)
+    a request over the limit raises QueryLimitExceeded, otherwise it is logged.
+    The count is returned in the X-Query-Count header in debug/testing.
+    """
+
+    app.config.setdefault("QUERY_LIMIT", int(os.getenv("QUERY_LIMIT", "0")))
+    app.config.setdefault("QUERY_LIMIT_RAISE", os.getenv("QUERY_LIMIT_RAISE", "0") == "1")
+
+    if not event.contains(Engine, "before_cursor_execute", _count_query):
+        event.listen(Engine, "before_cursor_execute", _count_query)
+
+    @app.before_request
+    def _start_query_count():
+        g.query_count = 0
+
+    @app.after_request
+    def _check_query_count(response):
+        count = g.get("query_count", 0)
+        limit = app.config["QUERY_LIMIT"]
+
+        if app.debug or app.testing:
+            response.headers["X-Query-Count"] = str(count)
+
+        if limit and count > limit:
+            message = f"{request.method} {request.path} ran {count} queries (limit {limit})"
+            if app.testing or app.config["QUERY_LIMIT_RAISE"]:
+                raise QueryLimitExceeded(message)
+            log.warning(message)
+
+        return response
+
+
+def _seed(db, models, rows):
+    """Users, posts, threads with comments and polls, ``rows`` of each."""
+    from werkzeug.security import generate_password_hash
+
+    roles = models.Role.query.all()
+    pw = generate_password_hash("bench")
+    users = [
+        models.User(username=f"bench{i}", first_name="Bench", last_name=str(i), hash=pw, roles=roles[:1 + i % len(roles)])
+        for i in range(rows)
+    ]
+    db.session.add_all(users)
+    db.session.flush()
+
+    admin = users[-1]
+    admin.roles = roles
+
+    thread = None
+    for i in range(rows):
+        author = users[i % len(users)]
+        t = models.DialogueThread(title=f"Dialoog {i}", body="<p>tekst</p>", author_id=author.id)
+        db.session.add(t)
+        db.session.flush()
+        thread = thread or t
+        db.session.add(models.BlogPost(title=f"Blog {i}", content="<p>tekst</p>", author_id=author.id,
+                                       dialogue_thread_id=t.id if i % 2 else None))
+        db.session.add(models.OpinionPoll(question=f"Vraag {i}?", description="", author_id=author.id))
+
+    # All comments on the first thread, every third one a reply
+    parent = None
+    for i in range(rows):
+        c = models.DialogueComment(body=f"Reactie {i}", thread_id=thread.id,
+                                   author_id=users[i % len(users)].id,
+                                   parent_id=parent.id if parent is not None and i % 3 == 0 else None)
+        db.session.add(c)
+        db.session.flush()
+        if i % 3 == 1:
+            parent = c
+
+    db.session.commit()
+    return admin.username, thread.id
+
+
+def _benchmark(sizes=(10, 100, 1000)):
+    """Queries per listing page at several table sizes (admin user logged in)."""
+    import sys
+    import tempfile
+    import importlib
+
+    workdir = tempfile.mkdtemp(prefix="querybench")
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["QUERY_LIMIT"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+    app_module = importlib.import_module("app")
+    import models
+
+    app, db = app_module.app, models.db
+    app.config["TESTING"] = True
+    pages = ["/blog", "/dialoog", "/opinie", "/admin", "/dialoog/{thread}", "/blog/{post}"]
+
+    print(f"{'rows':>6} " + " ".join(f"{p:>16}" for p in pages))
+    for rows in sizes:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            for name in ["user", "author", "admin", "superadmin"]:
+                db.session.add(models.Role(name=name))
+            db.session.commit()
+            username, thread_id = _seed(db, models, rows)
+            post_id = models.BlogPost.query.first().id
+
+        client = app.test_client()
+        client.post("/login", data={"username": username, "password": "bench"})
+        counts = []
+        for page in pages:
+            response = client.get(page.format(thread=thread_id, post=post_id))
+            assert response.status_code == 200, (page, response.status_code)
+            counts.append(response.headers.get("X-Query-Count", "?"))
+        print(f"{rows:>6} " + " ".join(f"{c:>16}" for c in counts))
+
+
+if __name__ == "__main__":
+    _benchmark()
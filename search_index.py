@@ -0,0 +1,445 @@
+import os
+import re
+import logging
+
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, event, func, inspect, text, select, Float, Integer
+
+import guard_extract
+from models import db, User, BlogPost, DialogueThread, OpinionPoll
+
+
+log = logging.getLogger(__name__)
+
+
+# What is searchable: kind -> (model, title column, body column). Bodies are
+# HTML from TinyMCE and are indexed as plain text. Users are indexed too (for
+# the admin search) with their full name as "body".
+KINDS = {
+    "blog_post": (BlogPost, "title", "content"),
+    "dialogue_thread": (DialogueThread, "title", "body"),
+    "opinion_poll": (OpinionPoll, "question", "description"),
+}
+
+# FTS5 rowid = ref_id * 8 + kind code, so one document can be replaced by rowid
+# (the UNINDEXED kind/ref_id columns can't be looked up without a full scan)
+KIND_CODES = {"blog_post": 1, "dialogue_thread": 2, "opinion_poll": 3, "user": 4}
+
+# Column weights: title, body, author
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 4.0
+AUTHOR_WEIGHT = 2.0
+
+# Words around the best match in a snippet
+SNIPPET_WORDS = int(os.getenv("SEARCH_SNIPPET_WORDS", "24"))
+
+# Highlight markers in raw snippets; the text is escaped before they become <mark>
+HL_START, HL_END = "\x02", "\x03"
+
+# SQLite has no Dutch stemmer in FTS5 (only the English "porter" tokenizer), so
+# every search word is matched as a prefix instead: "accountant" also finds
+# "accountants" and "accountantscontrole". PostgreSQL uses the 'dutch' config.
+SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        kind UNINDEXED, ref_id UNINDEXED, title, body, author,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+]
+
+POSTGRES_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS search_index (
+        kind VARCHAR(30) NOT NULL,
+        ref_id INTEGER NOT NULL,
+        title TEXT,
+        body TEXT,
+        author TEXT,
+        tsv tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('dutch', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('dutch', coalesce(body, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(author, '')), 'C')
+        ) STORED,
+        PRIMARY KEY (kind, ref_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_search_index_tsv ON search_index USING GIN (tsv)",
+]
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# "sqlite" / "postgresql" once init() found a usable index, None = ILIKE fallback
+_backend = None
+
+
+def _detect(bind):
+    name = bind.dialect.name
+    if name == "postgresql":
+        return name
+    if name == "sqlite":
+        with bind.connect() as conn:
+            options = {row[0] for row in conn.execute(text("PRAGMA compile_options"))}
+        if "ENABLE_FTS5" in options:
+            return name
+        log.warning("SQLite is built without FTS5, search falls back to ILIKE")
+    return None
+
+
+def init(bind=None):
+    """Create the search index if needed (filled on first creation). Returns the backend or None."""
+    global _backend
+
+    bind = bind if bind is not None else db.engine
+    backend = _detect(bind)
+    if backend is None:
+        _backend = None
+        return None
+
+    existed = inspect(bind).has_table("search_index")
+    with bind.begin() as conn:
+        for ddl in SQLITE_DDL if backend == "sqlite" else POSTGRES_DDL:
+            conn.execute(text(ddl))
+    _backend = backend
+
+    if not existed:
+        with bind.begin() as conn:
+            rebuild(conn)
+    return backend
+
+
+def enabled():
+    return _backend is not None
+
+
+def _plain(html):
+    return " ".join(guard_extract.html_to_text(html or "", active=False).split())
+
+
+def _rowid(kind, ref_id):
+    return ref_id * 8 + KIND_CODES[kind]
+
+
+def _write(conn, docs):
+    """Insert documents ({"kind", "ref_id", "title", "body", "author"} dicts) that are not in the index yet."""
+    if not docs:
+        return
+    if _backend == "sqlite":
+        for doc in docs:
+            doc["rowid"] = _rowid(doc["kind"], doc["ref_id"])
+        conn.execute(text(
+            "INSERT INTO search_index (rowid, kind, ref_id, title, body, author) "
+            "VALUES (:rowid, :kind, :ref_id, :title, :body, :author)"
+        ), docs)
+    elif _backend == "postgresql":
+        conn.execute(text(
+            "INSERT INTO search_index (kind, ref_id, title, body, author) "
+            "VALUES (:kind, :ref_id, :title, :body, :author) "
+            "ON CONFLICT (kind, ref_id) DO UPDATE SET "
+            "title = EXCLUDED.title, body = EXCLUDED.body, author = EXCLUDED.author"
+        ), docs)
+
+
+def remove(conn, kind, ref_ids):
+    """Drop documents from the index."""
+    ref_ids = list(ref_ids)
+    if not ref_ids or _backend is None:
+        return
+    if _backend == "sqlite":
+        conn.execute(
+            text("DELETE FROM search_index WHERE rowid = :rowid"),
+            [{"rowid": _rowid(kind, i)} for i in ref_ids],
+        )
+    else:
+        conn.execute(
+            text("DELETE FROM search_index WHERE kind = :kind AND ref_id = :ref_id"),
+            [{"kind": kind, "ref_id": i} for i in ref_ids],
+        )
+
+
+def _documents(conn, kind, where=None):
+    """Index documents for the rows of ``kind`` matching ``where``, read straight from the database."""
+    users = User.__table__
+
+    if kind == "user":
+        stmt = select(users.c.id, users.c.username, users.c.first_name, users.c.last_name)
+        if where is not None:
+            stmt = stmt.where(where)
+        for row in conn.execute(stmt):
+            full_name = " ".join(p for p in (row.first_name, row.last_name) if p)
+            yield {"kind": kind, "ref_id": row.id, "title": row.username, "body": full_name, "author": ""}
+        return
+
+    model, title_attr, body_attr = KINDS[kind]
+    table = model.__table__
+    stmt = (
+        select(table.c.id, table.c[title_attr], table.c[body_attr],
+               users.c.username, users.c.first_name, users.c.last_name)
+        .select_from(table.outerjoin(users, users.c.id == table.c.author_id))
+    )
+    if where is not None:
+        stmt = stmt.where(where)
+    for row in conn.execute(stmt):
+        yield {
+            "kind": kind,
+            "ref_id": row[0],
+            "title": row[1] or "",
+            "body": _plain(row[2]),
+            "author": " ".join(p for p in row[3:6] if p),
+        }
+
+
+def reindex(conn, kind, where):
+    """Replace the documents of ``kind`` matching ``where`` (a condition on its table)."""
+    if _backend is None:
+        return
+    docs = list(_documents(conn, kind, where))
+    remove(conn, kind, [d["ref_id"] for d in docs])
+    _write(conn, docs)
+
+
+def rebuild(conn, batch_size=1000):
+    """Empty the index and fill it from the content tables. Returns the number of documents."""
+    if _backend is None:
+        return 0
+    conn.execute(text("DELETE FROM search_index"))
+    for kind in list(KINDS) + ["user"]:
+        batch = []
+        for doc in _documents(conn, kind):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                _write(conn, batch)
+                batch = []
+        _write(conn, batch)
+    return conn.execute(text("SELECT COUNT(*) FROM search_index")).scalar()
+
+
+def _words(q):
+    return [w.lower() for w in WORD_RE.findall(q or "")][:16]
+
+
+def matches(kind, q):
+    """Subquery (ref_id, rank) of documents of ``kind`` matching ``q``.
+
+    Lower rank is better on both backends. Returns None when there is no index
+    or nothing to search for; callers then use the ILIKE query.
+    """
+    words = _words(q)
+    if _backend is None or not words:
+        return None
+
+    if _backend == "sqlite":
+        # Every word as a quoted prefix term, implicitly AND-ed
+        stmt = text(
+            # kind and ref_id come from the rowid: reading the stored columns
+            # of every match would cost more than the ranking itself
+            "SELECT rowid / 8 AS ref_id, bm25(search_index, 0, 0, :wt, :wb, :wa) AS rank "
+            "FROM search_index WHERE search_index MATCH :match AND rowid % 8 = :code"
+        ).bindparams(
+            match=_sqlite_match(words), code=KIND_CODES[kind],
+            wt=TITLE_WEIGHT, wb=BODY_WEIGHT, wa=AUTHOR_WEIGHT,
+        )
+    else:
+        stmt = text(
+            "SELECT ref_id, -ts_rank_cd(CAST(:weights AS real[]), tsv, query) AS rank "
+            "FROM search_index, to_tsquery('dutch', :match) AS query "
+            "WHERE kind = :kind AND tsv @@ query"
+        ).bindparams(
+            match=_postgres_match(words), kind=kind,
+            # ts_rank weights are {D, C, B, A}, between 0 and 1
+            weights=[0.1, AUTHOR_WEIGHT / 10, BODY_WEIGHT / 10, TITLE_WEIGHT / 10],
+        )
+
+    return stmt.columns(ref_id=Integer, rank=Float).subquery("hits")
+
+
+def snippets(kind, q, ref_ids):
+    """{ref_id: highlighted snippet} for the documents on one result page."""
+    words = _words(q)
+    ref_ids = list(ref_ids)
+    if _backend is None or not words or not ref_ids:
+        return {}
+
+    # Snippets are expensive, so they are only made for the page, not for every match
+    if _backend == "sqlite":
+        rows = db.session.execute(text(
+            "SELECT rowid / 8, snippet(search_index, 3, :hs, :he, '…', :words) "
+            "FROM search_index WHERE search_index MATCH :match AND rowid IN :rowids"
+        ).bindparams(bindparam("rowids", expanding=True)), {
+            "match": _sqlite_match(words), "rowids": [_rowid(kind, i) for i in ref_ids],
+            "hs": HL_START, "he": HL_END, "words": SNIPPET_WORDS,
+        })
+    else:
+        rows = db.session.execute(text(
+            "SELECT ref_id, ts_headline('dutch', body, "
+            "to_tsquery('dutch', :match), :options) "
+            "FROM search_index WHERE kind = :kind AND ref_id IN :ref_ids"
+        ).bindparams(bindparam("ref_ids", expanding=True)), {
+            "match": _postgres_match(words), "kind": kind, "ref_ids": ref_ids,
+            "options": f"StartSel={HL_START}, StopSel={HL_END}, MaxWords={SNIPPET_WORDS}, MinWords=8",
+        })
+    return {ref_id: highlight(snippet) for ref_id, snippet in rows}
+
+
+def _sqlite_match(words):
+    return " ".join(f'"{w}"*' for w in words)
+
+
+def _postgres_match(words):
+    return " & ".join(f"{w}:*" for w in words)
+
+
+def highlight(snippet):
+    """Raw snippet -> safe HTML with <mark> around the matched words."""
+    if not snippet:
+        return Markup("")
+    html = str(escape(snippet))
+    return Markup(html.replace(HL_START, "<mark>").replace(HL_END, "</mark>"))
+
+
+# Index maintenance. These run inside the flush, on the same connection, so
+# the index commits or rolls back together with the content. Bulk
+# Query.delete()/update() calls have to call remove()/upsert() themselves.
+def _watch(kind, model, title_attr, body_attr):
+
+    def _changed(item):
+        state = db.inspect(item)
+        return any(
+            state.attrs[name].history.has_changes()
+            for name in (title_attr, body_attr, "author_id")
+        )
+
+    @event.listens_for(model, "after_insert")
+    def _inserted(mapper, connection, item):
+        reindex(connection, kind, model.__table__.c.id == item.id)
+
+    @event.listens_for(model, "after_update")
+    def _updated(mapper, connection, item):
+        if _backend is not None and _changed(item):
+            reindex(connection, kind, model.__table__.c.id == item.id)
+
+    @event.listens_for(model, "after_delete")
+    def _deleted(mapper, connection, item):
+        remove(connection, kind, [item.id])
+
+
+for _kind, (_model, _title, _body) in KINDS.items():
+    _watch(_kind, _model, _title, _body)
+
+
+@event.listens_for(User, "after_insert")
+def _user_inserted(mapper, connection, user):
+    reindex(connection, "user", User.__table__.c.id == user.id)
+
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, user):
+    if _backend is None:
+        return
+    state = db.inspect(user)
+    if not any(state.attrs[n].history.has_changes() for n in ("username", "first_name", "last_name")):
+        return
+
+    # The name is part of every document the user wrote
+    reindex(connection, "user", User.__table__.c.id == user.id)
+    for kind, (model, _, _) in KINDS.items():
+        reindex(connection, kind, model.__table__.c.author_id == user.id)
+
+
+@event.listens_for(User, "after_delete")
+def _user_deleted(mapper, connection, user):
+    remove(connection, "user", [user.id])
+
+
+# Benchmark vocabulary, most frequent first (Zipf distributed)
+WORDS = (
+    "de het een en van accountant controle jaarrekening audit fraude continuïteit "
+    "materialiteit verslaggeving boekhouding regelgeving toezicht opleiding kantoor "
+    "klant rapportage risico steekproef belasting adviseur samenwerking duurzaamheid"
+).split() + [f"term{i}" for i in range(20_000)]
+
+
+def _benchmark(docs=100_000, repeat=5):
+    """ILIKE '%q%' against the FTS index on a SQLite database with ``docs`` blog posts.
+
+    Words that occur in a large part of all documents stay expensive: every
+    match has to be ranked before the first page is known.
+    """
+    import random
+    import tempfile
+    import time
+    from flask import Flask
+
+    random.seed(1)
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    workdir = tempfile.mkdtemp(prefix="searchbench")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{workdir}/bench.db"
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        users = User.__table__
+        posts = BlogPost.__table__
+        with db.engine.begin() as conn:
+            conn.execute(users.insert(), [
+                {"id": i + 1, "username": f"user{i}", "first_name": "Jan", "last_name": f"Jansen{i}", "hash": "x"}
+                for i in range(200)
+            ])
+            for start in range(0, docs, 10_000):
+                conn.execute(posts.insert(), [
+                    {
+                        "title": " ".join(random.choices(WORDS, weights, k=6)).capitalize(),
+                        "content": "<p>" + " ".join(random.choices(WORDS, weights, k=150)) + "</p>",
+                        "author_id": 1 + i % 200,
+                    }
+                    for i in range(start, min(start + 10_000, docs))
+                ])
+
+        started = time.perf_counter()
+        init(db.engine)
+        print(f"{docs} documents, index built in {time.perf_counter() - started:.1f}s")
+
+        def ilike(q):
+            like = f"%{q}%"
+            return db.session.execute(
+                select(posts.c.id)
+                .select_from(posts.join(users, users.c.id == posts.c.author_id))
+                .where(posts.c.title.ilike(like) | posts.c.content.ilike(like)
+                       | users.c.username.ilike(like) | users.c.first_name.ilike(like)
+                       | users.c.last_name.ilike(like))
+                .order_by(posts.c.created_at.desc(), posts.c.id.desc())
+                .limit(20)
+            ).all()
+
+        def fts(q):
+            hits = matches("blog_post", q)
+            rows = db.session.execute(
+                select(posts.c.id, hits.c.rank)
+                .join(hits, hits.c.ref_id == posts.c.id)
+                .order_by(hits.c.rank, posts.c.id.desc())
+                .limit(20)
+            ).all()
+            return rows, snippets("blog_post", q, [r.id for r in rows])
+
+        print(f"{'query':<24} {'matches':>8} {'ilike ms':>10} {'fts ms':>10}")
+        for q in ("term15000", "term500", "duurzaamheid", "jaarrekening fraude", "accountant", "bestaatniet"):
+            hits = matches("blog_post", q)
+            found = db.session.execute(select(func.count()).select_from(hits)).scalar()
+            timings = []
+            for search in (ilike, fts):
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    search(q)
+                timings.append((time.perf_counter() - started) / repeat * 1000)
+            print(f"{q:<24} {found:>8} {timings[0]:>10.1f} {timings[1]:>10.1f}")
+
+        with db.engine.begin() as conn:
+            started = time.perf_counter()
+            for i in range(1, 101):
+                reindex(conn, "blog_post", posts.c.id == i)
+            print(f"re-index one post: {(time.perf_counter() - started) * 10:.2f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -25,40 +25,65 @@ document.addEventListener("DOMContentLoaded", function () {
 document.addEventListener("DOMContentLoaded", function () {
     const uploadUrl = document.body.dataset.uploadImageUrl || "";
 
+    const editorConfig = {
+        plugins: 'link lists image media code emoticons',
+        menubar: false,
+        toolbar: 'undo redo | bold italic | bullist numlist | link image media emoticons | code',
+        automatic_uploads: true,
+        images_upload_url: uploadUrl,
+        images_upload_credentials: true,
+        media_live_embeds: true,
+        extended_valid_elements: 'iframe[src|frameborder|style|scrolling|class|width|height|name|align|allowfullscreen]'
+    };
+
     if (window.tinymce && document.querySelector("textarea.comment-editor, textarea.thread-editor")) {
-        tinymce.init({
-            selector: 'textarea.comment-editor, textarea.thread-editor',
-            plugins: 'link lists image media code emoticons',
-            menubar: false,
-            toolbar: 'undo redo | bold italic | bullist numlist | link image media emoticons | code',
-            automatic_uploads: true,
-            images_upload_url: uploadUrl,
-            images_upload_credentials: true,
-            media_live_embeds: true,
-            extended_valid_elements: 'iframe[src|frameborder|style|scrolling|class|width|height|name|align|allowfullscreen]'
-        });
+        tinymce.init(Object.assign({ selector: 'textarea.comment-editor, textarea.thread-editor' }, editorConfig));
     }
 
-    document.querySelectorAll("[data-reply-toggle]").forEach(function (link) {
-        link.addEventListener("click", function (e) {
-            e.preventDefault();
-            const commentId = this.getAttribute("data-reply-toggle");
-            const form = document.getElementById("reply-form-" + commentId);
-            if (form) {
-                form.style.display = form.style.display === "none" ? "block" : "none";
-            }
-        });
+    // Delegated, so comments loaded later through "more" links work too
+    document.addEventListener("click", function (e) {
+        const toggle = e.target.closest("[data-reply-toggle], [data-edit-toggle]");
+        if (!toggle) return;
+        e.preventDefault();
+        const form = toggle.hasAttribute("data-reply-toggle")
+            ? document.getElementById("reply-form-" + toggle.getAttribute("data-reply-toggle"))
+            : document.getElementById("edit-form-" + toggle.getAttribute("data-edit-toggle"));
+        if (form) {
+            form.style.display = form.style.display === "none" ? "block" : "none";
+        }
     });
 
-    document.querySelectorAll("[data-edit-toggle]").forEach(function (link) {
-        link.addEventListener("click", function (e) {
-            e.preventDefault();
-            const commentId = this.getAttribute("data-edit-toggle");
-            const form = document.getElementById("edit-form-" + commentId);
-            if (form) {
-                form.style.display = form.style.display === "none" ? "block" : "none";
-            }
-        });
+    // "More comments/replies": fetch the next part of the thread and put it in place of the link.
+    // Without JavaScript the link opens a page with that part of the thread.
+    document.addEventListener("click", function (e) {
+        const link = e.target.closest("[data-load-more]");
+        if (!link) return;
+        e.preventDefault();
+        if (link.classList.contains("loading")) return;
+        link.classList.add("loading");
+
+        fetch(link.href, { headers: { "Accept": "application/json" }, credentials: "same-origin" })
+            .then(function (response) {
+                if (!response.ok) throw new Error(response.status);
+                return response.json();
+            })
+            .then(function (data) {
+                const holder = document.createElement("div");
+                holder.innerHTML = data.html;
+                const nodes = Array.from(holder.children);
+                link.closest(".comment-more").replaceWith(...nodes);
+
+                if (window.tinymce) {
+                    nodes.forEach(function (node) {
+                        node.querySelectorAll("textarea.comment-editor").forEach(function (textarea) {
+                            tinymce.init(Object.assign({ target: textarea }, editorConfig));
+                        });
+                    });
+                }
+            })
+            .catch(function () {
+                window.location.href = link.href;
+            });
     });
 
     const threadEditForm   = document.getElementById("thread-edit-form");
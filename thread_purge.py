@@ -0,0 +1,159 @@
+from sqlalchemy import delete, select, update
+
+import search_index
+from models import (
+    db, BlogPost, DialogueThread, DialogueThreadVote, DialogueComment,
+    DialogueCommentVote, ModerationFingerprint, OpinionPoll,
+)
+
+
+def purge_thread(thread_id, session=None):
+    """Delete a dialogue thread with everything that hangs off it in a few set-based statements.
+
+    Comment votes, fingerprints and comments go by thread_id (subquery deletes) instead of
+    being loaded and deleted one by one; blog posts and polls made from the thread are
+    unlinked. The caller commits. Returns the number of deleted comments.
+    """
+
+    session = session or db.session
+    comment_ids = select(DialogueComment.id).where(DialogueComment.thread_id == thread_id)
+
+    statements = [
+        # Votes first, they reference the comments and the thread
+        delete(DialogueCommentVote).where(DialogueCommentVote.comment_id.in_(comment_ids)),
+        delete(DialogueThreadVote).where(DialogueThreadVote.thread_id == thread_id),
+
+        # Blog posts and polls the dialogue was started from stay, without the link
+        update(BlogPost).where(BlogPost.dialogue_thread_id == thread_id).values(dialogue_thread_id=None),
+        update(OpinionPoll).where(OpinionPoll.dialogue_thread_id == thread_id).values(dialogue_thread_id=None),
+
+        # Moderation fingerprints of the comments and the thread (ids can be reused)
+        delete(ModerationFingerprint).where(
+            ModerationFingerprint.content_type == "dialogue_comment",
+            ModerationFingerprint.content_id.in_(comment_ids),
+        ),
+        delete(ModerationFingerprint).where(
+            ModerationFingerprint.content_type == "dialogue_thread",
+            ModerationFingerprint.content_id == thread_id,
+        ),
+    ]
+
+    for stmt in statements:
+        session.execute(stmt.execution_options(synchronize_session=False))
+
+    # One statement for all comments: replies and their parents go together
+    deleted = session.execute(
+        delete(DialogueComment)
+        .where(DialogueComment.thread_id == thread_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    session.execute(
+        delete(DialogueThread).where(DialogueThread.id == thread_id).execution_options(synchronize_session=False)
+    )
+
+    # Bulk deletes skip the ORM events, so the search index is updated here
+    search_index.remove(session.connection(), "dialogue_thread", [thread_id])
+
+    # Loaded objects of the thread are gone from the database, drop them from the session
+    for item in list(session.identity_map.values()):
+        if isinstance(item, DialogueThread) and item.id == thread_id:
+            session.expunge(item)
+        elif isinstance(item, DialogueComment) and item.thread_id == thread_id:
+            session.expunge(item)
+    return deleted
+
+
+def _benchmark(comments=50_000, votes_per_comment=2):
+    """Deleting a 50k comment thread: ORM cascade (the old delete_thread) against purge_thread()."""
+    import random
+    import tempfile
+    import time
+    from datetime import datetime, timedelta
+    from flask import Flask
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from models import User
+
+    random.seed(1)
+    workdir = tempfile.mkdtemp(prefix="purgebench")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{workdir}/bench.db"
+    db.init_app(app)
+
+    queries = [0]
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _count(*args):
+        queries[0] += 1
+
+    def build():
+        # One big thread, a small one that has to survive, votes and fingerprints
+        db.drop_all()
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {"id": i + 1, "username": f"u{i}", "hash": "x"} for i in range(votes_per_comment)
+        ])
+        big = DialogueThread(title="Groot", author_id=1)
+        small = DialogueThread(title="Klein", author_id=1)
+        db.session.add_all([big, small])
+        db.session.flush()
+        db.session.add(BlogPost(title="Bron", content="x", author_id=1, dialogue_thread_id=big.id))
+
+        rows, start = [], datetime(2024, 1, 1)
+        for i in range(comments + 100):
+            thread_id = big.id if i < comments else small.id
+            first = 1 if i < comments else comments + 1
+            parent = random.randint(first, i) if i >= first and random.random() > 0.33 else None
+            rows.append({"id": i + 1, "thread_id": thread_id, "author_id": 1, "parent_id": parent,
+                         "body": f"Reactie {i}", "created_at": start + timedelta(seconds=i)})
+        db.session.execute(DialogueComment.__table__.insert(), rows)
+        db.session.execute(DialogueCommentVote.__table__.insert(), [
+            {"user_id": u + 1, "comment_id": r["id"], "value": 1} for r in rows for u in range(votes_per_comment)
+        ])
+        db.session.execute(ModerationFingerprint.__table__.insert(), [
+            {"content_type": "dialogue_comment", "content_id": r["id"], "prompt_version": "v",
+             "title_hash": "", "segment_hashes": "[]"} for r in rows
+        ])
+        db.session.commit()
+        return big.id, small.id
+
+    def old_delete(thread_id):
+        thread = db.session.get(DialogueThread, thread_id)
+        DialogueThreadVote.query.filter_by(thread_id=thread.id).delete(synchronize_session=False)
+        for comment in thread.comments:
+            DialogueCommentVote.query.filter_by(comment_id=comment.id).delete(synchronize_session=False)
+        BlogPost.query.filter_by(dialogue_thread_id=thread.id).update(
+            {BlogPost.dialogue_thread_id: None}, synchronize_session=False)
+        ids = [c.id for c in thread.comments]
+        ModerationFingerprint.query.filter(
+            ModerationFingerprint.content_type == "dialogue_comment",
+            ModerationFingerprint.content_id.in_(ids),
+        ).delete(synchronize_session=False)
+        db.session.delete(thread)
+        db.session.commit()
+
+    def new_delete(thread_id):
+        purge_thread(thread_id)
+        db.session.commit()
+
+    with app.app_context():
+        print(f"thread with {comments} comments, {comments * votes_per_comment} votes, {comments} fingerprints")
+        for label, fn in (("ORM cascade (old)", old_delete), ("purge_thread", new_delete)):
+            big, small = build()
+            db.session.expunge_all()
+            queries[0] = 0
+            started = time.perf_counter()
+            fn(big)
+            elapsed = time.perf_counter() - started
+            print(f"  {label:<20} {elapsed * 1000:>9.1f} ms {queries[0]:>7} queries")
+
+            # Nothing of the big thread is left, the small one is untouched
+            left = db.session.query(DialogueComment.thread_id, db.func.count()).group_by(DialogueComment.thread_id).all()
+            assert left == [(small, 100)], left
+            assert DialogueCommentVote.query.count() == 100 * votes_per_comment
+            assert ModerationFingerprint.query.count() == 100
+            assert BlogPost.query.filter(BlogPost.dialogue_thread_id.isnot(None)).count() == 0
+
+
+if __name__ == "__main__":
+    _benchmark()
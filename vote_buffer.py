@@ -0,0 +1,306 @@
+import os
+import glob
+import time
+import atexit
+import socket
+import logging
+import threading
+
+from sqlalchemy import event, func, or_, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+import hot_rank
+from models import (
+    db, DialogueThread, DialogueThreadVote, DialogueComment,
+    DialogueCommentVote, OpinionPoll, OpinionVote,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+# Write-behind for vote counters. Vote rows are written right away, but the
+# counter rows of the voted targets are only recomputed from the vote
+# tables every VOTE_FLUSH_MS, in one transaction, so a trending poll
+# doesn't take the write lock on its counter row for every single vote.
+# Until then the score/yes/no deltas of committed votes are kept in memory
+# and added to what is read. Because a flush sets the counters instead of
+# adding to them, a rebuild while other processes still hold deltas can't
+# count a vote twice.
+VOTE_FLUSH_MS = int(os.getenv("VOTE_FLUSH_MS", "250"))
+
+# While this process has unflushed targets a marker file exists. A marker
+# of a process that is gone means targets were never recomputed: the
+# counters are then rebuilt from the vote tables at startup.
+STATE_DIR = os.getenv("VOTE_BUFFER_STATE_DIR", os.path.dirname(os.path.abspath(__file__)))
+
+# Counter columns per model, in delta order
+COUNTERS = {
+    DialogueThread: ("score",),
+    DialogueComment: ("score",),
+    OpinionPoll: ("yes_count", "no_count", "score"),
+}
+
+_lock = threading.Lock()
+_pending = {}  # (model, id) -> [delta per counter column]
+_stop = threading.Event()
+_flusher = None
+
+
+def enabled():
+    return _flusher is not None
+
+
+def _marker(pid=None):
+    return os.path.join(STATE_DIR, f"vote_buffer.{socket.gethostname()}.{pid or os.getpid()}.pending")
+
+
+def add(model, target_id, *deltas, session=None):
+    """Buffer counter deltas for one target (same order as COUNTERS[model]).
+
+    The deltas belong to the vote in the session's transaction: they are
+    buffered when it commits and dropped when it rolls back.
+    """
+
+    session = session or db.session
+    _merge(session.info.setdefault("vote_buffer", {}), {(model, target_id): deltas})
+
+
+def _merge(into, batch):
+    for key, deltas in batch.items():
+        current = into.setdefault(key, [0] * len(deltas))
+        for i, delta in enumerate(deltas):
+            current[i] += delta
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    if session.in_nested_transaction():
+        return
+    batch = session.info.pop("vote_buffer", None)
+    if not batch:
+        return
+    with _lock:
+        if not _pending:
+            open(_marker(), "w").close()
+        _merge(_pending, batch)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _after_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("vote_buffer", None)
+
+
+def pending(model, target_id, session=None):
+    """Unflushed deltas of one target, or None. With a session its uncommitted deltas are included."""
+    with _lock:
+        deltas = _pending.get((model, target_id))
+        deltas = list(deltas) if deltas else None
+    own = session.info.get("vote_buffer", {}).get((model, target_id)) if session is not None else None
+    if own:
+        deltas = [a + b for a, b in zip(deltas or [0] * len(own), own)]
+    return deltas
+
+
+def flush():
+    """Recompute the counters of all buffered targets in one transaction. Returns the number of targets."""
+
+    with _lock:
+        batch = dict(_pending)
+        _pending.clear()
+    if not batch:
+        return 0
+
+    try:
+        with db.engine.begin() as conn:
+            for model in COUNTERS:
+                ids = sorted(target_id for m, target_id in batch if m is model)
+                if ids:
+                    table = model.__table__
+                    conn.execute(update(table).where(table.c.id.in_(ids)).values(_counts(table)))
+            hot_rank.refresh(conn, [target_id for model, target_id in batch if model is DialogueThread])
+    except Exception:
+        # Keep the deltas for the next round
+        with _lock:
+            _merge(_pending, batch)
+        raise
+
+    with _lock:
+        if not _pending:
+            try:
+                os.remove(_marker())
+            except FileNotFoundError:
+                pass
+    return len(batch)
+
+
+def _flush_loop(app):
+    with app.app_context():
+        while not _stop.wait(VOTE_FLUSH_MS / 1000):
+            try:
+                flush()
+            except Exception:
+                log.exception("Vote buffer flush failed, retrying")
+
+
+def _shutdown(app):
+    _stop.set()
+    with app.app_context():
+        flush()
+
+
+# Reads see the buffered votes too: loaded rows get the pending deltas added
+# without marking them dirty, so they are never written back
+@event.listens_for(DialogueThread, "load")
+@event.listens_for(DialogueComment, "load")
+@event.listens_for(OpinionPoll, "load")
+def _merge_pending(item, context, attrs=None):
+    deltas = pending(type(item), item.id) if _pending else None
+    if deltas:
+        for name, delta in zip(COUNTERS[type(item)], deltas):
+            if attrs is None or name in attrs:
+                set_committed_value(item, name, (getattr(item, name) or 0) + delta)
+
+
+for _model in COUNTERS:
+    event.listen(_model, "refresh", _merge_pending)
+
+
+# Vote table and target column per counter table
+VOTES = {
+    DialogueThread.__table__: (DialogueThreadVote.__table__, "thread_id"),
+    DialogueComment.__table__: (DialogueCommentVote.__table__, "comment_id"),
+    OpinionPoll.__table__: (OpinionVote.__table__, "poll_id"),
+}
+
+
+def _counts(table):
+    """Counter values of each row of table, as correlated subqueries on its vote table."""
+
+    votes, column = VOTES[table]
+    mine = votes.c[column] == table.c.id
+    if table is not OpinionPoll.__table__:
+        return {"score": select(func.coalesce(func.sum(votes.c.value), 0)).where(mine).scalar_subquery()}
+
+    yes, no = (
+        select(func.count(votes.c.id)).where(mine, votes.c.value == value).scalar_subquery()
+        for value in (1, -1)
+    )
+    return {"yes_count": yes, "no_count": no, "score": yes - no}
+
+
+def rebuild_counters():
+    """Recompute every vote counter from the vote tables. Returns the number of fixed rows.
+
+    Safe while other processes are running: their flushes set the same values.
+    """
+
+    fixed = 0
+    with db.engine.begin() as conn:
+        for model in COUNTERS:
+            table = model.__table__
+            counts = _counts(table)
+            wrong = [table.c[name] != value for name, value in counts.items()]
+            fixed += conn.execute(update(table).where(or_(*wrong)).values(counts)).rowcount
+    return fixed
+
+
+def recover():
+    """Rebuild the counters when a process on this host died with unflushed targets."""
+
+    stale = []
+    for path in glob.glob(_marker("*")):
+        pid = int(path.rsplit(".", 2)[-2])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            stale.append(path)
+        except PermissionError:
+            pass
+
+    if stale:
+        fixed = rebuild_counters()
+        log.warning("Vote buffer: %d stale marker(s), %d counters rebuilt", len(stale), fixed)
+        for path in stale:
+            os.remove(path)
+    return len(stale)
+
+
+def start(app):
+    """Recover after a crash and start the flush thread (once per process)."""
+    global _flusher
+
+    if _flusher is not None:
+        return
+
+    with app.app_context():
+        recover()
+
+    _stop.clear()
+    _flusher = threading.Thread(target=_flush_loop, args=(app,), name="vote-buffer", daemon=True)
+    _flusher.start()
+    atexit.register(_shutdown, app)
+
+
+def _benchmark(voters=200, threads=16, rounds=5):
+    """Votes per second on one hot poll, direct counters against the buffer (SQLite)."""
+    import random
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from flask import Flask
+
+    import voting
+    from models import User
+
+    workdir = tempfile.mkdtemp(prefix="votebuffer")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{workdir}/bench.db"
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 30}}
+    db.init_app(app)
+
+    global STATE_DIR
+    STATE_DIR = workdir
+
+    for buffered in (False, True):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.execute(User.__table__.insert(), [{"id": i + 1, "username": f"v{i}", "hash": "x"} for i in range(voters)])
+            poll = OpinionPoll(question="Populair?", author_id=1)
+            db.session.add(poll)
+            db.session.commit()
+            poll_id = poll.id
+
+        if buffered:
+            start(app)
+
+        def worker(seed):
+            rng = random.Random(seed)
+            with app.app_context():
+                for _ in range(rounds * voters // threads):
+                    voting.vote_poll(rng.randint(1, voters), poll_id, rng.choice((1, -1)))
+                    db.session.commit()
+            return rounds * voters // threads
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            total = sum(pool.map(worker, range(threads)))
+        elapsed = time.perf_counter() - started
+
+        with app.app_context():
+            flush()
+            yes = OpinionVote.query.filter_by(poll_id=poll_id, value=1).count()
+            no = OpinionVote.query.filter_by(poll_id=poll_id, value=-1).count()
+            p = db.session.get(OpinionPoll, poll_id)
+            assert (p.yes_count, p.no_count, p.score) == (yes, no, yes - no), (p.yes_count, p.no_count, yes, no)
+
+        label = "buffered" if buffered else "direct"
+        print(f"{label:<9} {total} votes in {elapsed:.2f}s ({total / elapsed:.0f}/s), totals match the vote table")
+
+    _stop.set()
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,223 @@
+import os
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+
+import hot_rank
+import vote_buffer
+from models import (
+    db, DialogueThread, DialogueThreadVote, DialogueComment,
+    DialogueCommentVote, OpinionPoll, OpinionVote,
+)
+
+
+# A vote is a few conditional writes whose row counts say what happened
+# (new vote, reversed vote, withdrawn vote), followed by one
+# "score = score + delta" on the target, all in one short transaction. A
+# portable INSERT ... ON CONFLICT DO UPDATE can't tell an insert from an
+# update, so the upsert is split into UPDATE ... WHERE value = -v and
+# INSERT ... ON CONFLICT DO NOTHING. Losing a race to a concurrent vote of
+# the same user just runs the steps again. With VOTE_BUFFER=1 the counter
+# deltas go to vote_buffer instead, once the vote commits, and the
+# counters are recomputed in batches.
+MAX_ATTEMPTS = 5
+
+
+def _insert_new(session, table, values, keys):
+    """INSERT ... ON CONFLICT DO NOTHING. True when the row was inserted."""
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        module = sqlite if dialect == "sqlite" else postgresql
+        stmt = module.insert(table).values(**values).on_conflict_do_nothing(index_elements=keys)
+        return session.execute(stmt).rowcount == 1
+
+    # Other databases: the unique constraint decides
+    try:
+        with session.begin_nested():
+            session.execute(insert(table).values(**values))
+        return True
+    except IntegrityError:
+        return False
+
+
+def _toggle(session, vote_model, target_column, user_id, target_id, value):
+    """Add, reverse or withdraw (same direction again) a +1/-1 vote. Returns (score delta, new vote)."""
+
+    table = vote_model.__table__
+    target = table.c[target_column]
+    mine = (table.c.user_id == user_id) & (target == target_id)
+
+    for _ in range(MAX_ATTEMPTS):
+        # Same direction again: withdraw
+        if session.execute(delete(table).where(mine, table.c.value == value)).rowcount:
+            return -value, 0
+
+        # Other direction: reverse
+        if session.execute(update(table).where(mine, table.c.value == -value).values(value=value)).rowcount:
+            return 2 * value, value
+
+        # No vote yet
+        if _insert_new(session, table, {"user_id": user_id, target_column: target_id, "value": value},
+                       ["user_id", target_column]):
+            return value, value
+
+    raise RuntimeError(f"vote on {table.name} {target_id} kept conflicting")
+
+
+def _add_score(session, model, target_id, delta):
+    table = model.__table__
+    if delta and vote_buffer.enabled():
+        vote_buffer.add(model, target_id, delta, session=session)
+    elif delta:
+        session.execute(
+            update(table).where(table.c.id == target_id).values(score=table.c.score + delta)
+        )
+
+    score = session.execute(select(table.c.score).where(table.c.id == target_id)).scalar_one()
+    return score + (vote_buffer.pending(model, target_id, session) or [0])[0]
+
+
+def vote_thread(user_id, thread_id, value, session=None):
+    """Toggle a vote on a dialogue thread. Returns {"score", "vote"}; the caller commits."""
+
+    session = session or db.session
+    delta, vote = _toggle(session, DialogueThreadVote, "thread_id", user_id, thread_id, value)
+    score = _add_score(session, DialogueThread, thread_id, delta)
+
+    # Buffered deltas update the rank when they are flushed
+    if delta and not vote_buffer.enabled():
+        hot_rank.refresh(session.connection(), [thread_id])
+    return {"score": score, "vote": vote}
+
+
+def vote_comment(user_id, comment_id, value, session=None):
+    """Toggle a vote on a comment. Returns {"score", "vote"}; the caller commits."""
+
+    session = session or db.session
+    delta, vote = _toggle(session, DialogueCommentVote, "comment_id", user_id, comment_id, value)
+    return {"score": _add_score(session, DialogueComment, comment_id, delta), "vote": vote}
+
+
+def vote_poll(user_id, poll_id, value, session=None):
+    """Vote yes (1) or no (-1) on a poll; a vote can be changed but not withdrawn.
+
+    Returns {"yes", "no", "score", "vote", "changed"}; the caller commits.
+    """
+
+    session = session or db.session
+    votes, polls = OpinionVote.__table__, OpinionPoll.__table__
+    mine = (votes.c.user_id == user_id) & (votes.c.poll_id == poll_id)
+    yes, no = (1, 0) if value == 1 else (0, 1)
+
+    for _ in range(MAX_ATTEMPTS):
+        # Changed their mind: move one vote from the other side
+        if session.execute(update(votes).where(mine, votes.c.value == -value).values(value=value)).rowcount:
+            yes, no = (yes - no, no - yes)
+            break
+
+        if _insert_new(session, votes, {"user_id": user_id, "poll_id": poll_id, "value": value},
+                       ["user_id", "poll_id"]):
+            break
+
+        # Conflict: the same vote was already there (or a concurrent one, try again)
+        existing = session.execute(select(votes.c.value).where(mine)).scalar()
+        if existing == value:
+            yes = no = 0
+            break
+    else:
+        raise RuntimeError(f"vote on poll {poll_id} kept conflicting")
+
+    if (yes or no) and vote_buffer.enabled():
+        vote_buffer.add(OpinionPoll, poll_id, yes, no, yes - no, session=session)
+    elif yes or no:
+        session.execute(
+            update(polls)
+            .where(polls.c.id == poll_id)
+            .values(
+                yes_count=polls.c.yes_count + yes,
+                no_count=polls.c.no_count + no,
+                score=polls.c.score + (yes - no),
+            )
+        )
+
+    totals = list(session.execute(
+        select(polls.c.yes_count, polls.c.no_count, polls.c.score).where(polls.c.id == poll_id)
+    ).one())
+    for i, delta in enumerate(vote_buffer.pending(OpinionPoll, poll_id, session) or ()):
+        totals[i] += delta
+    return {
+        "yes": totals[0],
+        "no": totals[1],
+        "score": totals[2],
+        "vote": value,
+        "changed": bool(yes or no),
+    }
+
+
+def _benchmark(voters=200, threads=16, rounds=3):
+    """Many threads voting on one poll and one dialogue thread; the totals must match the vote tables."""
+    import random
+    import tempfile
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from flask import Flask
+    from sqlalchemy import func
+
+    workdir = tempfile.mkdtemp(prefix="votebench")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("VOTE_BENCH_DATABASE_URL", f"sqlite:///{workdir}/bench.db")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 30}} if "sqlite" in app.config["SQLALCHEMY_DATABASE_URI"] else {}
+    db.init_app(app)
+
+    from models import User
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        users = User.__table__
+        db.session.execute(users.insert(), [{"id": i + 1, "username": f"voter{i}", "hash": "x"} for i in range(voters)])
+        poll = OpinionPoll(question="Populair?", author_id=1)
+        thread = DialogueThread(title="Populair", author_id=1)
+        db.session.add_all([poll, thread])
+        db.session.commit()
+        poll_id, thread_id = poll.id, thread.id
+
+    def worker(seed):
+        rng = random.Random(seed)
+        done = 0
+        with app.app_context():
+            for _ in range(rounds * voters // threads):
+                user_id = rng.randint(1, voters)
+                value = rng.choice((1, -1))
+                if rng.random() < 0.5:
+                    vote_poll(user_id, poll_id, value)
+                else:
+                    vote_thread(user_id, thread_id, value)
+                db.session.commit()
+                done += 1
+        return done
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        total = sum(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        p = db.session.get(OpinionPoll, poll_id)
+        t = db.session.get(DialogueThread, thread_id)
+        yes = OpinionVote.query.filter_by(poll_id=poll_id, value=1).count()
+        no = OpinionVote.query.filter_by(poll_id=poll_id, value=-1).count()
+        score = db.session.query(func.coalesce(func.sum(DialogueThreadVote.value), 0)).filter_by(thread_id=thread_id).scalar()
+
+    print(f"{total} votes from {threads} threads in {elapsed:.2f}s ({total / elapsed:.0f}/s)")
+    print(f"poll:   yes {p.yes_count} / {yes}, no {p.no_count} / {no}, score {p.score} / {yes - no}")
+    print(f"thread: score {t.score} / {score}")
+    assert (p.yes_count, p.no_count, p.score) == (yes, no, yes - no)
+    assert t.score == score
+    print("totals match the vote tables")
+
+
+if __name__ == "__main__":
+    _benchmark()